@@ -31,18 +31,24 @@ import email.Utils
 import email.Message
 import email.FeedParser
 import StringIO
-import gzip
 import zlib
+import tempfile
 import httplib
 import urlparse
 import base64
 import os
+import stat
 import copy
 import calendar
 import time
 import random
 import errno
 import logging
+import threading
+import weakref
+import Queue
+import select
+import io
 
 # Optional arguments to pass to alternative dns resolution libs like gevent.socket , mainly for QUERY_NO_SEARCH option
 SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS={}
@@ -71,25 +77,208 @@ try:
 except ImportError:
     socks = None
 
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import cacheindex
+from streaming_httplib2 import dnscache
+
+# Optional content-coding decoders
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Cache of name resolutions shared by all connections, set it
+# to None to resolve names each time a connection is opened.
+DNS_CACHE = dnscache.DNSCache()
+
+# Cache of the headers read from cache entries, for the entry files that
+# did not change since, set it to None to read them on each hit.
+CACHE_METADATA = cacheformat.MetadataCache()
+
+def _getaddrinfo(host, port):
+    "Resolve 'host' and 'port' for a connection, through DNS_CACHE"
+    if DNS_CACHE is None:
+        resolve = socket.getaddrinfo
+    else:
+        resolve = DNS_CACHE.getaddrinfo
+    return resolve(host, port, SOCKET_FAMILY, socket.SOCK_STREAM, **SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS)
+
+def _gethostbyname(host):
+    "socket.gethostbyname through DNS_CACHE, for the socks module"
+    if DNS_CACHE is None:
+        return socket.gethostbyname(host)
+    return DNS_CACHE.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM,
+            **SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS)[0][4][0]
+
+def _connect_failed(host):
+    "None of the addresses of 'host' could be connected to"
+    if DNS_CACHE is not None:
+        DNS_CACHE.invalidate(host)
+
+if socks is not None:
+    socks.gethostbyname = _gethostbyname
+
+if hasattr(select, 'poll'):
+    def _poll(fds, write, timeout):
+        """Those of the files or sockets 'fds' ready to be written to if
+        'write' is set, read from otherwise, or in error, waiting at
+        most 'timeout' seconds, or forever when it is None.
+
+        poll takes any file descriptor, select only those below
+        FD_SETSIZE, so select is only used where poll is missing."""
+        poller = select.poll()
+        if write:
+            mask = select.POLLOUT
+        else:
+            mask = select.POLLIN | select.POLLPRI
+        mask |= select.POLLERR | select.POLLHUP
+        by_fd = {}
+        for fd in fds:
+            by_fd[getattr(fd, 'fileno', lambda: fd)()] = fd
+            poller.register(fd, mask)
+        if timeout is not None:
+            timeout = max(timeout, 0) * 1000
+        return [by_fd[fd] for (fd, events) in poller.poll(timeout)]
+else:
+    def _poll(fds, write, timeout):
+        if write:
+            (readable, writable, failed) = select.select([], fds, fds, timeout)
+        else:
+            (readable, writable, failed) = select.select(fds, [], fds, timeout)
+        return list(set(readable + writable + failed))
+
+# How long to wait on a connection attempt before racing the
+# next address of the host with it, in seconds.
+CONNECT_ATTEMPT_DELAY = 0.25
+
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+                        getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+# The number of hosts the address family of the last connection is
+# remembered for.
+MAX_CONNECTED_FAMILIES = 1024
+
+# Map host to the address family of its last connection
+_connected_families = {}
+
+def _create_connection(host, port, timeout):
+    """Connect to 'host' and return the socket.
+
+    The addresses of the host are tried in staggered parallel attempts,
+    CONNECT_ATTEMPT_DELAY apart, alternating between address families
+    and starting with the family that connected last time, and the
+    first socket to connect wins. 'timeout' bounds the whole connect.
+    """
+    addresses = _getaddrinfo(host, port)
+    if not has_timeout(timeout):
+        timeout = socket.getdefaulttimeout()
+    preferred = _connected_families.get(host)
+    families = []
+    for address in addresses:
+        if address[0] not in families:
+            families.append(address[0])
+    if preferred in families:
+        families.remove(preferred)
+        families.insert(0, preferred)
+    by_family = [[address for address in addresses if address[0] == family] for family in families]
+    addresses = []
+    while by_family:
+        for family_addresses in by_family:
+            addresses.append(family_addresses.pop(0))
+        by_family = [family_addresses for family_addresses in by_family if family_addresses]
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    # Map sockets still connecting to their address family
+    pending = {}
+    winner = None
+    error = socket.error("getaddrinfo returns an empty list")
+    try:
+        while winner is None and (addresses or pending):
+            if addresses:
+                (family, socktype, proto, canonname, sockaddr) = addresses.pop(0)
+                sock = None
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    sock.setblocking(0)
+                    err = sock.connect_ex(sockaddr)
+                except socket.error, e:
+                    if sock:
+                        sock.close()
+                    error = e
+                    continue
+                if err == 0:
+                    (winner, winner_family) = (sock, family)
+                    break
+                if err not in _CONNECT_IN_PROGRESS:
+                    sock.close()
+                    error = socket.error(err, os.strerror(err))
+                    continue
+                pending[sock] = family
+            if not pending:
+                continue
+            wait = None
+            if addresses:
+                wait = CONNECT_ATTEMPT_DELAY
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                if wait is None or remaining < wait:
+                    wait = remaining
+            for sock in _poll(pending.keys(), True, wait):
+                family = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0 and winner is None:
+                    (winner, winner_family) = (sock, family)
+                else:
+                    sock.close()
+                    if err:
+                        error = socket.error(err, os.strerror(err))
+    finally:
+        for sock in pending:
+            sock.close()
+    if winner is None:
+        _connect_failed(host)
+        raise error
+    if host not in _connected_families and len(_connected_families) >= MAX_CONNECTED_FAMILIES:
+        _connected_families.clear()
+    _connected_families[host] = winner_family
+    winner.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    winner.settimeout(timeout)
+    return winner
+
 # Build the appropriate socket wrapper for ssl
 try:
     import ssl # python 2.6
     ssl_SSLError = ssl.SSLError
     def _ssl_wrap_socket(sock, key_file, cert_file,
-                         disable_validation, ca_certs):
+                         disable_validation, ca_certs,
+                         do_handshake_on_connect=True):
         if disable_validation:
             cert_reqs = ssl.CERT_NONE
         else:
             cert_reqs = ssl.CERT_REQUIRED
+        if hasattr(ssl, 'SSLContext'):
+            context = _ssl_context(key_file, cert_file, cert_reqs, ca_certs)
+            return context.wrap_socket(sock, do_handshake_on_connect=do_handshake_on_connect)
         # We should be specifying SSL version 3 or TLS v1, but the ssl module
         # doesn't expose the necessary knobs. So we need to go with the default
         # of SSLv23.
         return ssl.wrap_socket(sock, keyfile=key_file, certfile=cert_file,
-                               cert_reqs=cert_reqs, ca_certs=ca_certs)
+                               cert_reqs=cert_reqs, ca_certs=ca_certs,
+                               do_handshake_on_connect=do_handshake_on_connect)
 except (AttributeError, ImportError):
     ssl_SSLError = None
     def _ssl_wrap_socket(sock, key_file, cert_file,
-                         disable_validation, ca_certs):
+                         disable_validation, ca_certs,
+                         do_handshake_on_connect=True):
         if not disable_validation:
             raise CertificateValidationUnsupported(
                     "SSL certificate validation is not supported without "
@@ -98,6 +287,48 @@ except (AttributeError, ImportError):
         ssl_sock = socket.ssl(sock, key_file, cert_file)
         return httplib.FakeSocket(sock, ssl_sock)
 
+# Map (key_file, cert_file, cert_reqs, ca_certs) to an SSLContext, so that
+# the CA certificates and client certificate are loaded once.
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+def _ssl_context(key_file, cert_file, cert_reqs, ca_certs):
+    "The SSLContext for these settings, the same ssl.wrap_socket would set up"
+    key = (key_file, cert_file, cert_reqs, ca_certs)
+    _ssl_contexts_lock.acquire()
+    try:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = cert_reqs
+            if ca_certs:
+                context.load_verify_locations(ca_certs)
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            _ssl_contexts[key] = context
+        return context
+    finally:
+        _ssl_contexts_lock.release()
+
+# The number of (certificate, hostname) checks remembered.
+MAX_HOSTNAME_CHECKS = 1024
+
+# Map (certificate fingerprint, hostname) to whether they match
+_hostname_checks = {}
+
+def _check_hostname(conn, ssl_sock, hostname):
+    """Whether the certificate 'ssl_sock' got matches 'hostname', as
+    conn._ValidateCertificateHostname says, remembered by certificate
+    fingerprint and hostname."""
+    key = (_sha(ssl_sock.getpeercert(True)).hexdigest(), hostname)
+    valid = _hostname_checks.get(key)
+    if valid is None:
+        valid = conn._ValidateCertificateHostname(ssl_sock.getpeercert(), hostname)
+        if len(_hostname_checks) >= MAX_HOSTNAME_CHECKS:
+            _hostname_checks.clear()
+        _hostname_checks[key] = valid
+    return valid
+
 
 if sys.version_info >= (2,3):
     from iri2uri import iri2uri
@@ -113,7 +344,9 @@ def has_timeout(timeout): # python 2.6
 __all__ = ['Http', 'Response', 'ProxyInfo', 'HttpLib2Error',
   'RedirectMissingLocation', 'RedirectLimit', 'FailedToDecompressContent',
   'UnimplementedDigestAuthOptionError', 'UnimplementedHmacDigestAuthOptionError',
-  'debuglevel', 'ProxiesUnavailableError']
+  'debuglevel', 'ProxiesUnavailableError', 'ConnectionPool', 'PoolFullError',
+  'register_content_decoder', 'send_to', 'NonRewindableBodyError',
+  'Content', 'CacheBusyError']
 
 
 # The httplib debug level, set to a non-zero value to get debug output
@@ -160,6 +393,9 @@ class ProxiesUnavailableError(HttpLib2Error): pass
 class CertificateValidationUnsupported(HttpLib2Error): pass
 class SSLHandshakeError(HttpLib2Error): pass
 class NotSupportedOnThisPlatform(HttpLib2Error): pass
+class PoolFullError(HttpLib2Error): pass
+class NonRewindableBodyError(HttpLib2Error): pass
+class CacheBusyError(HttpLib2Error): pass
 class CertificateHostnameMismatch(SSLHandshakeError):
   def __init__(self, desc, host, cert):
     HttpLib2Error.__init__(self, desc)
@@ -188,6 +424,46 @@ class CertificateHostnameMismatch(SSLHandshakeError):
 # requesting that URI again.
 DEFAULT_MAX_REDIRECTS = 5
 
+# The maximum number of connections an Http object keeps open
+# to a single scheme:authority, and whether a request waits for
+# one of them to be free (True) or raises PoolFullError (False)
+# when they are all in use.
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_POOL_BLOCK = True
+
+# How long, in seconds, a pooled connection can stay idle, and be used
+# at all, before it is closed (None means no limit). Servers drop idle
+# keep-alive connections after a while, better close them first.
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+DEFAULT_POOL_MAX_LIFETIME = None
+
+# Closing a response body with at most this many bytes left unread
+# reads them, so that the connection can be reused. With more left,
+# the connection is closed instead.
+MAX_DRAIN_SIZE = 64 * 1024
+
+# How much of a compressed body is read at a time to decompress it.
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+# Cache entries holding a body as it was sent, compressed, say how
+# with this header.
+STORED_ENCODING = '-x-stored-encoding'
+
+# Partial cache entries, whose download stopped early, are looked up
+# with this header giving the number of bytes of their body they hold.
+PARTIAL_ENTRY = '-x-partial'
+
+# How much is read at a time to copy bodies, to and from the cache.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# The number of threads Http.fetch_all uses by default, and how
+# many of them can be talking to the same scheme:authority.
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_FETCH_PER_HOST = 4
+
+# The number of requests Http.pipeline writes ahead on one connection.
+DEFAULT_PIPELINE_DEPTH = 8
+
 # Default CA certificates file bundled with httplib2.
 CA_CERTS = os.path.join(
         os.path.dirname(os.path.abspath(__file__ )), "cacerts.txt")
@@ -314,6 +590,45 @@ def _parse_www_authenticate(headers, headername='www-authenticate'):
     return retval
 
 
+def _response_freshness(response_headers):
+    """What the freshness of a response depends on, from its Date,
+    Expires and Cache-Control headers, as (no_cache, date, lifetime):
+    whether it has Cache-Control: no-cache, its date in seconds since
+    the epoch, or None, and how long it is fresh from then, or None when
+    neither max-age nor Expires says. Cache lookups keep it with the
+    headers of entries, see Http._cache_lookup.
+    """
+    cc_response = _parse_cache_control(response_headers)
+    date = None
+    lifetime = None
+    if response_headers.has_key('date'):
+        date = email.Utils.parsedate_tz(response_headers['date'])
+    if date is not None:
+        date = calendar.timegm(date)
+        if cc_response.has_key('max-age'):
+            try:
+                lifetime = int(cc_response['max-age'])
+            except ValueError:
+                lifetime = 0
+        elif response_headers.has_key('expires'):
+            expires = email.Utils.parsedate_tz(response_headers['expires'])
+            if None == expires:
+                lifetime = 0
+            else:
+                lifetime = max(0, calendar.timegm(expires) - date)
+    return (cc_response.has_key('no-cache'), date, lifetime)
+
+def _entry_expiry(response_headers):
+    """When the response stops being fresh, from its Date, Expires and
+    Cache-Control headers, in seconds since the epoch, or 0 when it is
+    not known. Cache entries record it for the tools maintaining them,
+    freshness itself is determined by _entry_disposition.
+    """
+    (no_cache, date, lifetime) = _response_freshness(response_headers)
+    if no_cache or date is None or lifetime is None:
+        return 0
+    return date + lifetime
+
 def _entry_disposition(response_headers, request_headers):
     """Determine freshness from the Date, Expires and Cache-Control headers.
 
@@ -340,10 +655,17 @@ def _entry_disposition(response_headers, request_headers):
     only-if-cached
     max-age
     min-fresh
+
+    The response side is what _response_freshness returns for
+    'response_headers', or their 'freshness' attribute when they have
+    one, as cache lookups set.
     """
     retval = "STALE"
     cc = _parse_cache_control(request_headers)
-    cc_response = _parse_cache_control(response_headers)
+    freshness = getattr(response_headers, 'freshness', None)
+    if freshness is None:
+        freshness = _response_freshness(response_headers)
+    (no_cache, date, lifetime) = freshness
 
     if request_headers.has_key('pragma') and request_headers['pragma'].lower().find('no-cache') != -1:
         retval = "TRANSPARENT"
@@ -351,28 +673,15 @@ def _entry_disposition(response_headers, request_headers):
             request_headers['cache-control'] = 'no-cache'
     elif cc.has_key('no-cache'):
         retval = "TRANSPARENT"
-    elif cc_response.has_key('no-cache'):
+    elif no_cache:
         retval = "STALE"
     elif cc.has_key('only-if-cached'):
         retval = "FRESH"
-    elif response_headers.has_key('date'):
-        date = calendar.timegm(email.Utils.parsedate_tz(response_headers['date']))
+    elif date is not None:
         now = time.time()
         current_age = max(0, now - date)
 
-        if cc_response.has_key('max-age'):
-            try:
-                freshness_lifetime = int(cc_response['max-age'])
-            except ValueError:
-                freshness_lifetime = 0
-        elif response_headers.has_key('expires'):
-            expires = email.Utils.parsedate_tz(response_headers['expires'])
-            if None == expires:
-                freshness_lifetime = 0
-            else:
-                freshness_lifetime = max(0, calendar.timegm(expires) - date)
-        else:
-            freshness_lifetime = 0
+        freshness_lifetime = lifetime or 0
         if cc.has_key('max-age'):
             try:
                 freshness_lifetime = int(cc['max-age'])
@@ -390,25 +699,700 @@ def _entry_disposition(response_headers, request_headers):
 
     return retval
 
+# Streaming decoders of content-codings, by coding name: see
+# register_content_decoder.
+CONTENT_DECODERS = {}
+
+# The registered codings, in the order they are sent in accept-encoding.
+CONTENT_CODINGS = []
+
+def register_content_decoder(coding, factory, errors=(), magic=None):
+    """Decode responses with the content-coding 'coding', and ask for it.
+
+    'factory' returns a new decoder, that works as a zlib decompressobj:
+    decompress(data, max_length) may leave data in unconsumed_tail when
+    it returns max_length bytes, data after the end of the stream is in
+    unused_data, and flush() returns what is left at the end of the body.
+    Decoders raise one of 'errors' on invalid data. A body that ends
+    before its stream does is refused when the decoder can tell: with an
+    'eof' attribute, or a zlib decompressobj 'copy' method to probe with. Data after the end
+    of a stream starting with 'magic' is decoded as another stream,
+    anything else is ignored.
+
+    Decoders whose module can't bound their output, like br and zstd, are
+    fed at most max_length bytes at a time instead: what one call returns
+    is then bounded by the compression ratio of that slice only.
+    """
+    if coding not in CONTENT_CODINGS:
+        CONTENT_CODINGS.append(coding)
+    CONTENT_DECODERS[coding] = (factory, tuple(errors), magic)
+
+def _content_codings(encoding):
+    "The codings of a content-encoding header, in the order they were applied"
+    return [coding for coding in [c.strip().lower() for c in encoding.split(',')]
+            if coding and coding != 'identity']
+
+def _decodable(encoding):
+    "Whether a body with the content-encoding 'encoding' can be decoded"
+    codings = _content_codings(encoding or '')
+    return bool(codings) and not [c for c in codings if c not in CONTENT_DECODERS]
+
+def _accept_encoding():
+    return ", ".join(CONTENT_CODINGS)
+
+def _zlib_eof(decompressor):
+    """Whether the zlib 'decompressor' saw the end of its stream.
+
+    Python 2 decompressobjs have no eof attribute, but once the stream
+    ended, what they are given goes to unused_data: a copy is given a
+    byte to see where it goes."""
+    probe = decompressor.copy()
+    try:
+        probe.decompress("\0")
+    except zlib.error:
+        return False
+    return probe.unused_data == "\0"
+
+class _DeflateDecoder(object):
+    """deflate is meant to be zlib wrapped, but raw deflate is common:
+    the first two bytes tell which one a body is."""
+    def __init__(self):
+        self.decompressor = None
+        self.head = ""
+        self.unconsumed_tail = ""
+        self.unused_data = ""
+
+    def decompress(self, data, max_length=0):
+        if self.decompressor is None:
+            self.head += data
+            if len(self.head) < 2:
+                return ""
+            (data, self.head) = (self.head, "")
+            if ord(data[0]) & 0x0f == 8 and (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+                self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            else:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = self.decompressor.decompress(data, max_length)
+        self.unconsumed_tail = self.decompressor.unconsumed_tail
+        self.unused_data = self.decompressor.unused_data
+        return data
+
+    def flush(self):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(self.head) + self.decompressor.flush()
+        return self.decompressor.flush()
+
+    def copy(self):
+        decoder = _DeflateDecoder()
+        decoder.head = self.head
+        if self.decompressor is not None:
+            decoder.decompressor = self.decompressor.copy()
+        return decoder
+
+def _slice_input(decoder, data, max_length):
+    """The part of 'data' 'decoder' decompresses now, at most 'max_length'
+    bytes of it when that is set; the rest goes to its unconsumed_tail."""
+    if max_length and len(data) > max_length:
+        decoder.unconsumed_tail = data[max_length:]
+        return data[:max_length]
+    decoder.unconsumed_tail = ""
+    return data
+
+class _BrotliDecoder(object):
+    """Brotli decompressor, from the brotli or brotlipy module.
+
+    Neither module bounds the output of a call, so the input is sliced."""
+    unused_data = ""
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+        self.unconsumed_tail = ""
+
+    def decompress(self, data, max_length=0):
+        data = _slice_input(self, data, max_length)
+        if hasattr(self.decompressor, 'process'):
+            return self.decompressor.process(data)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if hasattr(self.decompressor, 'finish'):
+            return self.decompressor.finish() or ""
+        return ""
+
+    @property
+    def eof(self):
+        if hasattr(self.decompressor, 'is_finished'):
+            return self.decompressor.is_finished()
+        return None
+
+class _ZstdDecoder(object):
+    """Zstandard decompressor, from the zstandard module.
+
+    Its decompressobj does not bound the output of a call, so the input
+    is sliced."""
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.unconsumed_tail = ""
+        self.unused_data = ""
+
+    def decompress(self, data, max_length=0):
+        data = self.decompressor.decompress(_slice_input(self, data, max_length))
+        self.unused_data = getattr(self.decompressor, 'unused_data', "")
+        return data
+
+    def flush(self):
+        return ""
+
+    @property
+    def eof(self):
+        return getattr(self.decompressor, 'eof', None)
+
+register_content_decoder('gzip', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), [zlib.error], "\037\213")
+register_content_decoder('deflate', _DeflateDecoder, [zlib.error])
+if brotli is not None:
+    register_content_decoder('br', _BrotliDecoder, [getattr(brotli, 'error', getattr(brotli, 'Error', ValueError))])
+if zstandard is not None:
+    register_content_decoder('zstd', _ZstdDecoder, [zstandard.ZstdError], "\x28\xb5\x2f\xfd")
+
+class _DecompressedContent(object):
+    """File-like wrapper decoding a compressed body as it is read.
+
+    The body is read DECOMPRESS_CHUNK_SIZE bytes at a time, and each read
+    decompresses little more than it returns, so memory stays bounded
+    whatever the size of the body; br and zstd decoders are only bounded
+    by the compression ratio of a slice of input, see
+    register_content_decoder.
+    'encoding' is a content-encoding header: stacked codings are decoded
+    by a chain of wrappers, the last applied first. A body that fails to
+    decompress, or is cut short, raises FailedToDecompressContent from
+    read().
+
+    Until read() is first called, compressed() can hand the body back
+    as it was sent, 'length' bytes long when that is known.
+    """
+    def __init__(self, response, fp, encoding, length=None):
+        codings = _content_codings(encoding)
+        if len(codings) > 1:
+            # Decoded first, by the wrapper reading the body
+            fp = _DecompressedContent(response, fp, ", ".join(codings[1:]), length)
+        self.response = response
+        self.fp = fp
+        self.encoding = encoding
+        self.coding = codings[0]
+        (self.factory, self.errors, self.magic) = CONTENT_DECODERS[self.coding]
+        self.length = length
+        # What was read from 'fp', while it can still be handed back
+        self.raw = []
+        self.decompressor = None
+        # Compressed data not fed to the decompressor yet
+        self.pending = ""
+        # Decompressed data not returned yet
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, amt=None):
+        # The body can't be handed back any more: stop recording it, in
+        # the wrappers of the chain too, which are only read through _read.
+        content = self
+        while isinstance(content, _DecompressedContent):
+            content.raw = None
+            content = content.fp
+        return self._read(amt)
+
+    def close(self):
+        self.fp.close()
+
+    def compressed(self):
+        """The body as sent, or None once read() was called."""
+        if self.raw is None:
+            return None
+        prefix = "".join(self.raw)
+        self.raw = None
+        self.eof = True
+        self.buffer = ""
+        if isinstance(self.fp, _DecompressedContent):
+            return self.fp.compressed()
+        return _PrefixedFile(prefix, self.fp)
+
+    def prime(self):
+        """Decompress the start of the body, so that a body that is not
+        compressed at all fails right away."""
+        while not self.buffer and not self.eof:
+            self.buffer = self._decompress(1)
+
+    def _read(self, amt=None):
+        if amt is None:
+            chunks = [self.buffer]
+            self.buffer = ""
+            while not self.eof:
+                chunks.append(self._decompress(DECOMPRESS_CHUNK_SIZE))
+            return "".join(chunks)
+        while len(self.buffer) < amt and not self.eof:
+            self.buffer += self._decompress(amt - len(self.buffer))
+        data = self.buffer[:amt]
+        self.buffer = self.buffer[amt:]
+        return data
+
+    def _decompress(self, size):
+        """Decompress about 'size' more bytes."""
+        try:
+            if not self.pending:
+                self.pending = self._read_raw()
+                if not self.pending:
+                    self.eof = True
+                    if self.decompressor is None:
+                        return ""
+                    if not self._stream_ended():
+                        raise FailedToDecompressContent(_("Content purported to be compressed with %s ended before its stream did.") % self.encoding, self.response, StringIO.StringIO(""))
+                    return self.decompressor.flush()
+            if self.decompressor is None:
+                self.decompressor = self.factory()
+            data = self.decompressor.decompress(self.pending, max(size, 1024))
+            self.pending = self.decompressor.unconsumed_tail
+            unused = self.decompressor.unused_data
+            if unused:
+                # The end of a stream: another one may follow, anything
+                # else is ignored like gzip does with trailing garbage.
+                self.decompressor = None
+                if self.magic and unused.startswith(self.magic):
+                    self.pending = unused + self.pending
+                else:
+                    self.pending = ""
+                    self._skip()
+            return data
+        except self.errors:
+            self.eof = True
+            raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % self.encoding, self.response, StringIO.StringIO(""))
+
+    def _stream_ended(self):
+        """Whether the decompressor saw the end of its stream, True
+        when it can't tell."""
+        ended = getattr(self.decompressor, 'eof', None)
+        if ended is None and hasattr(self.decompressor, 'copy'):
+            ended = _zlib_eof(self.decompressor)
+        return ended is None or ended
+
+    def _read_raw(self):
+        if isinstance(self.fp, _DecompressedContent):
+            # The previous decoder of a chain: only the first records the body
+            return self.fp._read(DECOMPRESS_CHUNK_SIZE)
+        data = self.fp.read(DECOMPRESS_CHUNK_SIZE)
+        if self.raw is not None:
+            self.raw.append(data)
+        return data
+
+    def _skip(self):
+        """Read what is left of the body, so that its connection is released."""
+        while self._read_raw():
+            pass
+        self.eof = True
+
+
+class _PrefixedFile(object):
+    """File-like object reading 'prefix', then 'fp'."""
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.prefix + self.fp.read()
+            self.prefix = ""
+            return data
+        if self.prefix:
+            data = self.prefix[:amt]
+            self.prefix = self.prefix[amt:]
+            return data
+        return self.fp.read(amt)
+
+    def close(self):
+        self.fp.close()
+
+
+class _TeeContent(object):
+    """File-like wrapper writing what is read from 'content' through to a
+    cache entry 'writer', as returned by the open method of caches.
+
+    Nothing is buffered beyond what each read returns. The entry is
+    committed once its 'length' bytes were read, and aborted when the
+    body is closed before. When it ends early or fails, the entry is
+    aborted too, unless it is 'partial': what was written is then kept
+    as a partial entry, to be resumed (see Http._resume).
+
+    With 'length' None, the entry is committed when the body ends, and
+    'header' is called with its length for the entry header to write
+    over the one the entry was opened with, of the same size.
+
+    A body dropped without being closed is noticed through a weak
+    reference, and its entry aborted as if it was closed.
+    """
+    def __init__(self, content, writer, length, partial=False, header=None):
+        self.content = content
+        self.writer = writer
+        self.left = length
+        self.partial = partial
+        self.header = header
+        self.length = 0
+        self.ref = weakref.ref(self, _tee_lost)
+        _tee_writers[self.ref] = writer
+        if length == 0:
+            self._commit()
+
+    def read(self, amt=None):
+        if amt is None:
+            # In chunks, so that what was read is written if it fails
+            chunks = []
+            while True:
+                data = self.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                chunks.append(data)
+            if self.left is not None and self.left > 0:
+                raise httplib.IncompleteRead("".join(chunks), self.left)
+            return "".join(chunks)
+        try:
+            data = self.content.read(amt)
+        except:
+            self._stop()
+            raise
+        self.length += len(data)
+        if self.left is not None:
+            self.left -= len(data)
+        if self.writer is not None:
+            if self.left is not None and self.left < 0:
+                self._abort()
+            elif not data and amt != 0:
+                if self.left is None:
+                    self._complete()
+                else:
+                    self._stop()
+            else:
+                try:
+                    self.writer.write(data)
+                except (IOError, OSError):
+                    report_error("Could not write cache entry")
+                    self._abort()
+                if self.left == 0:
+                    self._commit()
+        return data
+
+    def close(self):
+        self._abort()
+        self.content.close()
+
+    def _take_writer(self):
+        (writer, self.writer) = (self.writer, None)
+        _tee_writers.pop(self.ref, None)
+        return writer
+
+    def _commit(self):
+        writer = self._take_writer()
+        if writer is not None:
+            try:
+                writer.commit()
+            except (IOError, OSError):
+                report_error("Could not write cache entry")
+                writer.abort()
+
+    def _abort(self):
+        writer = self._take_writer()
+        if writer is not None:
+            writer.abort()
+
+    def _complete(self):
+        "The body of unknown length ended"
+        try:
+            self.writer.rewrite(self.header(self.length))
+        except (IOError, OSError):
+            report_error("Could not write cache entry")
+            self._abort()
+        else:
+            self._commit()
+
+    def _stop(self):
+        "The body ended early"
+        if self.partial:
+            self._commit()
+        else:
+            self._abort()
+
+
+# Map weak references to the _TeeContent objects writing cache entries
+# to their writers, aborted if they are dropped without being closed.
+_tee_writers = {}
+
+def _tee_lost(ref):
+    writer = _tee_writers.pop(ref, None)
+    if writer is not None:
+        try:
+            writer.abort()
+        except Exception:
+            report_error("Could not abort cache entry")
+
+
+class _ResumedContent(object):
+    """File-like object reading the first 'length' bytes of the partial
+    cache entry 'cached_value', then the rest of the body from 'rest'."""
+    def __init__(self, cached_value, length, rest):
+        self.cached_value = cached_value
+        self.left = length
+        self.rest = rest
+
+    def read(self, amt=None):
+        if self.left > 0:
+            if amt is None:
+                data = self.cached_value.read(self.left)
+                self.left = 0
+                return data + self.rest.read()
+            data = self.cached_value.read(min(amt, self.left))
+            if not data:
+                # The entry is shorter than it was
+                raise IOError(errno.EIO, "Partial cache entry truncated")
+            self.left -= len(data)
+            if self.left == 0 and len(data) < amt:
+                data += self.rest.read(amt - len(data))
+            return data
+        if amt is None:
+            return self.rest.read()
+        return self.rest.read(amt)
+
+    def close(self):
+        # The rest first: it may be appending to the entry
+        self.rest.close()
+        self.cached_value.close()
+
+
+def _range_validator(headers):
+    """The validator of 'headers' an If-Range header can use, a strong
+    ETag or a Last-Modified date, or None."""
+    etag = headers.get('etag', None)
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified', None)
+
+
 def _decompressContent(response, new_content):
     content = new_content
-    try:
-        encoding = response.get('content-encoding', None)
-        if encoding in ['gzip', 'deflate']:
-            if encoding == 'gzip':
-                content = gzip.GzipFile(fileobj=StringIO.StringIO(new_content.read())).read()
-            if encoding == 'deflate':
-                content = zlib.decompress(content.read())
-            response['content-length'] = str(len(content))
-            # Record the historical presence of the encoding in a way the won't interfere.
-            response['-content-encoding'] = response['content-encoding']
-            del response['content-encoding']
-            content = StringIO.StringIO(content)
-    except IOError:
-        content = StringIO.StringIO("")
-        raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % response.get('content-encoding'), response, content)
+    encoding = response.get('content-encoding', None)
+    if _decodable(encoding):
+        length = response.get('content-length', None)
+        if length is not None:
+            length = int(length)
+        content = _DecompressedContent(response, new_content, encoding, length)
+        content.prime()
+        # The decompressed length is only known at the end
+        if response.has_key('content-length'):
+            del response['content-length']
+        # Record the historical presence of the encoding in a way the won't interfere.
+        response['-content-encoding'] = response['content-encoding']
+        del response['content-encoding']
     return content
 
+def _copy(content, write, chunk_size=None):
+    """Copy what is left of 'content' with 'write', and return the number
+    of bytes copied.
+
+    Contents with a readinto method are read into a single buffer, and
+    'write' is given memoryviews of it which it must not keep. Others
+    are read 'chunk_size' bytes at a time, COPY_CHUNK_SIZE by default.
+    """
+    chunk_size = chunk_size or COPY_CHUNK_SIZE
+    total = 0
+    readinto = getattr(content, 'readinto', None)
+    if readinto is not None:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            size = readinto(buf)
+            if not size:
+                break
+            write(view[:size])
+            total += size
+    else:
+        while True:
+            data = content.read(chunk_size)
+            if not data:
+                break
+            write(data)
+            total += len(data)
+    return total
+
+def _fd_writer(fd):
+    "A write function for _copy, writing all it is given to 'fd'"
+    def write(data):
+        while len(data):
+            data = data[os.write(fd, data):]
+    return write
+
+def _spool(content):
+    """Copy 'content' to a temporary file, and return it with its length,
+    for caches that can only be given a body of known length."""
+    spooled = tempfile.TemporaryFile()
+    length = _copy(content, spooled.write)
+    spooled.seek(0)
+    return (spooled, length)
+
+def _libc_sendfile():
+    """sendfile(2) called through ctypes, for pythons without os.sendfile."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+
+    def _sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return _sendfile
+
+# sendfile(out_fd, in_fd, offset, count) when the platform has it
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+def send_to(content, out):
+    """Write what is left of 'content' to 'out', a file descriptor or an
+    object with a fileno() method such as a socket, and return the
+    number of bytes written.
+
+    Cache hits are real files: the kernel copies them with sendfile where
+    it is available, without going through python. Other contents, and
+    destinations sendfile refuses, are copied with _copy.
+    """
+    if isinstance(content, Content):
+        content = content.fp
+    if isinstance(out, (int, long)):
+        out_fd = out
+    else:
+        if hasattr(out, 'flush'):
+            out.flush()
+        out_fd = out.fileno()
+    total = 0
+    if _sendfile is not None and isinstance(content, file):
+        in_fd = content.fileno()
+        offset = content.tell()
+        left = os.fstat(in_fd).st_size - offset
+        try:
+            while left > 0:
+                try:
+                    sent = _sendfile(out_fd, in_fd, offset + total, left)
+                except (OSError, IOError), e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        # A socket with a timeout is non blocking
+                        timeout = getattr(out, 'gettimeout', lambda: None)()
+                        if not _poll([out_fd], True, timeout):
+                            raise socket.timeout("timed out")
+                        continue
+                    if e.errno == errno.EINTR:
+                        continue
+                    if total == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP):
+                        break
+                    raise
+                if sent == 0:
+                    break
+                total += sent
+                left -= sent
+        finally:
+            content.seek(offset + total)
+    if hasattr(out, 'sendall'):
+        write = out.sendall
+    else:
+        write = _fd_writer(out_fd)
+    return total + _copy(content, write)
+
+class Content(object):
+    """The content of a response, whatever it is read from: the network,
+    a cache entry or memory.
+
+    'fp' is the file-like object it wraps, and 'length' the number of
+    bytes left to read when the response started, if it is known. Cache
+    entries are on disk: their fileno() can be used to copy them without
+    reading them, which send_to does once they are complete. Entries
+    still being written by another process, which dcache.FollowedFile
+    reads, have one too, and an in_progress attribute. Other contents
+    raise io.UnsupportedOperation from fileno(), or the OSError
+    or IOError of 'fp'. close() can be called several
+    times, and contents work as context managers. Other attributes are
+    those of 'fp'.
+    """
+    def __init__(self, fp, length=None):
+        self.fp = fp
+        self.length = length
+        self.closed = False
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.fp.read()
+        return self.fp.read(amt)
+
+    def readinto(self, buf):
+        """Read into 'buf', a bytearray or memoryview, and return the
+        number of bytes read, 0 at the end."""
+        readinto = getattr(self.fp, 'readinto', None)
+        if readinto is not None:
+            return readinto(buf)
+        data = self.fp.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def iter_chunks(self, size=None):
+        """Yield what is left to read, 'size' bytes at a time,
+        COPY_CHUNK_SIZE by default."""
+        size = size or COPY_CHUNK_SIZE
+        while True:
+            data = self.fp.read(size)
+            if not data:
+                break
+            yield data
+
+    def fileno(self):
+        fileno = getattr(self.fp, 'fileno', None)
+        if fileno is None:
+            raise io.UnsupportedOperation("fileno: the content is not on disk")
+        return fileno()
+
+    def send_to(self, out):
+        "See send_to"
+        return send_to(self, out)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+def _response_content(response, content, method):
+    """'content' of 'response' to a 'method' request, as a Content."""
+    if isinstance(content, Content):
+        return content
+    length = None
+    if method == "HEAD":
+        length = 0
+    elif response.has_key('content-length'):
+        try:
+            length = int(response['content-length'])
+        except ValueError:
+            pass
+    return Content(content, length)
+
 def _updateCache(request_headers, response_headers, content, cache, cachekey):
     retval = content
     if cachekey:
@@ -417,10 +1401,33 @@ def _updateCache(request_headers, response_headers, content, cache, cachekey):
         if cc.has_key('no-store') or cc_response.has_key('no-store'):
             cache.delete(cachekey)
         else:
+            # A body still encoded is stored as such, and so is a body
+            # being decompressed when the cache stores them compressed.
+            stored_encoding = response_headers.get('content-encoding', None)
+            length = response_headers.get('content-length', None)
+            if (stored_encoding is None and getattr(cache, 'store_compressed', False)
+                and isinstance(content, _DecompressedContent)):
+                compressed = content.compressed()
+                if compressed is not None:
+                    (stored_encoding, content, length) = (content.encoding, compressed, content.length)
+            # Caches in tee mode write the body as the caller reads it.
+            # So do all caches that can for bodies of unknown length,
+            # whose header gets the length once the body ended.
+            tee = hasattr(cache, 'open') and hasattr(content, 'read') and (
+                length is None or getattr(cache, 'tee', False))
+            if length is None and not tee:
+                # Cache entries record the length of their body
+                (content, length) = _spool(content)
+                if stored_encoding is None or response_headers.has_key('content-encoding'):
+                    response_headers['content-length'] = str(length)
             info = email.Message.Message()
             for key, value in response_headers.iteritems():
-                if key not in ['status','content-encoding','transfer-encoding']:
+                if key not in ['status','content-encoding','transfer-encoding','content-length']:
                     info[key] = value
+            if length is not None:
+                info['content-length'] = str(length)
+            if stored_encoding is not None:
+                info[STORED_ENCODING] = stored_encoding
 
             # Add annotations to the cache to indicate what headers
             # are variant for this request.
@@ -444,12 +1451,132 @@ def _updateCache(request_headers, response_headers, content, cache, cachekey):
             for key in info.keys():
                 header_str += key + ": " + info[key] + "\n"
             text = "".join([status_header, header_str])
-            text += "\r\n\r\n"
-
-            retval = cache.set(cachekey, text, content)
+            expires = _entry_expiry(response_headers)
+
+            if length is None:
+                # The content-length line is written over the padding
+                size = len(text) + cacheformat.LENGTH_RESERVE
+
+                def header(length):
+                    return cacheformat.pack(text + "content-length: %d\n" % length, length, expires, size)
+                retval = _TeeContent(content, cache.open(cachekey, cacheformat.pack(text, 0, expires, size)),
+                                     None, header=header)
+            elif tee:
+                # Bodies that can be asked for again from where they
+                # stopped are kept when their download does.
+                partial = (status == 200 and stored_encoding is None and _range_validator(response_headers) is not None
+                           and response_headers.get('accept-ranges', 'bytes') != 'none')
+                retval = _TeeContent(content, cache.open(cachekey, cacheformat.pack(text, int(length), expires)),
+                                     int(length), partial)
+            else:
+                retval = cache.set(cachekey, cacheformat.pack(text, int(length), expires), content)
+            if stored_encoding is not None and not response_headers.has_key('content-encoding'):
+                # The caller was reading it decompressed
+                retval = _DecompressedContent(response_headers, retval, stored_encoding)
             
     return retval
 
+def _request_tuple(item):
+    """Expand a URI, or a tuple (uri, method, body, headers) whose trailing
+    items can be left out, into a complete (uri, method, body, headers)."""
+    if isinstance(item, basestring):
+        item = (item,)
+    return tuple(item) + (None, "GET", None, None)[len(item):]
+
+def _request_target(uri):
+    """The (uri, scheme, authority, request_uri, defrag_uri) a request
+    for 'uri' goes to: http URIs of port 443 go to https."""
+    uri = iri2uri(uri)
+    (scheme, authority, request_uri, defrag_uri) = urlnorm(uri)
+    domain_port = authority.split(":")[0:2]
+    if len(domain_port) == 2 and domain_port[1] == '443' and scheme == 'http':
+        scheme = 'https'
+        authority = domain_port[0]
+    return (uri, scheme, authority, request_uri, defrag_uri)
+
+class _StreamingBody(object):
+    """A request body read from a file-like object or an iterable, and
+    sent as it is read, with chunked transfer encoding when 'length' is
+    None.
+
+    Sending it again, to retry a request, authenticate or follow a
+    redirect, rewinds file-like objects that tell where they started,
+    and lists and tuples. Other bodies can only be sent once, and raise
+    NonRewindableBodyError.
+    """
+    def __init__(self, source, length):
+        self.source = source
+        self.length = length
+        self.start = None
+        if hasattr(source, 'read'):
+            try:
+                self.start = source.tell()
+            except (AttributeError, IOError, OSError):
+                pass
+        elif isinstance(source, (list, tuple)):
+            self.start = 0
+        self.sent = False
+
+    def chunks(self):
+        if self.sent:
+            if self.start is None:
+                raise NonRewindableBodyError(_("The request body can't be sent again: it can't be rewound."))
+            if hasattr(self.source, 'seek'):
+                self.source.seek(self.start)
+        self.sent = True
+        if hasattr(self.source, 'read'):
+            while True:
+                data = self.source.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+        else:
+            for data in self.source:
+                if data:
+                    yield data
+
+def _streaming_body(body, headers):
+    """Wrap a file-like or iterable request 'body' in a _StreamingBody,
+    and set the content-length or transfer-encoding header it needs."""
+    if body is None or isinstance(body, (basestring, _StreamingBody)):
+        return body
+    length = None
+    if headers.has_key('content-length'):
+        length = int(headers['content-length'])
+    elif not headers.has_key('transfer-encoding') and hasattr(body, 'read'):
+        # What is left of a regular file
+        try:
+            st = os.fstat(body.fileno())
+            if stat.S_ISREG(st.st_mode):
+                length = st.st_size - body.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    if length is None:
+        headers['transfer-encoding'] = 'chunked'
+    else:
+        headers['content-length'] = str(length)
+    return _StreamingBody(body, length)
+
+def _send_streaming(conn, method, request_uri, body, headers):
+    """Same as conn.request, for a _StreamingBody."""
+    skips = {}
+    if 'host' in headers:
+        skips['skip_host'] = 1
+    if 'accept-encoding' in headers:
+        skips['skip_accept_encoding'] = 1
+    conn.putrequest(method, request_uri, **skips)
+    for (key, value) in headers.iteritems():
+        conn.putheader(key, value)
+    conn.endheaders()
+    for data in body.chunks():
+        if body.length is None:
+            # One send, and one packet with TCP_NODELAY, per chunk
+            conn.send("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            conn.send(data)
+    if body.length is None:
+        conn.send("0\r\n\r\n")
+
 def _cnonce():
     dig = _md5("%s:%s" % (time.ctime(), ["0123456789"[random.randrange(0, 9)] for i in range(20)])).hexdigest()
     return dig[:16]
@@ -698,12 +1825,47 @@ class FileCache(object):
     """Uses a local directory as a store for cached files.
     Not really safe to use if multiple threads or processes are going to
     be running on the same cache.
+
+    With 'store_compressed', compressed responses are stored as they
+    were sent and decompressed when read back. Bodies are written
+    'chunk_size' bytes at a time, COPY_CHUNK_SIZE by default. With
+    'tee', responses are returned right away, and written to the cache
+    as they are read, which is how bodies of unknown length are always
+    written. With 'index', entries are recorded in a
+    cacheindex.CacheIndex as they are written, read and deleted, its
+    index attribute.
+
+    'max_size' and 'max_entries' limit the total size of the entries, in
+    bytes, and their number. Entries are evicted when a new one goes
+    over them, least recently used first, or least frequently used with
+    'eviction' set to 'lfu'. Limits need the index, and only apply to
+    the entries written since it is kept.
+
+    Interrupted downloads are only resumed with 'tee': the partial
+    entries they resume from are what tee mode keeps of a body that
+    ended early (see resume).
     """
-    def __init__(self, cache, safe=safename): # use safe=lambda x: md5.new(x).hexdigest() for the old behavior
+    def __init__(self, cache, safe=safename, store_compressed=False, chunk_size=None, tee=False, index=False,
+                 max_size=None, max_entries=None, eviction='lru'): # use safe=lambda x: md5.new(x).hexdigest() for the old behavior
         self.cache = cache
         self.safe = safe
+        self.store_compressed = store_compressed
+        self.chunk_size = chunk_size
+        self.tee = tee
         if not os.path.exists(cache):
             os.makedirs(self.cache)
+        self._limits(max_size, max_entries, eviction)
+        self.index = None
+        if index or self.limited:
+            self.index = cacheindex.CacheIndex(cache)
+
+    def _limits(self, max_size, max_entries, eviction):
+        if eviction not in cacheindex.EVICTION_ORDERS:
+            raise ValueError("Unknown eviction policy %r" % (eviction,))
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.limited = max_size is not None or max_entries is not None
 
     def get(self, key):
         retval = None
@@ -712,27 +1874,188 @@ class FileCache(object):
             retval = file(cacheFullPath, "rb")
         except IOError:
             pass
+        if retval is not None and self.index is not None:
+            self.index.hit(key)
         return retval
 
     def set(self, key, header, content):
         cacheFullPath = os.path.join(self.cache, self.safe(key))
-        f = file(cacheFullPath, "wb")
-        f.write(header)
-        while True:
-            c = content.read(8192)
-            if len(c) == 0 or c == None:
-                break
-            f.write(c)
-            
-        f.close()
-        f = open(cacheFullPath)
-        f.read(len(header))
+        # Written aside and renamed, so that readers in other threads never
+        # see it partly written, and reopened before it can be replaced
+        writer = _FileCacheWriter(cacheFullPath, header)
+        try:
+            _copy(content, writer.write, self.chunk_size)
+            writer.fp.flush()
+            f = file(writer.tmp, "rb")
+        except:
+            writer.abort()
+            raise
+        try:
+            writer.commit()
+        except:
+            f.close()
+            raise
+        self._indexed(key, cacheFullPath, header)
+        f.seek(len(header))
         return f
 
+    def open(self, key, header):
+        """Start writing the entry for 'key': return a writer whose write
+        method appends to its body, commit makes it the entry and abort
+        drops it."""
+        path = os.path.join(self.cache, self.safe(key))
+        return _FileCacheWriter(path, header, lambda header: self._indexed(key, path, header))
+
+    def resume(self, key, cached_value, length=None):
+        """Return a writer appending to the partial entry for 'key', read
+        through 'cached_value' when it was 'length' bytes long, or None
+        if someone else is appending to it, or it changed since.
+
+        The entry is exclusively locked, where fcntl is available, until
+        the writer commits, or aborts, which truncates it back to its
+        length. Partial entries are only written in tee mode.
+        """
+        path = os.path.join(self.cache, self.safe(key))
+        try:
+            # Not created again if it is gone
+            fp = os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND), "ab")
+        except OSError:
+            return None
+        try:
+            if cacheformat.fcntl is not None:
+                cacheformat.fcntl.flock(fp.fileno(), cacheformat.fcntl.LOCK_EX | cacheformat.fcntl.LOCK_NB)
+            st = os.fstat(fp.fileno())
+        except IOError, e:
+            fp.close()
+            if e.errno == errno.EWOULDBLOCK:
+                return None
+            raise
+        if (st.st_ino != os.fstat(cached_value.fileno()).st_ino
+            or (length is not None and st.st_size != length)):
+            # Replaced, or appended to, meanwhile
+            fp.close()
+            return None
+        return _FileCacheAppender(fp, st.st_size, lambda: self._indexed(key, path))
+
     def delete(self, key):
         cacheFullPath = os.path.join(self.cache, self.safe(key))
         if os.path.exists(cacheFullPath):
             os.remove(cacheFullPath)
+        if self.index is not None:
+            self.index.remove(key)
+
+    def _indexed(self, key, path, header=None):
+        if self.index is not None:
+            try:
+                self.index.record(key, path, header)
+                self.evict(key)
+            except Exception:
+                # The entry is there all the same
+                report_error("Error while indexing cache file %s." % path)
+
+    def _over(self, size, entries, part=1.0):
+        return ((self.max_size is not None and size > self.max_size * part)
+                or (self.max_entries is not None and entries > self.max_entries * part))
+
+    def evict(self, keep=None):
+        """If the cache is over its limits, evict entries until it is back
+        under cacheindex.EVICTION_TARGET of them. Entries that can't be
+        removed are skipped, and so is the entry for 'keep', just written.
+        Returns how many entries were evicted."""
+        if not self.limited or self.index is None:
+            return 0
+        totals = self.index.totals()
+        (size, entries) = (totals['size'], totals['entries'])
+        if not self._over(size, entries):
+            return 0
+        evicted = 0
+        skipped = 0
+        while self._over(size, entries, cacheindex.EVICTION_TARGET):
+            victims = self.index.victims(self.eviction, offset=skipped)
+            if not victims:
+                break
+            for entry in victims:
+                if not self._over(size, entries, cacheindex.EVICTION_TARGET):
+                    break
+                if entry['key'] != keep and self._evict_entry(entry):
+                    self.index.remove(entry['key'])
+                    size -= entry['size']
+                    entries -= 1
+                    evicted += 1
+                else:
+                    skipped += 1
+        return evicted
+
+    def _evict_entry(self, entry):
+        "Remove the file of an index entry, returns whether it is gone"
+        try:
+            os.remove(os.path.join(self.cache, entry['path']))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                return False
+        return True
+
+class _FileCacheWriter(object):
+    """Writes a FileCache entry to a temporary file, renamed to 'path'
+    once complete, so that it is never read partly written. 'committed'
+    is called once it is, with the header it was last written with."""
+    def __init__(self, path, header, committed=None):
+        self.path = path
+        self.header = header
+        self.committed = committed
+        (fd, self.tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        self.fp = os.fdopen(fd, "wb")
+        self.fp.write(header)
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def rewrite(self, header):
+        "Write 'header' over the header of the entry, of the same size"
+        self.fp.seek(0)
+        self.fp.write(header)
+        self.fp.seek(0, os.SEEK_END)
+        self.header = header
+
+    def commit(self):
+        self.fp.close()
+        try:
+            os.rename(self.tmp, self.path)
+        except OSError:
+            # Windows does not replace files
+            os.remove(self.path)
+            os.rename(self.tmp, self.path)
+        if self.committed is not None:
+            self.committed(self.header)
+
+    def abort(self):
+        self.fp.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+class _FileCacheAppender(object):
+    """Appends to the locked FileCache entry 'fp', 'length' bytes long,
+    see FileCache.resume. 'committed' is called once it commits."""
+    def __init__(self, fp, length, committed=None):
+        self.fp = fp
+        self.length = length
+        self.committed = committed
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def commit(self):
+        self.fp.close()
+        if self.committed is not None:
+            self.committed()
+
+    def abort(self):
+        "Drop what was appended"
+        self.fp.flush()
+        os.ftruncate(self.fp.fileno(), self.length)
+        self.fp.close()
 
 class Credentials(object):
     def __init__(self):
@@ -794,17 +2117,17 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
         if self.proxy_info and socks is None:
             raise ProxiesUnavailableError(
                 'Proxy support missing but proxy use was requested!')
+        if not (self.proxy_info and self.proxy_info.isgood()):
+            self.sock = _create_connection(self.host, self.port, self.timeout)
+            if self.debuglevel > 0:
+                report_error("connect: (%s, %s)" % (self.host, self.port))
+            return
         msg = "getaddrinfo returns an empty list"
-        for res in socket.getaddrinfo(self.host, self.port, SOCKET_FAMILY,
-            socket.SOCK_STREAM, **SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS):
+        for res in _getaddrinfo(self.host, self.port):
             af, socktype, proto, canonname, sa = res
             try:
-                if self.proxy_info and self.proxy_info.isgood():
-                    self.sock = socks.socksocket(af, socktype, proto)
-                    self.sock.setproxy(*self.proxy_info.astuple())
-                else:
-                    self.sock = socket.socket(af, socktype, proto)
-                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sock = socks.socksocket(af, socktype, proto)
+                self.sock.setproxy(*self.proxy_info.astuple())
                 # Different from httplib: support timeouts.
                 if has_timeout(self.timeout):
                     self.sock.settimeout(self.timeout)
@@ -822,6 +2145,7 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
                 continue
             break
         if not self.sock:
+            _connect_failed(self.host)
             raise socket.error, msg
 
 class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
@@ -901,28 +2225,32 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
         "Connect to a host on a given (SSL) port."
 
         msg = "getaddrinfo returns an empty list"
-        for family, socktype, proto, canonname, sockaddr in socket.getaddrinfo(
-            self.host, self.port, SOCKET_FAMILY, socket.SOCK_STREAM, **SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS):
+        if self.proxy_info and self.proxy_info.isgood():
+            attempts = _getaddrinfo(self.host, self.port)
+        else:
+            # A single attempt, racing the addresses of the host
+            attempts = [None]
+        for res in attempts:
+            sock = None
             try:
-                if self.proxy_info and self.proxy_info.isgood():
+                if res is None:
+                    sock = _create_connection(self.host, self.port, self.timeout)
+                else:
+                    family, socktype, proto, canonname, sockaddr = res
                     sock = socks.socksocket(family, socktype, proto)
                     sock.setproxy(*self.proxy_info.astuple())
-                else:
-                    sock = socket.socket(family, socktype, proto)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-                if has_timeout(self.timeout):
-                    sock.settimeout(self.timeout)
-                sock.connect((self.host, self.port))
+                    if has_timeout(self.timeout):
+                        sock.settimeout(self.timeout)
+                    sock.connect((self.host, self.port))
                 self.sock =_ssl_wrap_socket(
                     sock, self.key_file, self.cert_file,
                     self.disable_ssl_certificate_validation, self.ca_certs)
                 if self.debuglevel > 0:
                     report_error("connect: (%s, %s)" % (self.host, self.port))
                 if not self.disable_ssl_certificate_validation:
-                    cert = self.sock.getpeercert()
                     hostname = self.host.split(':', 0)[0]
-                    if not self._ValidateCertificateHostname(cert, hostname):
+                    if not _check_hostname(self, self.sock, hostname):
+                        cert = self.sock.getpeercert()
                         raise CertificateHostnameMismatch(
                             'Server presented certificate that does not match '
                             'host %s: %s' % (hostname, cert), hostname, cert)
@@ -951,6 +2279,7 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
               continue
             break
         if not self.sock:
+          _connect_failed(self.host)
           raise socket.error, msg
 
 SCHEME_TO_CONNECTION = {
@@ -1052,6 +2381,408 @@ except ImportError:
   pass
 
 
+class ConnectionPool(object):
+    """A thread safe pool of connections, keyed by 'scheme:authority'.
+
+    At most 'maxsize' connections are created for each key (None means
+    no limit). get() checks an idle connection out, creating a new one
+    with the given factory while the key is below its limit, and put()
+    checks it back in.
+
+    When every connection of a key is in use, get() waits for one to be
+    put back if 'block' is true, for at most 'timeout' seconds (None
+    waits forever). Otherwise, or once the timeout expires, PoolFullError
+    is raised.
+
+    Before an idle connection is handed out, its socket is polled without
+    waiting: a socket with something to read has been closed by the
+    server (or is out of step), and is closed so that the connection
+    reconnects. So is a socket idle for more than 'idle_timeout' seconds,
+    or connected for more than 'max_lifetime' seconds. With a
+    'reap_interval', a background thread runs reap() that often, closing
+    such connections before servers drop them.
+    """
+    def __init__(self, maxsize=DEFAULT_POOL_MAXSIZE, block=DEFAULT_POOL_BLOCK, timeout=None,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, max_lifetime=DEFAULT_POOL_MAX_LIFETIME,
+                 reap_interval=None):
+        self.maxsize = maxsize
+        self.block = block
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.reap_interval = reap_interval
+        self.reaper = None
+        self.lock = threading.Condition()
+        # Map key to the idle connections, most recently used last
+        self.idle = {}
+        # Map key to every connection created for it, idle or not
+        self.all = {}
+
+    def get(self, key, factory):
+        """Check out a connection for 'key'."""
+        self.lock.acquire()
+        try:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    if self._stale(conn, time.time()):
+                        conn.close()
+                    conn._pool_checkout = time.time()
+                    return conn
+                conns = self.all.setdefault(key, [])
+                if self.maxsize is None or len(conns) < self.maxsize:
+                    conn = factory()
+                    conns.append(conn)
+                    conn._pool_checkout = time.time()
+                    return conn
+                if not self.block:
+                    raise PoolFullError("All %d connections to %s are in use." % (self.maxsize, key))
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolFullError("Timed out waiting for a free connection to %s." % key)
+                    self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+    def put(self, key, conn):
+        """Check a connection out by get() back in."""
+        self.lock.acquire()
+        try:
+            if conn in self.all.get(key, []):
+                idle = self.idle.setdefault(key, [])
+                if conn not in idle:
+                    sock = getattr(conn, 'sock', None)
+                    if sock is not getattr(conn, '_pool_sock', None):
+                        # Connected while it was checked out
+                        conn._pool_sock = sock
+                        conn._pool_connected = getattr(conn, '_pool_checkout', time.time())
+                    conn._pool_idle_since = time.time()
+                    idle.append(conn)
+                    self.lock.notify()
+                    if self.reap_interval is not None and self.reaper is None:
+                        self.reaper = threading.Thread(target=_reap_pool,
+                                args=(weakref.ref(self), self.reap_interval))
+                        self.reaper.setDaemon(True)
+                        self.reaper.start()
+        finally:
+            self.lock.release()
+
+    def reap(self):
+        """Close and forget the idle connections that get() would have
+        to close."""
+        stale = []
+        self.lock.acquire()
+        try:
+            now = time.time()
+            for key, idle in self.idle.items():
+                for conn in idle[:]:
+                    if self._stale(conn, now):
+                        idle.remove(conn)
+                        self.all[key].remove(conn)
+                        stale.append(conn)
+                if not idle:
+                    del self.idle[key]
+                if not self.all[key]:
+                    del self.all[key]
+            if stale:
+                self.lock.notifyAll()
+        finally:
+            self.lock.release()
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def _stale(self, conn, now):
+        """Whether the idle 'conn' has to be closed before it is used."""
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        if self.idle_timeout is not None and now - conn._pool_idle_since > self.idle_timeout:
+            return True
+        if self.max_lifetime is not None and now - conn._pool_connected > self.max_lifetime:
+            return True
+        try:
+            if getattr(sock, 'pending', None) and sock.pending():
+                return True
+            readable = _poll([sock], False, 0)
+        except (ValueError, TypeError, select.error, socket.error):
+            return True
+        # An idle connection has nothing to read, but the end of the
+        # stream when the server closed it.
+        return bool(readable)
+
+    def discard(self, key, conn):
+        """Close a checked out connection and forget about it."""
+        self.lock.acquire()
+        try:
+            conns = self.all.get(key, [])
+            if conn in conns:
+                conns.remove(conn)
+                self.lock.notify()
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def clear(self):
+        """Close the idle connections and forget every connection."""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+            self.all = {}
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    # A little of the dictionary interface, since self.connections
+    # used to map each key to its single connection.
+    def __contains__(self, key):
+        return bool(self.all.get(key))
+
+    def __getitem__(self, key):
+        """Return the most recently used idle connection for 'key',
+        or any connection of 'key' when none is idle."""
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key) or self.all.get(key)
+            if not conns:
+                raise KeyError(key)
+            return conns[-1]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [key for key, conns in self.all.items() if conns]
+
+    def values(self):
+        self.lock.acquire()
+        try:
+            return [conn for conns in self.all.values() for conn in conns]
+        finally:
+            self.lock.release()
+
+
+def _reap_pool(pool_ref, interval):
+    """Body of the reaper thread of a ConnectionPool, which ends
+    once the pool is gone."""
+    while True:
+        time.sleep(interval)
+        pool = pool_ref()
+        if pool is None:
+            return
+        try:
+            pool.reap()
+        except Exception:
+            report_error("Reaping pooled connections failed")
+        del pool
+
+
+class _ConnectionLease(object):
+    """One checkout of a connection from a ConnectionPool.
+
+    The connection goes back to the pool once the request is over,
+    which release() signals, and the body streaming from it, if any,
+    has been read to the end or closed. release() only counts the
+    first time it is called, so the connection can be released early
+    (before following a redirect) and again once the request is over.
+
+    A body dropped without being closed is noticed through a weak
+    reference, and its connection closed before being put back.
+    """
+    def __init__(self, pool, key, conn):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.lock = threading.RLock()
+        # Weak reference to the body reading from the connection
+        self.body = None
+        self.done = False
+        self.released = False
+
+    def attach(self, body):
+        """Make 'body' the one holding the connection."""
+        self.lock.acquire()
+        try:
+            self.reclaim()
+            self.body = weakref.ref(body, self._lost)
+        finally:
+            self.lock.release()
+
+    def reclaim(self):
+        """Close the body holding the connection, so that it can be used
+        for another request."""
+        self.lock.acquire()
+        try:
+            body = self.body and self.body()
+            if body is not None:
+                body.close()
+        finally:
+            self.lock.release()
+
+    def detach(self, reusable):
+        """Called by the body once it is done with the connection."""
+        self.lock.acquire()
+        try:
+            if not reusable:
+                self.conn.close()
+            self.body = None
+            self._checkin()
+        finally:
+            self.lock.release()
+
+    def _lost(self, ref):
+        self.lock.acquire()
+        try:
+            if self.body is ref:
+                self.detach(False)
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        try:
+            self.done = True
+            self._checkin()
+        finally:
+            self.lock.release()
+
+    def _checkin(self):
+        if self.done and self.body is None and not self.released:
+            self.released = True
+            self.pool.put(self.key, self.conn)
+
+
+class _LeasedResponse(object):
+    """File-like wrapper around an httplib.HTTPResponse that hands its
+    connection back to the pool once the body has been read to the end.
+
+    Closing it early drains what is left of the body when that is at most
+    MAX_DRAIN_SIZE bytes, so the connection can be reused; otherwise the
+    connection is closed.
+    """
+    def __init__(self, response, lease):
+        self.response = response
+        self.lease = lease
+        self.finished = False
+        lease.attach(self)
+
+    def read(self, amt=None):
+        if self.finished:
+            return ""
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except:
+            self._finish(False)
+            raise
+        if self.response.isclosed():
+            self._finish(True)
+        return data
+
+    def close(self):
+        if self.finished:
+            return
+        remaining = self.response.length
+        if remaining is not None and remaining > MAX_DRAIN_SIZE:
+            self._finish(False)
+            return
+        try:
+            drained = 0
+            while drained <= MAX_DRAIN_SIZE and not self.response.isclosed():
+                data = self.response.read(8192)
+                if not data:
+                    break
+                drained += len(data)
+        except (socket.error, httplib.HTTPException):
+            self._finish(False)
+            return
+        self._finish(self.response.isclosed())
+
+    def _finish(self, reusable):
+        self.finished = True
+        self.response.close()
+        self.lease.detach(reusable)
+
+    def fileno(self):
+        # What the response buffered is not read from its socket again
+        raise io.UnsupportedOperation("fileno: the content is read from a connection")
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class _PipelinedResponse(object):
+    """File-like wrapper around an httplib.HTTPResponse read off a pipelined
+    connection, ahead of the responses to later requests.
+
+    Before the next response can be read from the connection, spool()
+    buffers what is left of this body in memory. Closing it reads and
+    discards the rest of the body, for the same reason.
+    """
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.response.read()
+        return self.response.read(amt)
+
+    def spool(self):
+        if isinstance(self.response, httplib.HTTPResponse):
+            response = self.response
+            self.response = StringIO.StringIO(response.read())
+            response.close()
+
+    def close(self):
+        self.spool()
+        self.response = StringIO.StringIO("")
+
+    def fileno(self):
+        raise io.UnsupportedOperation("fileno: the content is read from a connection")
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class _PipelinedRequest(object):
+    """One request of Http.pipeline, and what its cache lookup found."""
+    def __init__(self, uri, method, body, headers):
+        self.uri = uri
+        self.method = method
+        self.body = body
+        self.headers = headers
+        # The scheme:authority of the connection, None when the
+        # request can't be pipelined
+        self.key = None
+        self.looked_up = False
+        # Set when request() has to handle it
+        self.direct = False
+        # The (response, content) found in the cache, if fresh
+        self.result = None
+        self.info = email.Message.Message()
+        self.cached_value = None
+        self.cachekey = None
+        self.attempts = 0
+
+    def pipelined(self):
+        return self.key is not None and not self.direct and self.result is None
+
+
 class Http(object):
     """An HTTP client that handles:
 - all methods
@@ -1091,8 +2822,8 @@ and more.
         self.disable_ssl_certificate_validation = \
                 disable_ssl_certificate_validation
 
-        # Map domain name to an httplib connection
-        self.connections = {}
+        # Map domain name to a pool of httplib connections
+        self.connections = ConnectionPool()
         # The location of the cache, for now a directory
         # where cached responses are held.
         if cache and isinstance(cache, basestring):
@@ -1124,6 +2855,10 @@ and more.
 
         self.force_exception_to_status_code = False
 
+        # If set to False, compressed bodies are returned as they were
+        # sent, with their content-encoding header.
+        self.decompress_content = True
+
         self.timeout = timeout
 
     def _auth_from_challenge(self, host, request_uri, headers, response, content):
@@ -1152,13 +2887,25 @@ and more.
         self.credentials.clear()
         self.authorizations = []
 
-    def _conn_request(self, conn, request_uri, method, body, headers):
+    def _conn_request(self, conn, request_uri, method, body, headers, lease=None):
+        """Send the request on 'conn' and return the response. When 'lease'
+        is given, the content streams from the connection and holds it
+        until it is read to the end or closed."""
+        if lease is not None:
+            # The previous body must be out of the way
+            lease.reclaim()
         for i in range(2):
             try:
                 if conn.sock is None:
                   conn.connect()
                 
-                conn.request(method, request_uri, body, headers)
+                if isinstance(body, _StreamingBody) and hasattr(conn, 'putrequest'):
+                    _send_streaming(conn, method, request_uri, body, headers)
+                elif isinstance(body, _StreamingBody):
+                    # App Engine takes the whole payload at once
+                    conn.request(method, request_uri, "".join(body.chunks()), headers)
+                else:
+                    conn.request(method, request_uri, body, headers)
             except socket.timeout:
                 raise
             except socket.gaierror:
@@ -1201,43 +2948,71 @@ and more.
                     raise
             else:
                 content = StringIO.StringIO("")
-                if method == "HEAD":
+                if method == "HEAD" or getattr(response, 'length', None) == 0:
                     response.close()
+                elif lease is not None and isinstance(response, httplib.HTTPResponse):
+                    content = _LeasedResponse(response, lease)
                 else:
                     content = response
                 response = Response(response)
-                if method != "HEAD":
+                if method != "HEAD" and self.decompress_content:
                     content = _decompressContent(response, content)
             break
         return (response, content)
 
 
-    def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey):
+    def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey, lease=None):
         """Do the actual request using the connection object
-        and also follow one level of redirects if necessary"""
+        and also follow one level of redirects if necessary.
+        'lease' is the checkout of 'conn' from the connection pool."""
 
         auths = [(auth.depth(request_uri), auth) for auth in self.authorizations if auth.inscope(host, request_uri)]
         auth = auths and sorted(auths)[0][1] or None
         if auth:
             auth.request(method, request_uri, headers, body)
 
-        (response, content) = self._conn_request(conn, request_uri, method, body, headers)
+        (response, content) = self._conn_request(conn, request_uri, method, body, headers, lease)
 
         if auth:
             if auth.response(response, body):
                 auth.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers )
+                (response, content) = self._conn_request(conn, request_uri, method, body, headers, lease)
                 response._stale_digest = 1
 
         if response.status == 401:
             for authorization in self._auth_from_challenge(host, request_uri, headers, response, content):
                 authorization.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers, )
+                (response, content) = self._conn_request(conn, request_uri, method, body, headers, lease)
                 if response.status != 401:
                     self.authorizations.append(authorization)
                     authorization.response(response, body)
                     break
 
+        return self._follow_response(absolute_uri, method, body, headers, redirections, cachekey, response, content, lease)
+
+    def _follow_response(self, absolute_uri, method, body, headers, redirections, cachekey, response, content, lease=None):
+        """Follow a redirect response, or store a cacheable one."""
+        (response, content, redirect) = self._response_redirect(absolute_uri, method, body, headers,
+                redirections, cachekey, response, content)
+        if redirect is not None:
+            (location, redirect_method, body, old_response) = redirect
+            if lease is not None:
+                # Don't hold on to the connection while following the redirect
+                lease.reclaim()
+                lease.release()
+            (response, content) = self.request(location, redirect_method, body=body, headers = headers, redirections = redirections - 1)
+            response.previous = old_response
+        return (response, content)
+
+    def _response_redirect(self, absolute_uri, method, body, headers, redirections, cachekey, response, content):
+        """Store a cacheable response, and tell where a redirect leads.
+
+        Returns (response, content, redirect): 'redirect' is None, or the
+        (location, method, body, previous) of the request to follow the
+        redirect with, 'previous' to be set on its response. 'headers'
+        are made ready for that request.
+        """
+        redirect = None
         if (self.follow_all_redirects or (method in ["GET", "HEAD"]) or response.status == 303):
             if self.follow_redirects and response.status in [300, 301, 302, 303, 307]:
                 # Pick out the location header and basically start from the beginning
@@ -1260,6 +3035,10 @@ and more.
                         if not response.has_key('content-location'):
                             response['content-location'] = absolute_uri
                         content = _updateCache(headers, response, content, self.cache, cachekey)
+                    if self.cache and response.status in [301, 302] and method in ["GET", "HEAD"]:
+                        # Nobody reads the body of the redirect, which
+                        # caches may be writing as it is read
+                        _copy(content, lambda data: None)
 
                     if headers.has_key('if-none-match'):
                         del headers['if-none-match']
@@ -1274,8 +3053,10 @@ and more.
                         if response.status in [302, 303]:
                             redirect_method = "GET"
                             body = None
-                        (response, content) = self.request(location, redirect_method, body=body, headers = headers, redirections = redirections - 1)
-                        response.previous = old_response
+                            for key in ['content-length', 'transfer-encoding']:
+                                if headers.has_key(key):
+                                    del headers[key]
+                        redirect = (location, redirect_method, body, old_response)
                 else:
                     raise RedirectLimit("Redirected more times than rediection_limit allows.", response, content)
             elif response.status in [200, 203] and method in ["GET", "HEAD"]:
@@ -1284,34 +3065,620 @@ and more.
                     response['content-location'] = absolute_uri
                 content = _updateCache(headers, response, content, self.cache, cachekey)
 
+        return (response, content, redirect)
+
+    def _resume(self, conn, host, absolute_uri, request_uri, headers, redirections, cachekey, lease, info, cached_value):
+        """Ask for the rest of the body of the partial cache entry 'info',
+        'cached_value' at hand, if it didn't change, and append it to the
+        entry as it is read. Returns (response, content), or None when the
+        request has to be made again without the entry."""
+        have = int(info[PARTIAL_ENTRY])
+        total = int(info['content-length'])
+        resume_headers = dict(headers)
+        resume_headers['range'] = 'bytes=%d-' % have
+        resume_headers['if-range'] = _range_validator(info)
+        # Partial entries hold the body as it is, not encoded
+        resume_headers['accept-encoding'] = 'identity'
+        (response, new_content) = self._request(conn, host, absolute_uri, request_uri, "GET", None,
+                resume_headers, redirections, cachekey, lease)
+        if response.status != 206:
+            # The entry changed: this is the new one, cached as usual
+            cached_value.close()
+            return (response, new_content)
+        if (response.get('content-range', None) != 'bytes %d-%d/%d' % (have, total - 1, total)
+            or 'content-encoding' in response or '-content-encoding' in response):
+            new_content.close()
+            return None
+        writer = None
+        if hasattr(self.cache, 'resume'):
+            # Not read yet, 'cached_value' is at the end of the header
+            writer = self.cache.resume(cachekey, cached_value, cached_value.tell() + have)
+        if writer is not None:
+            new_content = _TeeContent(new_content, writer, total - have, True)
+        del info[PARTIAL_ENTRY]
+        response = Response(info)
+        return (response, _ResumedContent(cached_value, have, new_content))
+
+    def _revalidated(self, info, cached_value, cachekey, method, response, new_content):
+        """Merge the response to a request made with the cache entry
+        'info', 'cached_value' at hand, and return (response, content)."""
+        if response.status == 304 and method == "GET":
+            # Rewrite the cache entry with the new end-to-end headers
+            # Take all headers that are in response
+            # and overwrite their values in info.
+            # unless they are hop-by-hop, or are listed in the connection header.
+
+            for key in _get_end2end_headers(response):
+                info[key] = response[key]
+            merged_response = Response(info)
+            if hasattr(response, "_stale_digest"):
+                merged_response._stale_digest = response._stale_digest
+            # TEMPORARY LAGUNAS : DO NOT UPDATE CACHE
+#            _updateCache(headers, merged_response, content, self.cache, cachekey)
+            response = merged_response
+            response.status = 200
+            response.fromcache = True
+            content = cached_value
+        elif response.status == 200:
+            content = new_content
+        else:
+            self.cache.delete(cachekey)
+            content = new_content
         return (response, content)
 
-    def _cache_value_info_read(self, cached_value):
-        read = 0
-        MAX_HEADER_SIZE = 1024 * 1024
-        info = ""
-        while len(info) < MAX_HEADER_SIZE:
-            last_chars = info[-4:]
-            # Small speedup
-            if "\r" not in last_chars and "\n" not in last_chars:
-                add = cached_value.read(4)
-            else:
-                add = cached_value.read(1)
-
-            if len(add) == 0 or add == None:
-                break
-            info += add
-
-            if info[-4:] == "\r\n\r\n":
-                break
+    def _normalize_headers(self, headers):
+        return _normalize_headers(headers)
 
-        if len(info) >= 4:
-            return info[:-4]
+    def _prepare_headers(self, headers):
+        """The normalized 'headers' of a request, None for none, with
+        the user-agent and accept-encoding it sends by default."""
+        if headers is None:
+            headers = {}
+        else:
+            headers = self._normalize_headers(headers)
+        if not headers.has_key('user-agent'):
+            headers['user-agent'] = "Python-httplib2/%s (gzip)" % __version__
+        if 'range' not in headers and 'accept-encoding' not in headers:
+            headers['accept-encoding'] = _accept_encoding()
+        return headers
+
+    def _usable_entry(self, method, headers, info, cached_value, cachekey):
+        """The cache entry 'info', 'cached_value' looked up for a request
+        of 'method' with 'headers', or None when the request can't use it.
+
+        Methods other than GET and HEAD invalidate the entry, and those of
+        optimistic_concurrency_methods send its etag along."""
+        if method in self.optimistic_concurrency_methods and self.cache and info.has_key('etag') and not self.ignore_etag and 'if-match' not in headers:
+            # http://www.w3.org/1999/04/Editing/
+            headers['if-match'] = info['etag']
+
+        if method not in ["GET", "HEAD"] and self.cache and cachekey:
+            # RFC 2616 Section 13.10
+            self.cache.delete(cachekey)
+
+        # Check the vary header in the cache to see if this request
+        # matches what varies in the cache.
+        if method in ['GET', 'HEAD'] and 'vary' in info:
+            vary = info['vary']
+            vary_headers = vary.lower().replace(' ', '').split(',')
+            for header in vary_headers:
+                key = '-varied-%s' % header
+                value = info[key]
+                if headers.get(header, None) != value:
+                    return None
+        return cached_value
+
+    def _cache_answer(self, method, headers, info, cached_value, redirections):
+        """What the cache entry 'info', 'cached_value' answers to a request
+        of 'method' with 'headers', before the request goes to the network.
+
+        Returns ("CACHED", (response, content)) for a fresh entry, or a
+        miss with only-if-cached; ("REDIRECT", url) for a cached redirect
+        to follow; ("FETCH", entry) when the request has to be made, its
+        response to be merged with the stale 'entry' by _revalidated, when
+        it is not None. The validators of a stale entry are added to
+        'headers'.
+        """
+        if cached_value and method in ["GET", "HEAD"] and self.cache and 'range' not in headers:
+            entry_disposition = _entry_disposition(info, headers)
+
+            is_fresh_302 = info['status'] == "302" and entry_disposition == "FRESH"
+
+            is_permanent_redirect = info.has_key('-x-permanent-redirect-url')
+
+            if is_permanent_redirect or is_fresh_302:
+                if is_permanent_redirect:
+                    url = info['-x-permanent-redirect-url']
+
+                if is_fresh_302:
+                    url = info['location']
+
+                # Should cached permanent redirects be counted in our redirection count? For now, yes.
+                if redirections <= 0:
+                  raise RedirectLimit("Redirected more times than rediection_limit allows.", {}, "")
+                return ("REDIRECT", url)
+
+            # Determine our course of action:
+            #   Is the cached entry fresh or stale?
+            #   Has the client requested a non-cached response?
+            #
+            # There seems to be three possible answers:
+            # 1. [FRESH] Return the cache entry w/o doing a GET
+            # 2. [STALE] Do the GET (but add in cache validators if available)
+            # 3. [TRANSPARENT] Do a GET w/o any cache validators (Cache-Control: no-cache) on the request
+
+            if entry_disposition == "FRESH":
+                response = Response(info)
+                response.fromcache = True
+                return ("CACHED", (response, cached_value))
+
+            if entry_disposition == "STALE":
+                if info.has_key('etag') and not self.ignore_etag and not 'if-none-match' in headers:
+                    headers['if-none-match'] = info['etag']
+                if info.has_key('last-modified') and not 'last-modified' in headers:
+                    headers['if-modified-since'] = info['last-modified']
+            elif entry_disposition == "TRANSPARENT":
+                pass
+            return ("FETCH", cached_value)
+
+        cc = _parse_cache_control(headers)
+        if cc.has_key('only-if-cached'):
+            info['status'] = '504'
+            return ("CACHED", (Response(info), StringIO.StringIO("")))
+        return ("FETCH", None)
+
+    def _cache_lookup(self, cachekey, partial=False, wait=True):
+        """Read the cache entry for 'cachekey'.
+
+        Returns (info, cached_value, cachekey): 'info' is an email.Message
+        of the cached headers, 'cached_value' the cache entry positioned at
+        the start of the body, or None if there is no entry. A corrupted
+        entry is deleted and 'cachekey' returned as None, so that the
+        response is not cached either. Partial entries are only returned
+        with 'partial' set, with a PARTIAL_ENTRY header.
+
+        Without 'wait', caches with a get_nowait method are asked through
+        it: an entry being written by someone else is then a miss, and
+        'cachekey' is returned as None so that the response is not
+        cached over it.
+
+        The 'freshness' attribute of the 'info' of complete entries is
+        what _response_freshness returns for it, kept in CACHE_METADATA
+        with the headers so that hits don't parse their dates again.
+        """
+        info = email.Message.Message()
+        get_nowait = getattr(self.cache, 'get_nowait', None)
+        if not wait and get_nowait is not None:
+            try:
+                cached_value = get_nowait(cachekey)
+            except CacheBusyError:
+                return (info, None, None)
+        else:
+            cached_value = self.cache.get(cachekey)
+        if cached_value:
+            # info = email.message_from_string(cached_value)
+            #
+            # Need to replace the line above with the kludge below
+            # to fix the non-existent bug not fixed in this
+            # bug report: http://mail.python.org/pipermail/python-bugs-list/2005-September/030289.html
+            try:
+                st = os.fstat(cached_value.fileno())
+                fileLength = st.st_size
+                in_progress = getattr(cached_value, 'in_progress', False)
+                metadata_key = None
+                metadata = None
+                if CACHE_METADATA is not None and not in_progress:
+                    metadata_key = cacheformat.stat_key(cachekey, st)
+                    metadata = CACHE_METADATA.get(metadata_key)
+                if metadata is not None:
+                    # Complete entries that did not change since they were read
+                    (header_size, headers, totalLength, freshness) = metadata
+                    cached_value.seek(header_size)
+                else:
+                    header = cacheformat.read_header(cached_value)
+                    (header_size, headers) = (header.size, cacheformat.parse(header.text))
+
+                msg = email.Message.Message()
+                for key, value in headers:
+                    msg[key] = value
+
+                if metadata is None:
+                    body_length = header.body_length
+                    if body_length is None:
+                        body_length = int(msg['content-length'])
+                    totalLength = header_size + body_length
+                if in_progress:
+                    # Files still being written (see dcache.FollowedFile) are checked once complete
+                    cached_value.expected_size = totalLength
+                elif (totalLength > fileLength and msg['status'] == '200' and msg[STORED_ENCODING] is None
+                      and _range_validator(msg) is not None):
+                    if not partial:
+                        cached_value.close()
+                        return (email.Message.Message(), None, cachekey)
+                    msg[PARTIAL_ENTRY] = str(fileLength - header_size)
+                elif totalLength != fileLength:
+                    error = "Invalid cache file %s : length should be %s, got %s" % (cachekey, totalLength, fileLength)
+                    report_error(error)
+                    raise Exception(error)
+                elif metadata_key is not None:
+                    if metadata is None:
+                        freshness = _response_freshness(msg)
+                        CACHE_METADATA.set(metadata_key, (header_size, headers, totalLength, freshness))
+                    msg.freshness = freshness
+                info = msg
+                encoding = info[STORED_ENCODING]
+                if encoding is not None:
+                    if _decodable(encoding) and self.decompress_content:
+                        cached_value = _DecompressedContent(Response(info), cached_value, encoding)
+                        del info['content-length']
+                        info['-content-encoding'] = encoding
+                    else:
+                        info['content-encoding'] = encoding
+            except Exception, e:
+                self.cache.delete(cachekey)
+                cachekey = None
+                cached_value = None
+        return (info, cached_value, cachekey)
+
+    def fetch_all(self, requests, workers=DEFAULT_FETCH_WORKERS, per_host=DEFAULT_FETCH_PER_HOST):
+        """Perform many requests at once, on 'workers' threads, with at most
+        'per_host' of them in progress for any one scheme:authority.
+
+        Each item of 'requests' is a URI, or a tuple of the 'uri', 'method',
+        'body' and 'headers' arguments of request() whose trailing items can
+        be left out. Yields a (uri, response, content) tuple for each of them
+        as they complete, in any order. The threads share the connections
+        and the cache of this object.
+
+        A content streaming from the network holds its connection until it
+        is read or closed, so read or close each content before asking for
+        more results than self.connections allows per host.
+        """
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                (key, (uri, method, body, headers)) = task
+                try:
+                    (response, content) = self.request(uri, method, body, headers)
+                    results.put((key, (uri, response, content), None))
+                except:
+                    results.put((key, None, sys.exc_info()))
+
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=work)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        # Requests not handed to the threads yet, per scheme:authority
+        pending = {}
+        pending_count = 0
+        # Requests in progress, per scheme:authority
+        active = {}
+        active_count = 0
+        requests = iter(requests)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and pending_count < workers * 4:
+                    try:
+                        item = _request_tuple(requests.next())
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        (scheme, authority, request_uri, defrag_uri) = urlnorm(iri2uri(item[0]))
+                        key = scheme + ":" + authority
+                    except Exception:
+                        # request() will raise the appropriate error
+                        key = None
+                    pending.setdefault(key, []).append(item)
+                    pending_count += 1
+                for key, items in pending.items():
+                    while items and (key is None or active.get(key, 0) < per_host):
+                        tasks.put((key, items.pop(0)))
+                        active[key] = active.get(key, 0) + 1
+                        active_count += 1
+                        pending_count -= 1
+                    if not items:
+                        del pending[key]
+                if not active_count:
+                    break
+                (key, result, exc_info) = results.get()
+                active[key] -= 1
+                active_count -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield result
+        finally:
+            for thread in threads:
+                tasks.put(None)
+
+    def pipeline(self, requests, depth=DEFAULT_PIPELINE_DEPTH):
+        """Perform GET and HEAD requests using HTTP/1.1 pipelining.
+
+        Each item of 'requests' is a URI, or a tuple like in fetch_all().
+        Consecutive requests to the same scheme:authority are written
+        back-to-back on one connection, up to 'depth' of them, and their
+        responses read in order. Yields a (uri, response, content) tuple
+        for each request, in the order of 'requests'.
+
+        Going on to the next result buffers what is left unread of the
+        previous content when a response follows it on the connection.
+        Requests left unanswered when the server closes the connection
+        are sent again, and later connections to that server carry no
+        more requests than it answered. Fresh cache entries are returned
+        without touching the network, stale ones revalidated, and
+        responses cached as request() does. Other methods, redirects to
+        follow from the cache and authentication challenges go through
+        request().
+        """
+        requests = iter(requests)
+        waiting = []
+        # How many requests a scheme:authority answers on one connection
+        depths = {}
+        while True:
+            if not waiting:
+                try:
+                    waiting.append(self._pipeline_parse(requests.next()))
+                except StopIteration:
+                    return
+            first = waiting.pop(0)
+            if first.key is not None and not first.looked_up:
+                self._pipeline_lookup(first)
+            if not first.pipelined():
+                yield self._pipeline_direct(first)
+                continue
+            run = [first]
+            # The cache entry of a request can't be looked up again before
+            # the response to it is stored: that would wait on itself.
+            cachekeys = set([first.defrag_uri])
+            while len(run) < depths.get(first.key, depth):
+                if not waiting:
+                    try:
+                        waiting.append(self._pipeline_parse(requests.next()))
+                    except StopIteration:
+                        break
+                request = waiting[0]
+                if request.key != first.key or request.defrag_uri in cachekeys:
+                    break
+                if not request.looked_up:
+                    self._pipeline_lookup(request)
+                if not request.pipelined():
+                    break
+                run.append(waiting.pop(0))
+                cachekeys.add(request.defrag_uri)
+            for result in self._pipeline_run(run, waiting, depths):
+                yield result
+
+    def _pipeline_parse(self, item):
+        """Turn 'item' of pipeline() into a _PipelinedRequest."""
+        (uri, method, body, headers) = _request_tuple(item)
+        request = _PipelinedRequest(uri, method, body, self._prepare_headers(headers))
+        if method not in ["GET", "HEAD"] or body is not None:
+            return request
+        try:
+            (absolute_uri, scheme, authority, request_uri, defrag_uri) = _request_target(uri)
+        except HttpLib2Error:
+            # request() will raise it
+            return request
+        if not issubclass(SCHEME_TO_CONNECTION[scheme], httplib.HTTPConnection):
+            return request
+        request.key = scheme + ":" + authority
+        request.scheme = scheme
+        request.authority = authority
+        request.absolute_uri = absolute_uri
+        request.request_uri = request_uri
+        request.defrag_uri = defrag_uri
+        return request
+
+    def _pipeline_lookup(self, request):
+        """The cache side of request(), for a request of pipeline()."""
+        request.looked_up = True
+        info = email.Message.Message()
+        cached_value = None
+        if self.cache:
+            (info, cached_value, request.cachekey) = self._cache_lookup(request.defrag_uri)
+        request.info = info
+        cached_value = self._usable_entry(request.method, request.headers, info, cached_value, request.cachekey)
+        (answer, value) = self._cache_answer(request.method, request.headers, info, cached_value,
+                DEFAULT_MAX_REDIRECTS)
+        if answer == "REDIRECT":
+            # request() follows it
+            cached_value.close()
+            request.direct = True
+        elif answer == "CACHED":
+            request.result = value
+        else:
+            request.cached_value = value
+
+    def _pipeline_direct(self, request):
+        """The result of a request of pipeline() that isn't pipelined."""
+        if request.result is not None:
+            (response, content) = request.result
+            return (request.uri, response, _response_content(response, content, request.method))
+        return (request.uri,) + self.request(request.uri, request.method, request.body, request.headers)
+
+    def _pipeline_fail(self, request, e):
+        """The result of a request of pipeline() that failed with 'e'."""
+        if not self.force_exception_to_status_code:
+            raise e
+        (response, content) = self._exception_response(e)
+        return (request.uri, response, _response_content(response, content, request.method))
+
+    def _pipeline_text(self, conn, request):
+        """The text of 'request', to be written to 'conn'."""
+        headers = request.headers
+        auths = [(auth.depth(request.request_uri), auth) for auth in self.authorizations if auth.inscope(request.authority, request.request_uri)]
+        auth = auths and sorted(auths)[0][1] or None
+        if auth:
+            auth.request(request.method, request.request_uri, headers, None)
+        host = conn.host
+        if ':' in host:
+            host = '[%s]' % host
+        if conn.port != conn.default_port:
+            host = '%s:%s' % (host, conn.port)
+        lines = ["%s %s HTTP/1.1" % (request.method, request.request_uri)]
+        if 'host' not in headers:
+            lines.append("Host: %s" % host)
+        if 'accept-encoding' not in headers:
+            lines.append("Accept-Encoding: identity")
+        for (key, value) in headers.iteritems():
+            lines.append("%s: %s" % (key, value))
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def _pipeline_run(self, run, waiting, depths):
+        """Write the requests of 'run' on one connection, and yield their
+        results. Unanswered requests are put back in front of 'waiting'."""
+        first = run[0]
+        conn = self.connections.get(first.key,
+                lambda: self._new_connection(SCHEME_TO_CONNECTION[first.scheme], first.authority))
+        lease = _ConnectionLease(self.connections, first.key, conn)
+        answered = 0
+        finished = False
+        try:
+            reused = conn.sock is not None
+            try:
+                if not reused:
+                    conn.connect()
+                conn.sock.sendall("".join([self._pipeline_text(conn, request) for request in run]))
+            except socket.gaierror:
+                conn.close()
+                finished = True
+                waiting[0:0] = run[1:]
+                yield self._pipeline_fail(first, ServerNotFoundError("Unable to find the server at %s" % conn.host))
+                return
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                finished = True
+                if reused:
+                    # The server closed the connection while it was idle
+                    waiting[0:0] = run
+                else:
+                    waiting[0:0] = run[1:]
+                    yield self._pipeline_fail(first, e)
+                return
+
+            previous = None
+            for (index, request) in enumerate(run):
+                try:
+                    if conn.sock is None:
+                        raise httplib.HTTPException("The server closed the connection")
+                    if previous is not None:
+                        previous.spool()
+                        previous = None
+                    response = httplib.HTTPResponse(conn.sock, strict=conn.strict, method=request.method)
+                    response.begin()
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    finished = True
+                    if answered:
+                        depths[first.key] = answered
+                    if isinstance(e, socket.timeout) or (not answered and not reused and request.attempts):
+                        waiting[0:0] = run[index + 1:]
+                        yield self._pipeline_fail(request, e)
+                    else:
+                        if not answered and not reused:
+                            request.attempts += 1
+                        waiting[0:0] = run[index:]
+                    return
+                answered += 1
+                if response.will_close:
+                    conn.close()
+                if request.method == "HEAD" or response.length == 0:
+                    response.close()
+                    content = StringIO.StringIO("")
+                elif response.will_close:
+                    # The body is all that is left to read on the connection
+                    content = response
+                elif index == len(run) - 1:
+                    content = _LeasedResponse(response, lease)
+                else:
+                    content = previous = _PipelinedResponse(response)
+                try:
+                    result = self._pipeline_response(request, Response(response), content)
+                except Exception, e:
+                    result = self._pipeline_fail(request, e)
+                yield result
+            finished = True
+        finally:
+            if not finished:
+                lease.reclaim()
+                conn.close()
+            lease.release()
+
+    def _pipeline_response(self, request, response, content):
+        """The response side of request(), for a request of pipeline()."""
+        if request.method != "HEAD" and self.decompress_content:
+            content = _decompressContent(response, content)
+        if response.status == 401 and list(self.credentials.iter(request.authority)):
+            return (request.uri,) + self.request(request.uri, request.method, headers=request.headers)
+        (response, content) = self._follow_response(request.absolute_uri, request.method, None, request.headers,
+                DEFAULT_MAX_REDIRECTS, request.cachekey, response, content)
+        if request.cached_value is not None:
+            (response, content) = self._revalidated(request.info, request.cached_value, request.cachekey,
+                    request.method, response, content)
+        return (request.uri, response, _response_content(response, content, request.method))
+
+    def _exception_response(self, e):
+        """Turn the exception 'e' into a (response, content) pair,
+        for when force_exception_to_status_code is set."""
+        if isinstance(e, HttpLib2ErrorWithResponse):
+            response = e.response
+            content = e.content
+            response.status = 500
+            response.reason = str(e)
+        elif isinstance(e, socket.timeout):
+            content = "Request Timeout"
+            response = Response( {
+                    "content-type": "text/plain",
+                    "status": "408",
+                    "content-length": len(content)
+                    })
+            content = StringIO.StringIO(content)
+            response.reason = "Request Timeout"
         else:
-            return info
+            content = str(e)
+            response = Response( {
+                    "content-type": "text/plain",
+                    "status": "400",
+                    "content-length": len(content)
+                    })
+            content = StringIO.StringIO(content)
+            response.reason = "Bad Request"
+        return (response, content)
 
-    def _normalize_headers(self, headers):
-        return _normalize_headers(headers)
+    def _new_connection(self, connection_type, authority):
+        """Create a connection to 'authority', to be added to the pool."""
+        certs = list(self.certificates.iter(authority))
+        if issubclass(connection_type, HTTPSConnectionWithTimeout):
+            if certs:
+                conn = connection_type(
+                        authority, key_file=certs[0][0],
+                        cert_file=certs[0][1], timeout=self.timeout,
+                        proxy_info=self.proxy_info,
+                        ca_certs=self.ca_certs,
+                        disable_ssl_certificate_validation=
+                                self.disable_ssl_certificate_validation)
+            else:
+                conn = connection_type(
+                        authority, timeout=self.timeout,
+                        proxy_info=self.proxy_info,
+                        ca_certs=self.ca_certs,
+                        disable_ssl_certificate_validation=
+                                self.disable_ssl_certificate_validation)
+        else:
+            conn = connection_type(
+                    authority, timeout=self.timeout,
+                    proxy_info=self.proxy_info)
+        conn.set_debuglevel(debuglevel)
+        return conn
 
 # Need to catch and rebrand some exceptions
 # Then need to optionally turn all exceptions into status codes
@@ -1327,7 +3694,11 @@ The 'method' is the HTTP method to perform, such as GET, POST, DELETE, etc.
 There is no restriction on the methods allowed.
 
 The 'body' is the entity body to be sent with the request. It is a string
-object.
+object, or a file-like object or an iterable of strings, which are sent as
+they are read: with the 'content-length' header when it is given or the
+body is a regular file, with chunked transfer encoding otherwise. Seekable
+files, lists and tuples are rewound to be sent again, for authentication,
+retries and redirects; other bodies raise NonRewindableBodyError then.
 
 Any extra headers that are to be sent with the request should be provided in the
 'headers' dictionary.
@@ -1338,228 +3709,74 @@ exception is 'redirections. The default is 5.
 The return value is a tuple of (response, content), the first
 being and instance of the 'Response' class, the second being
 a string that contains the response entity body.
+
+A single Http object can be shared by several threads: each request
+checks a connection out of 'self.connections', a ConnectionPool. When
+the content streams from the network, the connection goes back to the
+pool once the content is read to the end or closed, so content that is
+not read entirely should be closed.
         """
+        lease = None
         try:
-            if headers is None:
-                headers = {}
-            else:
-                headers = self._normalize_headers(headers)
-
-            if not headers.has_key('user-agent'):
-                headers['user-agent'] = "Python-httplib2/%s (gzip)" % __version__
+            headers = self._prepare_headers(headers)
 
-            uri = iri2uri(uri)
+            body = _streaming_body(body, headers)
 
-            (scheme, authority, request_uri, defrag_uri) = urlnorm(uri)
-            domain_port = authority.split(":")[0:2]
-            if len(domain_port) == 2 and domain_port[1] == '443' and scheme == 'http':
-                scheme = 'https'
-                authority = domain_port[0]
+            (uri, scheme, authority, request_uri, defrag_uri) = _request_target(uri)
 
             conn_key = scheme+":"+authority
-            if conn_key in self.connections:
-                conn = self.connections[conn_key]
-            else:
-                if not connection_type:
-                  connection_type = SCHEME_TO_CONNECTION[scheme]
-                certs = list(self.certificates.iter(authority))
-                if issubclass(connection_type, HTTPSConnectionWithTimeout):
-                    if certs:
-                        conn = self.connections[conn_key] = connection_type(
-                                authority, key_file=certs[0][0],
-                                cert_file=certs[0][1], timeout=self.timeout,
-                                proxy_info=self.proxy_info,
-                                ca_certs=self.ca_certs,
-                                disable_ssl_certificate_validation=
-                                        self.disable_ssl_certificate_validation)
-                    else:
-                        conn = self.connections[conn_key] = connection_type(
-                                authority, timeout=self.timeout,
-                                proxy_info=self.proxy_info,
-                                ca_certs=self.ca_certs,
-                                disable_ssl_certificate_validation=
-                                        self.disable_ssl_certificate_validation)
-                else:
-                    conn = self.connections[conn_key] = connection_type(
-                            authority, timeout=self.timeout,
-                            proxy_info=self.proxy_info)
-                conn.set_debuglevel(debuglevel)
-
-            if 'range' not in headers and 'accept-encoding' not in headers:
-                headers['accept-encoding'] = 'gzip, deflate'
+            if not connection_type:
+                connection_type = SCHEME_TO_CONNECTION[scheme]
+            conn = self.connections.get(conn_key,
+                    lambda: self._new_connection(connection_type, authority))
+            lease = _ConnectionLease(self.connections, conn_key, conn)
 
             info = email.Message.Message()
             cached_value = None
             if self.cache:
-                cachekey = defrag_uri
-                cached_value = self.cache.get(cachekey)
-                if cached_value:
-                    # info = email.message_from_string(cached_value)
-                    #
-                    # Need to replace the line above with the kludge below
-                    # to fix the non-existent bug not fixed in this
-                    # bug report: http://mail.python.org/pipermail/python-bugs-list/2005-September/030289.html
-                    try:
-                        info0 = self._cache_value_info_read(cached_value)
-                        fileLength = os.fstat(cached_value.fileno()).st_size
-
-                        content = cached_value                        
-                        info = info0.split("\n")
-
-                        msg = email.Message.Message()
-                        
-                        for l in info:
-                            if len(l) != 0:
-                                parts = l.split(": ", 1)
-                                if len(parts) > 1:
-                                    msg[parts[0]] = parts[1]
-
-                        info = msg
-
-                        totalLength = len(info0) + 4 + int(info['content-length'])
-                        if totalLength != fileLength:
-                            msg = "Invalid cache file %s : length should be %s, got %s" % (cachekey, totalLength, fileLength)
-                            report_error(msg)
-                            raise Exception(msg)
-                    except Exception, e:
-                        self.cache.delete(cachekey)
-                        cachekey = None
-                        cached_value = None
+                (info, cached_value, cachekey) = self._cache_lookup(defrag_uri, True)
             else:
                 cachekey = None
-
-
-            if method in self.optimistic_concurrency_methods and self.cache and info.has_key('etag') and not self.ignore_etag and 'if-match' not in headers:
-                # http://www.w3.org/1999/04/Editing/
-                headers['if-match'] = info['etag']
-
-            if method not in ["GET", "HEAD"] and self.cache and cachekey:
-                # RFC 2616 Section 13.10
-                self.cache.delete(cachekey)
-
-            # Check the vary header in the cache to see if this request
-            # matches what varies in the cache.
-            if method in ['GET', 'HEAD'] and 'vary' in info:
-                vary = info['vary']
-                vary_headers = vary.lower().replace(' ', '').split(',')
-                for header in vary_headers:
-                    key = '-varied-%s' % header
-                    value = info[key]
-                    if headers.get(header, None) != value:
-                        cached_value = None
-                        break
-
-            if cached_value and method in ["GET", "HEAD"] and self.cache and 'range' not in headers:
-                entry_disposition = _entry_disposition(info, headers)
-
-                is_fresh_302 = info['status'] == "302" and entry_disposition == "FRESH"
-
-                is_permanent_redirect = info.has_key('-x-permanent-redirect-url')
-
-                if is_permanent_redirect or is_fresh_302:
-                    if is_permanent_redirect:
-                        url = info['-x-permanent-redirect-url']
-
-                    if is_fresh_302:
-                        url = info['location']
-
-                    # Should cached permanent redirects be counted in our redirection count? For now, yes.
-                    if redirections <= 0:
-                      raise RedirectLimit("Redirected more times than rediection_limit allows.", {}, "")
-                    (response, new_content) = self.request(url, "GET", headers = headers, redirections = redirections - 1)
+            cached_value = self._usable_entry(method, headers, info, cached_value, cachekey)
+
+            resumed = None
+            if cached_value and info.has_key(PARTIAL_ENTRY):
+                if method == "GET" and 'range' not in headers:
+                    resumed = self._resume(conn, authority, uri, request_uri, headers, redirections, cachekey, lease,
+                                           info, cached_value)
+                if resumed is None:
+                    cached_value.close()
+                    cached_value = None
+
+            if resumed is not None:
+                (response, content) = resumed
+            else:
+                (answer, value) = self._cache_answer(method, headers, info, cached_value, redirections)
+                if answer == "CACHED":
+                    (response, content) = value
+                elif answer == "REDIRECT":
+                    # Don't hold on to our connection while following the redirect
+                    lease.release()
+                    (response, new_content) = self.request(value, "GET", headers = headers, redirections = redirections - 1)
                     response.previous = Response(info)
                     response.previous.fromcache = True
+                    (response, content) = self._revalidated(info, cached_value, cachekey, method, response, new_content)
                 else:
-                    # Determine our course of action:
-                    #   Is the cached entry fresh or stale?
-                    #   Has the client requested a non-cached response?
-                    #
-                    # There seems to be three possible answers:
-                    # 1. [FRESH] Return the cache entry w/o doing a GET
-                    # 2. [STALE] Do the GET (but add in cache validators if available)
-                    # 3. [TRANSPARENT] Do a GET w/o any cache validators (Cache-Control: no-cache) on the request
-
-                    if entry_disposition == "FRESH":
-                        if not cached_value:
-                            info['status'] = '504'
-                            content = StringIO.StringIO("")
-                        response = Response(info)
-                        if cached_value:
-                            response.fromcache = True
-
-                        if response.status not in [302]:
-                            return (response, content)
-
-                    if entry_disposition == "STALE":
-                        if info.has_key('etag') and not self.ignore_etag and not 'if-none-match' in headers:
-                            headers['if-none-match'] = info['etag']
-                        if info.has_key('last-modified') and not 'last-modified' in headers:
-                            headers['if-modified-since'] = info['last-modified']
-                    elif entry_disposition == "TRANSPARENT":
-                        pass
-
-                    (response, new_content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
-
-                if response.status == 304 and method == "GET":
-                    # Rewrite the cache entry with the new end-to-end headers
-                    # Take all headers that are in response
-                    # and overwrite their values in info.
-                    # unless they are hop-by-hop, or are listed in the connection header.
-
-                    for key in _get_end2end_headers(response):
-                        info[key] = response[key]
-                    merged_response = Response(info)
-                    if hasattr(response, "_stale_digest"):
-                        merged_response._stale_digest = response._stale_digest
-                    # TEMPORARY LAGUNAS : DO NOT UPDATE CACHE
-#                    _updateCache(headers, merged_response, content, self.cache, cachekey)
-                    response = merged_response
-                    response.status = 200
-                    response.fromcache = True                    
-
-                elif response.status == 200:
-                    content = new_content
-                else:
-                    self.cache.delete(cachekey)
-                    content = new_content
-            else:
-                cc = _parse_cache_control(headers)
-                if cc.has_key('only-if-cached'):
-                    info['status'] = '504'
-                    response = Response(info)
-                    content = StringIO.StringIO("")
-                else:
-                    (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey, lease)
+                    if value is not None:
+                        (response, content) = self._revalidated(info, value, cachekey, method, response, content)
         except Exception, e:
+            if lease is not None:
+                lease.reclaim()
             if self.force_exception_to_status_code:
-                if isinstance(e, HttpLib2ErrorWithResponse):
-                    response = e.response
-                    content = e.content
-                    response.status = 500
-                    response.reason = str(e)
-                elif isinstance(e, socket.timeout):
-                    content = "Request Timeout"
-                    response = Response( {
-                            "content-type": "text/plain",
-                            "status": "408",
-                            "content-length": len(content)
-                            })
-                    content = StringIO.StringIO(content)
-                    response.reason = "Request Timeout"
-                else:
-                    content = str(e)
-                    response = Response( {
-                            "content-type": "text/plain",
-                            "status": "400",
-                            "content-length": len(content)
-                            })
-                    content = StringIO.StringIO(content)
-                    response.reason = "Bad Request"
+                (response, content) = self._exception_response(e)
             else:
                 raise
+        finally:
+            if lease is not None:
+                lease.release()
 
-
-        return (response, content)
+        return (response, _response_content(response, content, method))
 
 
 
@@ -0,0 +1,315 @@
+"""
+The format of cache entries.
+
+An entry starts with a fixed size preamble: a magic string, the format
+version, the length of the header, the length of the body, and when the
+response stops being fresh, in seconds since the epoch or 0 when that
+is not known. The header follows, as "key: value" lines, the first one
+being the status, then the body. Readers get the header in one read
+once they have the preamble, and can tell an entry is complete, or when
+it expires, without parsing it.
+
+Reading a header still costs a few system calls and its parsing, paid
+again on each hit. MetadataCache keeps what the readers of entries
+parse from them, for the files that did not change since.
+
+Entries written before the preamble existed (version 0) start with the
+header, ended by "\\r\\n\\r\\n". They are still read, and convert() and
+convert_tree() rewrite them in the current format:
+
+    python -m streaming_httplib2.cacheformat CACHE_DIRECTORY...
+"""
+
+import collections
+import errno
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = "\x89H2C"
+VERSION = 1
+
+# magic, version, padding, header length, body length, expiry
+PREAMBLE = struct.Struct("!4sB3xIQq")
+
+# The room to leave in the header of an entry whose body length is not
+# known yet, for the content-length line written over it once it is.
+LENGTH_RESERVE = len("content-length: %d\n" % (2 ** 64 - 1))
+
+# The largest header read from a version 0 entry
+MAX_HEADER_SIZE = 1024 * 1024
+
+# Chunk size of the body copies made by convert()
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# How many entries a MetadataCache keeps by default
+DEFAULT_METADATA_ENTRIES = 4096
+
+
+class Header(object):
+    """What comes before the body of an entry.
+
+    'text' is the header, 'size' the number of bytes before the body,
+    'body_length' the length of the body and 'expires' the expiry of the
+    entry. The last two are None in version 0 entries, which don't
+    record them.
+    """
+    def __init__(self, version, text, size, body_length=None, expires=None):
+        self.version = version
+        self.text = text
+        self.size = size
+        self.body_length = body_length
+        self.expires = expires
+
+
+def pack(text, body_length, expires=0, size=None):
+    """The start of an entry for a header 'text' and a body of 'body_length' bytes.
+
+    With 'size', the header is padded to 'size' bytes with a blank line
+    that parse() skips, so that headers packed with the same 'size' can
+    be written over each other.
+    """
+    if size is not None:
+        if len(text) > size:
+            raise ValueError("Cache entry header larger than %d bytes" % size)
+        if len(text) < size:
+            text += " " * (size - len(text) - 1) + "\n"
+    return PREAMBLE.pack(MAGIC, VERSION, len(text), body_length, int(expires or 0)) + text
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    while data and len(data) < size:
+        more = fp.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read_header(fp):
+    """Read the header of the entry 'fp', leaving it at the start of the body.
+
+    Raises ValueError for an entry in an unknown format, or too short.
+    """
+    preamble = _read_exactly(fp, PREAMBLE.size)
+    if preamble[:len(MAGIC)] != MAGIC:
+        return _read_version0(fp, preamble)
+    if len(preamble) < PREAMBLE.size:
+        raise ValueError("Truncated cache entry preamble")
+    (magic, version, header_length, body_length, expires) = PREAMBLE.unpack(preamble)
+    if version != VERSION:
+        raise ValueError("Unknown cache entry version %d" % version)
+    text = _read_exactly(fp, header_length)
+    if len(text) < header_length:
+        raise ValueError("Truncated cache entry header")
+    return Header(version, text, PREAMBLE.size + header_length, body_length, expires)
+
+
+def _read_version0(fp, info):
+    end = info.find("\r\n\r\n")
+    if end >= 0:
+        # Only tiny headers end within the preamble size
+        fp.seek(end + 4)
+        return Header(0, info[:end], end + 4)
+    while len(info) < MAX_HEADER_SIZE:
+        last_chars = info[-4:]
+        # Small speedup
+        if "\r" not in last_chars and "\n" not in last_chars:
+            add = fp.read(4)
+        else:
+            add = fp.read(1)
+
+        if not add:
+            break
+        info += add
+
+        if info[-4:] == "\r\n\r\n":
+            return Header(0, info[:-4], len(info))
+    raise ValueError("Truncated cache entry header")
+
+
+def parse(text):
+    """The header 'text' as a list of (key, value)."""
+    headers = []
+    for line in text.split("\n"):
+        parts = line.split(": ", 1)
+        if len(parts) > 1:
+            headers.append((parts[0], parts[1]))
+    return headers
+
+
+class MetadataCache(object):
+    """A thread-safe LRU of the metadata parsed from cache entries.
+
+    Keys identify a version of an entry file, such as what stat_key()
+    returns for it: a file replaced or written to gets another key, and
+    the metadata of its previous version is eventually dropped, as the
+    least recently used.
+    """
+    def __init__(self, max_entries=DEFAULT_METADATA_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+
+def stat_key(name, st):
+    """A key for the version of the file 'name' whose os.stat result is 'st'."""
+    return (name, st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
+def remove(path, fp=None):
+    """Remove the entry at 'path', unless a process holds a lock on it:
+    DistributedFileCache readers hold a shared one, and writers an
+    exclusive one. With 'fp', the entry open, only its version of the
+    entry is removed. Returns whether it was removed, or was already gone.
+    """
+    if fp is None:
+        try:
+            fp = open(path, 'rb')
+        except IOError, e:
+            return e.errno == errno.ENOENT
+        try:
+            return remove(path, fp)
+        finally:
+            fp.close()
+    if fcntl is not None:
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno == errno.EWOULDBLOCK:
+                return False
+            raise
+    try:
+        try:
+            if os.stat(path).st_ino != os.fstat(fp.fileno()).st_ino:
+                # Replaced meanwhile
+                return False
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return True
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def convert(path):
+    """Rewrite the entry at 'path' in the current format.
+
+    Returns whether it was rewritten: entries already in the current
+    format, incomplete, or being written (locked by a
+    DistributedFileCache) are left alone.
+    """
+    import email.Message
+    import streaming_httplib2
+
+    f = open(path, 'rb')
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+        try:
+            header = read_header(f)
+        except ValueError:
+            return False
+        if header.version == VERSION:
+            return False
+        msg = email.Message.Message()
+        for key, value in parse(header.text):
+            msg[key] = value
+        try:
+            body_length = int(msg['content-length'])
+        except (TypeError, ValueError):
+            return False
+        if header.size + body_length != os.fstat(f.fileno()).st_size:
+            return False
+
+        (fd, temp) = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                out.write(pack(header.text, body_length, streaming_httplib2._entry_expiry(msg)))
+                while True:
+                    data = f.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+            finally:
+                out.close()
+            try:
+                os.rename(temp, path)
+            except OSError:
+                # Windows can't rename onto an existing file
+                os.remove(path)
+                os.rename(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return True
+    finally:
+        f.close()
+
+
+def convert_tree(directory):
+    """Convert the entries in 'directory' and below. Returns how many were rewritten."""
+    converted = 0
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for filename in filenames:
+            if filename.startswith('.'):
+                # Temporary files and the cacheindex
+                continue
+            if convert(os.path.join(dirpath, filename)):
+                converted += 1
+    return converted
+
+
+def main(argv):
+    if not argv:
+        sys.stderr.write("usage: python -m streaming_httplib2.cacheformat CACHE_DIRECTORY...\n")
+        return 2
+    for directory in argv:
+        print "%s: %d entries converted" % (directory, convert_tree(directory))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,263 @@
+"""
+A metadata index of the entries of a cache directory.
+
+Knowing the size, expiry or validators of the entries of a cache means
+opening each entry file and reading its header, which is slow on large
+caches and on network filesystems. A CacheIndex keeps them in an SQLite
+database in the cache directory, updated as entries are written and
+removed by FileCache and DistributedFileCache when created with 'index'
+set: tools maintaining the cache can query it instead, and so do these
+caches to evict entries when they have size limits.
+
+For each entry, the index records its key, its path relative to the
+cache directory, its size on disk, its expiry (see cacheformat), its
+ETag and Last-Modified headers, when it was last read or written, and
+how many times it was read. Reads are counted in memory, and written to
+the database every FLUSH_INTERVAL seconds or FLUSH_HITS reads, with the
+next entry update, or on flush(): the counts of a process that exits
+before are lost, which only makes them approximate.
+
+The number of entries and their total size are kept up to date by
+triggers as entries change, so that caches with limits don't go through
+the index on each write. They are only counted from the entries when
+the index is opened without them, as indexes created before were.
+
+SQLite relies on file locks, which some network filesystems don't
+implement correctly: check yours before sharing an index between hosts.
+"""
+
+import os
+import StringIO
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from streaming_httplib2 import cacheformat
+
+# The name of the index database in the cache directory. Names starting
+# with a dot are not cache entries.
+INDEX_NAME = ".index.sqlite"
+
+# How long to wait, in seconds, for other processes to release the database.
+DEFAULT_TIMEOUT = 30
+
+# When to write the reads counted in memory.
+FLUSH_INTERVAL = 5
+FLUSH_HITS = 100
+
+# The order in which entries are evicted, for each eviction policy:
+# least recently used first, or least frequently used.
+EVICTION_ORDERS = {
+    'lru': "last_access",
+    'lfu': "hits, last_access",
+}
+
+# Caches over their limits evict entries until they are back under
+# this part of them, so that they don't evict on each new entry.
+EVICTION_TARGET = 0.9
+
+# How many eviction candidates are queried at a time.
+EVICTION_BATCH = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries BEGIN
+    UPDATE totals SET entries = entries + 1, size = size + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries BEGIN
+    UPDATE totals SET entries = entries - 1, size = size - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resized AFTER UPDATE OF size ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size + NEW.size;
+END;
+INSERT OR IGNORE INTO totals SELECT 0, (SELECT COUNT(*) FROM entries), (SELECT COALESCE(SUM(size), 0) FROM entries)
+    WHERE NOT EXISTS (SELECT 1 FROM totals);
+"""
+
+COLUMNS = ('key', 'path', 'size', 'expires', 'etag', 'last_modified', 'last_access', 'hits')
+
+
+class CacheIndex(object):
+    """The index of the cache directory 'directory', in its INDEX_NAME file.
+
+    Safe to use from several threads, and several processes: each
+    process opens its own connection to the database.
+    """
+    def __init__(self, directory, timeout=DEFAULT_TIMEOUT):
+        if sqlite3 is None:
+            raise ImportError("The sqlite3 module is needed to index a cache")
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_NAME)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        # Map keys to [reads, time of the last one] not written yet
+        self.pending = {}
+        self.reads = 0
+        self.flushed = time.time()
+
+    def _db(self):
+        if self.pid != os.getpid():
+            # Connections are not shared with forked processes
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+            self.pid = os.getpid()
+        return self.connection
+
+    def record(self, key, path, header=None):
+        """Record the entry for 'key', just written to 'path'.
+
+        'header' is the start of the entry as it was written, which
+        spares reading it back from the file.
+        """
+        st = os.stat(path)
+        if header is not None:
+            header = cacheformat.read_header(StringIO.StringIO(header))
+        else:
+            f = open(path, 'rb')
+            try:
+                header = cacheformat.read_header(f)
+            finally:
+                f.close()
+        headers = dict([(name.lower(), value) for (name, value) in cacheformat.parse(header.text)])
+        expires = header.expires
+        if expires is None:
+            expires = 0
+        values = (os.path.relpath(path, self.directory), st.st_size, expires,
+                  headers.get('etag'), headers.get('last-modified'), time.time())
+        self.lock.acquire()
+        try:
+            db = self._db()
+            # Updated in place rather than replaced, for the triggers
+            # keeping the totals
+            cursor = db.execute("UPDATE entries SET path = ?, size = ?, expires = ?, etag = ?, "
+                                "last_modified = ?, last_access = ? WHERE key = ?", values + (key,))
+            if cursor.rowcount == 0:
+                db.execute("INSERT INTO entries (%s) VALUES (?, ?, ?, ?, ?, ?, ?)" % ", ".join(COLUMNS[:-1]),
+                           (key,) + values)
+            self._flush(db)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """Forget the entry for 'key'."""
+        self.lock.acquire()
+        try:
+            self.pending.pop(key, None)
+            db = self._db()
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._flush(db)
+        finally:
+            self.lock.release()
+
+    def hit(self, key):
+        """Count a read of the entry for 'key'."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            pending = self.pending.setdefault(key, [0, now])
+            pending[0] += 1
+            pending[1] = now
+            self.reads += 1
+            if self.reads >= FLUSH_HITS or now - self.flushed >= FLUSH_INTERVAL:
+                self._flush(self._db())
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write the reads counted in memory."""
+        self.lock.acquire()
+        try:
+            self._flush(self._db())
+        finally:
+            self.lock.release()
+
+    def _flush(self, db):
+        if self.pending:
+            db.executemany("UPDATE entries SET hits = hits + ?, last_access = MAX(last_access, ?) WHERE key = ?",
+                           [(hits, last_access, key) for (key, (hits, last_access)) in self.pending.items()])
+            self.pending.clear()
+        self.reads = 0
+        db.commit()
+        self.flushed = time.time()
+
+    def lookup(self, key):
+        """The entry for 'key', as a dictionary of its COLUMNS, or None."""
+        entries = self.query("WHERE key = ?", (key,))
+        if entries:
+            return entries[0]
+        return None
+
+    def query(self, where="", parameters=()):
+        """The entries selected by the SQL clauses 'where', as dictionaries
+        of their COLUMNS. For instance, the expired entries:
+
+            index.query("WHERE expires > 0 AND expires < ? ORDER BY expires", (time.time(),))
+        """
+        self.lock.acquire()
+        try:
+            db = self._db()
+            self._flush(db)
+            rows = db.execute("SELECT %s FROM entries %s" % (", ".join(COLUMNS), where), parameters).fetchall()
+        finally:
+            self.lock.release()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def victims(self, policy, limit=EVICTION_BATCH, offset=0):
+        """The entries to evict first with the eviction 'policy', one of
+        EVICTION_ORDERS, 'limit' entries from the 'offset'th."""
+        return self.query("ORDER BY %s LIMIT ? OFFSET ?" % EVICTION_ORDERS[policy], (limit, offset))
+
+    def totals(self):
+        """The number of entries and their total size, as kept up to date."""
+        self.lock.acquire()
+        try:
+            (entries, size) = self._db().execute("SELECT entries, size FROM totals").fetchone()
+        finally:
+            self.lock.release()
+        return {'entries': entries, 'size': size}
+
+    def stats(self):
+        """The number of entries, their total size and number of reads,
+        counted going through all entries."""
+        self.lock.acquire()
+        try:
+            db = self._db()
+            self._flush(db)
+            (entries, size, hits) = db.execute("SELECT COUNT(*), SUM(size), SUM(hits) FROM entries").fetchone()
+        finally:
+            self.lock.release()
+        return {'entries': entries, 'size': size or 0, 'hits': hits or 0}
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.connection is not None and self.pid == os.getpid():
+                self._flush(self.connection)
+                self.connection.close()
+            self.connection = None
+            self.pid = None
+        finally:
+            self.lock.release()
@@ -1,4 +1,6 @@
 import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import cacheindex
 import time
 import os
 import re
@@ -40,6 +42,22 @@ def urlopen(url, cache_dir, path_schema = [(0,2), (2,4)], create_cache_dirs = Fa
     return resp, content
 
 
+def urlopen_all(urls, cache_dir, path_schema = [(0,2), (2,4)], create_cache_dirs = False, headers = {},
+                workers = httplib2.DEFAULT_FETCH_WORKERS, per_host = httplib2.DEFAULT_FETCH_PER_HOST):
+    """Open several urls concurrently, through a single Http and cache, and yield
+       (url, response info, content stream) as each of them completes.
+       'workers' and 'per_host' are passed to Http.fetch_all.
+       Be careful, ssl_certificate_validation is disactivated."""
+    c = DistributedFileCache(cache_dir, path_schema = path_schema,
+            create = create_cache_dirs)
+    h = httplib2.Http(c, disable_ssl_certificate_validation = True)
+    try:
+        for result in h.fetch_all([(url, "GET", None, headers) for url in urls], workers, per_host):
+            yield result
+    finally:
+        c.cleanup()
+
+
 try:
     from hashlib import sha1 as _sha, md5 as _md5
 except ImportError:
@@ -90,15 +108,34 @@ class DistributedFileCache(httplib2.FileCache):
        - get the content of the cache : it will lock it if it did no exist to prevent concurrent download
        - set the content of the cache : it will unlock it
        - cleanup the cache after the operation: unlock every file if some remain
+
+    Interrupted downloads are only resumed with tee, which keeps what was written of a
+    body that ended early as a partial file (see resume).
     """
-    def __init__(self, cachedir, safe=safename, path_schema = [(0,2),(2,4)], create = False):
+    def __init__(self, cachedir, safe=safename, path_schema = [(0,2),(2,4)], create = False, store_compressed = False,
+                 chunk_size = None, tee = False, follow = False, index = False, max_size = None, max_entries = None,
+                 eviction = 'lru'):
         self.cachedir = cachedir
         self.safe = safe
+        # How much is read at a time to write a body, httplib2.COPY_CHUNK_SIZE by default
+        self.chunk_size = chunk_size
+        # Return responses right away, and write them as they are read (see open)
+        self.tee = tee
+        # Read files while they are being written, instead of waiting for them (see get)
+        self.follow = follow
+        # Store compressed responses as they were sent (see httplib2.FileCache)
+        self.store_compressed = store_compressed
         self.lock = threading.Lock()
         self.exclusive_locks = {}
         self.path_schema = path_schema
         if create:
             self.create_dirs()
+        # Limits on the size and number of entries, see httplib2.FileCache and _evict_entry
+        self._limits(max_size, max_entries, eviction)
+        # Record entries in a cacheindex.CacheIndex as they are written, read and deleted
+        self.index = None
+        if index or self.limited:
+            self.index = cacheindex.CacheIndex(cachedir)
 
     def report_error(self, message, exc_info = True):
         "Report an error"
@@ -175,10 +212,12 @@ class DistributedFileCache(httplib2.FileCache):
         ret = os.path.join(self.cachedir, self.build_path(key))
         return ret
 
-    def get(self, key, timeout = 600):
+    def get(self, key, timeout = 600, wait = True):
         """Get the content of the cache.
         If no content was found, then create a exclusively locked file, so somebody trying just after that will wait until I finish.
-        If some content was found, then try to "shared lock" the file, wait for the lock if needed, then return the content of the file"""
+        If some content was found, then try to "shared lock" the file, wait for the lock if needed, then return the content of the file.
+        In follow mode, a locked file is returned as soon as something was written to it, as a FollowedFile.
+        Without wait, a file locked by a writer raises httplib2.CacheBusyError instead."""
         cache_full_path = self.cache_path(key)
 
         # Try to acquire the lock. It its succeeds, it means that the file did not exist, so that the cache was empty
@@ -198,6 +237,8 @@ class DistributedFileCache(httplib2.FileCache):
         startTime = time.time()
         sleeping = 1.0
         OK = False
+        follow = False
+        busy = False
         fd = None
         try:
             fd = os.open(cache_full_path, os.O_RDWR, 0644)
@@ -217,6 +258,13 @@ class DistributedFileCache(httplib2.FileCache):
                 except IOError, e:
                     # IF the error is "would block", this is just a sign that the file is still locked by someone else
                     if e.errno == errno.EWOULDBLOCK:
+                        if not wait:
+                            busy = True
+                            break
+                        if self.follow and os.fstat(fd).st_size > 0:
+                            # Its header is there, the rest will be read as it is written
+                            follow = True
+                            break
                         time.sleep(sleeping)
                         sleeping *= 2.0
                         if sleeping >= 10.0:
@@ -229,13 +277,24 @@ class DistributedFileCache(httplib2.FileCache):
             self.report_error("Unknown error waiting for file %s." % cache_full_path)
             raise
         finally:
-            if not OK:
+            if follow:
+                return FollowedFile(fd, cache_full_path, timeout)
+            elif busy:
+                os.close(fd)
+                raise httplib2.CacheBusyError("Cache file %s is being written." % cache_full_path)
+            elif not OK:
                 if fd != None:
                     os.close(fd)
                 return None
             else:
+                if self.index is not None:
+                    self.index.hit(key)
                 return os.fdopen(fd, "r")
 
+    def get_nowait(self, key):
+        "Same as get, raising httplib2.CacheBusyError instead of waiting for a file being written"
+        return self.get(key, wait = False)
+
     def write_content(self, cache_full_path, fd, content):
         """Write the content to the file"""
         try:
@@ -243,14 +302,7 @@ class DistributedFileCache(httplib2.FileCache):
                 os.write(fd, content)
                 return len(content)
             elif hasattr(content, "read"):
-                total = 0
-                while True:
-                    b = content.read(8192)
-                    total += len(b)
-                    if len(b) == 0 or b is None:
-                        break
-                    os.write(fd, b)        
-                return total
+                return httplib2._copy(content, httplib2._fd_writer(fd), self.chunk_size)
             else:
                 raise Exception("Cache: unsupported type of content variable : %s" % content.__class__.__name__)
         except:
@@ -316,12 +368,67 @@ class DistributedFileCache(httplib2.FileCache):
         if fd == None:
             self.report_error("Error while rereading cache file %s after writing it." % cache_full_path)
             raise
-        
+        self._indexed(key, cache_full_path, header)
+
         # Rewind the file, and skip the header part
         f = os.fdopen(fd, "r")        
         os.lseek(fd, len(header), os.SEEK_SET)
         return f
 
+    def open(self, key, header):
+        """Start writing the cache file, and return a writer for its body (see httplib2.FileCache.open).
+        The file stays exclusively locked until the writer commits or aborts, cleanup leaves it alone."""
+        cache_full_path = self.cache_path(key)
+        if cache_full_path not in self.exclusive_locks:
+            # Same as release_ex_lock : we did not lock the file, so we replace it
+            try:
+                os.unlink(cache_full_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self.report_error("Unknown error unlinking file %s." % cache_full_path)
+                    raise
+            self.acquire_ex_lock(cache_full_path)
+
+        self.lock.acquire()
+        try:
+            fd = self.exclusive_locks.pop(cache_full_path)["fd"]
+        finally:
+            self.lock.release()
+        writer = CacheWriter(self, cache_full_path, fd, key, header)
+        try:
+            writer.write(header)
+        except:
+            writer.abort()
+            raise
+        return writer
+
+    def resume(self, key, cached_value, length = None):
+        """Return a writer appending to the partial cache file cached_value, as returned by get
+        when it was length bytes long, or None if another process is reading or writing it, or
+        it changed since. The file is exclusively locked until the writer commits, or aborts,
+        which truncates it back to its length (see httplib2.FileCache.resume)."""
+        cache_full_path = self.cache_path(key)
+        lock_fd = cached_value.fileno()
+        try:
+            # Upgrade the shared lock taken by get
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno == errno.EWOULDBLOCK:
+                return None
+            raise
+        try:
+            fd = os.open(cache_full_path, os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            return None
+        st = os.fstat(fd)
+        if st.st_ino != os.fstat(lock_fd).st_ino or (length is not None and st.st_size != length):
+            # The file was replaced, or appended to, meanwhile
+            os.close(fd)
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            return None
+        return CacheAppender(self, cache_full_path, fd, lock_fd, key, st.st_size)
+
     def cleanup(self):
         # Clean all the locks that may remain
         for k in self.exclusive_locks.keys():
@@ -335,3 +442,163 @@ class DistributedFileCache(httplib2.FileCache):
         except:
             self.report_error("Unknown error removing file %s." % cache_full_path)
             raise
+        if self.index is not None:
+            self.index.remove(key)
+
+    def _indexed(self, key, cache_full_path, header = None):
+        if self.index is not None:
+            try:
+                self.index.record(key, cache_full_path, header)
+                self.evict(key)
+            except Exception:
+                # The entry is there all the same
+                self.report_error("Error while indexing cache file %s." % cache_full_path)
+
+    def _evict_entry(self, entry):
+        """Remove the file of an index entry, unless it is locked: readers hold a shared lock
+        on the files they read (see get), and writers an exclusive one. Returns whether it is gone."""
+        return cacheformat.remove(os.path.join(self.cachedir, entry['path']))
+
+
+# How long, in seconds, a FollowedFile waits at first, and at most, for more data.
+FOLLOW_POLL_MIN = 0.01
+FOLLOW_POLL_MAX = 0.2
+
+
+class FollowedFile(object):
+    """Reads a cache file while another process writes it, tail -f style.
+    At the end of the file, reads wait for more data until the writer releases its lock:
+    the file is then complete, unless it was truncated and unlinked, which is how aborted
+    writes are marked (see CacheWriter.abort) and raises an IOError. So does a file of unknown
+    length whose writer released its lock without writing its length (see length_written).
+    A read waiting more than timeout seconds for data raises an IOError too."""
+    def __init__(self, fd, cache_full_path, timeout):
+        self.fd = fd
+        self.cache_full_path = cache_full_path
+        self.timeout = timeout
+        # The file is checked against its content-length once complete, the size httplib2 sets here
+        self.in_progress = True
+        self.expected_size = None
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = self.read(httplib2.COPY_CHUNK_SIZE)
+                if not data:
+                    return "".join(chunks)
+                chunks.append(data)
+
+        startTime = time.time()
+        sleeping = FOLLOW_POLL_MIN
+        while True:
+            data = os.read(self.fd, size)
+            if data or size == 0 or not self.in_progress:
+                return data
+            if self.writer_done():
+                # Read once more what was written before it finished
+                continue
+            if (time.time() - startTime) >= self.timeout:
+                raise IOError(errno.ETIMEDOUT, "Timed out waiting for cache file %s" % self.cache_full_path)
+            time.sleep(sleeping)
+            sleeping = min(sleeping * 2.0, FOLLOW_POLL_MAX)
+
+    def writer_done(self):
+        "Whether the file is complete, raising an IOError if it was aborted"
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno == errno.EWOULDBLOCK:
+                return False
+            raise
+        stat = os.fstat(self.fd)
+        if stat.st_nlink == 0 or stat.st_size == 0:
+            raise IOError(errno.EIO, "Cache file %s was aborted while being read" % self.cache_full_path)
+        if ((self.expected_size is not None and stat.st_size < self.expected_size)
+            or not self.length_written()):
+            # Kept as a partial file, to be resumed, or left by a writer that died
+            raise IOError(errno.EIO, "Cache file %s was left incomplete while being read" % self.cache_full_path)
+        self.in_progress = False
+        return True
+
+    def length_written(self):
+        """Whether the header of the file has the length of its body: files of unknown length
+        start with a length of 0 and no content-length, written over them once they are complete."""
+        position = os.lseek(self.fd, 0, os.SEEK_CUR)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        f = os.fdopen(os.dup(self.fd), "rb")
+        try:
+            header = cacheformat.read_header(f)
+        except ValueError:
+            return False
+        finally:
+            f.close()
+            os.lseek(self.fd, position, os.SEEK_SET)
+        if header.body_length != 0:
+            return True
+        return "content-length" in [name.lower() for (name, value) in cacheformat.parse(header.text)]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CacheWriter(object):
+    """Writes the body of an exclusively locked cache file, see DistributedFileCache.open.
+    header is the header it starts with, if known, kept for the index."""
+    def __init__(self, cache, cache_full_path, fd, key = None, header = None):
+        self.cache = cache
+        self.cache_full_path = cache_full_path
+        self.fd = fd
+        self.key = key
+        self.header = header
+        self.write = httplib2._fd_writer(fd)
+
+    def rewrite(self, header):
+        "Write header over the header of the file, of the same size"
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        self.write(header)
+        os.lseek(self.fd, 0, os.SEEK_END)
+        self.header = header
+
+    def commit(self):
+        "The file is complete: unlock it"
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.cache._indexed(self.key, self.cache_full_path, self.header)
+
+    def abort(self):
+        "Remove the partly written file, then unlock it"
+        try:
+            os.ftruncate(self.fd, 0)
+            os.unlink(self.cache_full_path)
+        except OSError:
+            self.cache.report_error("Error while removing cache file %s." % self.cache_full_path)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+
+class CacheAppender(CacheWriter):
+    """Appends to a partial cache file of length bytes, see DistributedFileCache.resume.
+    The exclusive lock is held by lock_fd, the file descriptor reading the file."""
+    def __init__(self, cache, cache_full_path, fd, lock_fd, key = None, length = None):
+        CacheWriter.__init__(self, cache, cache_full_path, fd, key)
+        self.lock_fd = lock_fd
+        self.length = length
+
+    def commit(self):
+        "Back to the shared lock of the reader"
+        os.close(self.fd)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_SH)
+        self.cache._indexed(self.key, self.cache_full_path)
+
+    def abort(self):
+        "Drop what was appended, back to the shared lock of the reader"
+        if self.length is not None:
+            os.ftruncate(self.fd, self.length)
+        os.close(self.fd)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_SH)
@@ -0,0 +1,141 @@
+"""
+A process-wide cache of name resolutions.
+
+Each connection resolves its host with socket.getaddrinfo, which can be
+slow enough to show in response times when connections are opened at a
+high rate. DNSCache keeps the results for a while, remembers the names
+that do not exist, and can resolve names still in use again in the
+background before they expire, so that lookups never wait on the
+resolver.
+
+streaming_httplib2 resolves names through its DNS_CACHE, an instance
+of DNSCache, with its SOCKET_FAMILY and SOCKET_GET_ADDR_INFO_ADD_ARGUMENTS
+settings, which are part of the cache key.
+"""
+
+import socket
+import threading
+import time
+
+# How long, in seconds, to keep resolved names, and names that don't exist.
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 10
+
+# With background refresh, the part of the TTL left when a lookup
+# triggers a new resolution.
+REFRESH_AHEAD = 0.25
+
+# The number of entries above which expired ones are dropped.
+DEFAULT_MAX_ENTRIES = 1024
+
+# The getaddrinfo errors that mean the name does not exist, as opposed
+# to the resolver failing for now.
+NEGATIVE_ERRORS = set([getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA')
+                       if hasattr(socket, name)])
+
+
+class DNSCache(object):
+    """Caches socket.getaddrinfo results for 'ttl' seconds, and the names
+    that don't exist for 'negative_ttl' seconds.
+
+    With 'refresh' set, a lookup in the last part of the TTL of its entry
+    returns it and resolves the name again in a background thread.
+    'resolver' replaces socket.getaddrinfo, which is looked up on each
+    resolution otherwise, so that libraries patching the socket module
+    are followed.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, refresh=False,
+                 resolver=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+        self.resolver = resolver
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Map getaddrinfo arguments to (expiry time, addresses or gaierror)
+        self.entries = {}
+        # Keys being resolved in the background
+        self.refreshing = set()
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0, **kwargs):
+        """Same as socket.getaddrinfo, from the cache when possible."""
+        key = (host, port, family, socktype, proto, flags, tuple(sorted(kwargs.items())))
+        now = time.time()
+        refresh = False
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                entry = None
+            if (entry is not None and self.refresh and not isinstance(entry[1], socket.gaierror)
+                and entry[0] - now < self.ttl * REFRESH_AHEAD and key not in self.refreshing):
+                self.refreshing.add(key)
+                refresh = True
+        finally:
+            self.lock.release()
+
+        if entry is None:
+            entry = self._resolve(key)
+        elif refresh:
+            thread = threading.Thread(target=self._refresh, args=(key,))
+            thread.setDaemon(True)
+            thread.start()
+        if isinstance(entry[1], socket.gaierror):
+            raise socket.gaierror(*entry[1].args)
+        return list(entry[1])
+
+    def invalidate(self, host):
+        """Forget what is known about 'host', for instance once none of
+        its addresses could be connected to."""
+        self.lock.acquire()
+        try:
+            for key in self.entries.keys():
+                if key[0] == host:
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def _resolve(self, key):
+        (host, port, family, socktype, proto, flags, kwargs) = key
+        resolver = self.resolver or socket.getaddrinfo
+        try:
+            entry = (time.time() + self.ttl,
+                     list(resolver(host, port, family, socktype, proto, flags, **dict(kwargs))))
+        except socket.gaierror, e:
+            if e.args[0] not in NEGATIVE_ERRORS:
+                raise
+            entry = (time.time() + self.negative_ttl, e)
+        self.lock.acquire()
+        try:
+            if len(self.entries) >= self.max_entries:
+                now = time.time()
+                for (other, (expiry, value)) in self.entries.items():
+                    if expiry <= now:
+                        del self.entries[other]
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+            self.entries[key] = entry
+        finally:
+            self.lock.release()
+        return entry
+
+    def _refresh(self, key):
+        try:
+            try:
+                self._resolve(key)
+            except Exception:
+                # The entry stays until it expires
+                pass
+        finally:
+            self.lock.acquire()
+            try:
+                self.refreshing.discard(key)
+            finally:
+                self.lock.release()
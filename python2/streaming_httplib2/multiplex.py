@@ -0,0 +1,780 @@
+"""
+Drives many HTTP/1.1 requests at once from a single thread, using
+epoll where the platform has it and select otherwise.
+
+    fetcher = MultiplexFetcher(httplib2.Http(".cache"))
+    for uri, response, content in fetcher.fetch(uris):
+        ...
+
+Each item of 'uris' is either a URI or a tuple (uri, method, body, headers)
+whose trailing items can be left out. Results are yielded as they
+complete, in any order, along with the URI they were requested for.
+
+Requests go through the cache of the Http object just like Http.request
+does: fresh entries are returned without touching the network, stale
+ones are revalidated, and cacheable responses are stored with
+_updateCache. Redirects are followed according to the Http settings.
+Host names are resolved on background threads, so that the loop never
+waits on the resolver.
+Errors are raised, or turned into responses when the Http object has
+force_exception_to_status_code set.
+
+Authentication and proxies are not handled, use Http.request for those,
+and for request bodies that are not strings. Response bodies are held in
+memory, as they all arrive at once.
+"""
+
+import collections
+import errno
+import httplib
+import os
+import select
+import socket
+import StringIO
+import threading
+import time
+
+import streaming_httplib2 as httplib2
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# The maximum number of connections open at once, overall and per host.
+DEFAULT_MAX_ACTIVE = 256
+DEFAULT_MAX_PER_HOST = 8
+
+# Largest response head (status line and headers) we accept.
+MAX_HEAD_SIZE = 1024 * 1024
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+def _would_block(e):
+    """Whether the socket error 'e' only means 'try again later'."""
+    if ssl is not None and isinstance(e, ssl.SSLError):
+        return e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    return e.args[0] in _WOULD_BLOCK
+
+
+def _wants_write(e, writing):
+    """Whether the socket must become writable before trying again,
+    after 'e' interrupted a write (or a read when 'writing' is false)."""
+    if ssl is not None and isinstance(e, ssl.SSLError):
+        return e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+    return writing
+
+
+class _Poller(object):
+    """Readiness notification through epoll, or select as a fallback."""
+    def __init__(self):
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, write):
+        """Watch 'fd' for reading, or writing when 'write' is true."""
+        if self.epoll is not None:
+            mask = write and select.EPOLLOUT or select.EPOLLIN
+            if fd in self.readers or fd in self.writers:
+                self.epoll.modify(fd, mask)
+            else:
+                self.epoll.register(fd, mask)
+        self.unregister(fd, True)
+        if write:
+            self.writers.add(fd)
+        else:
+            self.readers.add(fd)
+
+    def unregister(self, fd, keep=False):
+        if self.epoll is not None and not keep and (fd in self.readers or fd in self.writers):
+            self.epoll.unregister(fd)
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        """Return the ready file descriptors."""
+        if self.epoll is not None:
+            if timeout is None:
+                timeout = -1
+            try:
+                return [fd for fd, event in self.epoll.poll(timeout)]
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+        try:
+            r, w, x = select.select(list(self.readers), list(self.writers),
+                    list(self.readers | self.writers), timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return list(set(r) | set(w) | set(x))
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+
+class _Resolver(object):
+    """Resolves the hosts of channels on background threads, and wakes
+    the loop up through a pipe, which it polls, when one is done."""
+    def __init__(self):
+        (self.fd, self.wake_fd) = os.pipe()
+        self.lock = threading.Lock()
+        # (channel, addresses or exception) of the resolutions done
+        self.done = collections.deque()
+        self.closed = False
+
+    def resolve(self, channel):
+        thread = threading.Thread(target=self._resolve, args=(channel,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def results(self):
+        """The (channel, addresses or exception) resolved since last time."""
+        os.read(self.fd, 4096)
+        results = []
+        while self.done:
+            results.append(self.done.popleft())
+        return results
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            os.close(self.fd)
+            os.close(self.wake_fd)
+        finally:
+            self.lock.release()
+
+    def _resolve(self, channel):
+        conn = channel.conn
+        try:
+            result = httplib2._getaddrinfo(conn.host, conn.port)
+        except Exception, e:
+            result = e
+        self.lock.acquire()
+        try:
+            # The fetch may be over, and the pipe closed
+            if not self.closed:
+                self.done.append((channel, result))
+                # One byte per channel resolving: the pipe can't fill up
+                os.write(self.wake_fd, "x")
+        finally:
+            self.lock.release()
+
+
+class _ResponseParser(object):
+    """Incremental parser of an HTTP/1.x response."""
+    def __init__(self, method):
+        self.method = method
+        self.buffer = ""
+        self.received = False
+        self.state = "head"
+        self.status = None
+        self.reason = ""
+        self.version = 11
+        self.headers = {}
+        self.body = []
+        self.remaining = 0
+        self.will_close = False
+        self.complete = False
+
+    def feed(self, data):
+        if data:
+            self.received = True
+        self.buffer += data
+        while not self.complete:
+            if self.state == "head":
+                end = self.buffer.find("\r\n\r\n")
+                if end < 0:
+                    if len(self.buffer) > MAX_HEAD_SIZE:
+                        raise httplib.HTTPException("Response head too long")
+                    return
+                head = self.buffer[:end]
+                self.buffer = self.buffer[end + 4:]
+                self._parse_head(head)
+            elif self.state == "body":
+                data = self.buffer[:self.remaining]
+                self.buffer = self.buffer[len(data):]
+                self.body.append(data)
+                self.remaining -= len(data)
+                if self.remaining == 0:
+                    self.complete = True
+                else:
+                    return
+            elif self.state == "close":
+                self.body.append(self.buffer)
+                self.buffer = ""
+                return
+            elif self.state in ["chunk-size", "trailer"]:
+                end = self.buffer.find("\r\n")
+                if end < 0:
+                    return
+                line = self.buffer[:end]
+                self.buffer = self.buffer[end + 2:]
+                if self.state == "trailer":
+                    if not line:
+                        self.complete = True
+                    continue
+                try:
+                    self.remaining = int(line.split(";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise httplib.IncompleteRead("".join(self.body))
+                self.state = self.remaining and "chunk" or "trailer"
+            elif self.state == "chunk":
+                if self.remaining:
+                    data = self.buffer[:self.remaining]
+                    self.buffer = self.buffer[len(data):]
+                    self.body.append(data)
+                    self.remaining -= len(data)
+                    if self.remaining:
+                        return
+                # The CRLF ending the chunk
+                if len(self.buffer) < 2:
+                    return
+                self.buffer = self.buffer[2:]
+                self.state = "chunk-size"
+
+    def feed_eof(self):
+        """The server closed the connection."""
+        if self.state == "close":
+            self.complete = True
+        elif not self.complete:
+            raise httplib.IncompleteRead("".join(self.body))
+
+    def _parse_head(self, head):
+        lines = head.split("\r\n")
+        parts = lines[0].split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise httplib.BadStatusLine(lines[0])
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise httplib.BadStatusLine(lines[0])
+        if 100 <= status < 200:
+            # Interim response, the real one follows
+            return
+        self.status = status
+        self.reason = len(parts) > 2 and parts[2] or ""
+        self.version = parts[0] == "HTTP/1.0" and 10 or 11
+        key = None
+        for line in lines[1:]:
+            if line[:1] in [" ", "\t"] and key:
+                self.headers[key] += " " + line.strip()
+                continue
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key = key.strip().lower()
+            value = value.strip()
+            if key in self.headers:
+                self.headers[key] += ", " + value
+            else:
+                self.headers[key] = value
+
+        connection = self.headers.get("connection", "").lower()
+        self.will_close = "close" in connection or (self.version == 10 and "keep-alive" not in connection)
+        if self.method == "HEAD" or status in [204, 304]:
+            self.complete = True
+        elif "chunked" in self.headers.get("transfer-encoding", "").lower():
+            self.state = "chunk-size"
+        elif "content-length" in self.headers:
+            try:
+                self.remaining = int(self.headers["content-length"])
+            except ValueError:
+                raise httplib.BadStatusLine(lines[0])
+            self.state = "body"
+            self.complete = self.remaining == 0
+        else:
+            self.state = "close"
+            self.will_close = True
+
+    def response(self):
+        response = httplib2.Response(self.headers)
+        response.status = self.status
+        response['status'] = str(self.status)
+        response.reason = self.reason
+        response.version = self.version
+        return response
+
+
+class _Exchange(object):
+    """One request, and what we know about it so far."""
+    def __init__(self, original_uri, uri, method, body, headers, redirections):
+        self.original_uri = original_uri
+        self.uri = uri
+        self.method = method
+        self.body = body
+        self.headers = headers
+        self.redirections = redirections
+        self.previous = None
+        self.retried = False
+        # The cache key this exchange holds in MultiplexFetcher.in_flight
+        self.held = None
+
+
+class _Channel(object):
+    """A non-blocking connection to one scheme:authority."""
+    def __init__(self, key, conn, addresses):
+        self.key = key
+        # The Http connection object, for its settings
+        self.conn = conn
+        self.addresses = addresses
+        self.sock = None
+        self.state = None
+        self.exchange = None
+        self.parser = None
+        self.outgoing = ""
+        self.deadline = None
+        # Whether an earlier exchange completed on this connection
+        self.reused = False
+        # Whether the connection counts against the limits
+        self.counted = True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+
+class MultiplexFetcher(object):
+    """Fetch many URIs concurrently from one thread, on behalf of an
+    Http object whose cache and settings are used."""
+    def __init__(self, http=None, max_active=DEFAULT_MAX_ACTIVE, max_per_host=DEFAULT_MAX_PER_HOST):
+        if http is None:
+            http = httplib2.Http()
+        if http.proxy_info:
+            raise httplib2.ProxiesUnavailableError(
+                'MultiplexFetcher does not support proxies.')
+        self.http = http
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+
+    def fetch(self, requests):
+        """Generator of (uri, response, content) for each of 'requests'."""
+        self.poller = _Poller()
+        self.resolver = _Resolver()
+        self.poller.register(self.resolver.fd, False)
+        # Channels whose host is being resolved
+        self.resolving = set()
+        # Exchanges waiting for a connection, per scheme:authority
+        self.waiting = collections.OrderedDict()
+        # Connections per file descriptor, and per scheme:authority
+        self.channels = {}
+        self.open_count = {}
+        self.idle = {}
+        self.results = collections.deque()
+        # Exchanges waiting for the one in progress for the same cache key,
+        # per cache key: looking the entry up would wait on that one.
+        self.in_flight = {}
+        requests = iter(requests)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and self._waiting_count() < self.max_active:
+                    try:
+                        item = requests.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self._start(self._exchange(item))
+                self._dispatch()
+                while self.results:
+                    yield self.results.popleft()
+                if exhausted and not self._waiting_count() and not self._busy():
+                    break
+                for fd in self.poller.poll(self._poll_timeout()):
+                    if fd == self.resolver.fd:
+                        self._resolved()
+                        continue
+                    channel = self.channels.get(fd)
+                    if channel is not None:
+                        self._service(channel)
+                self._expire()
+                while self.results:
+                    yield self.results.popleft()
+        finally:
+            for channel in self.channels.values():
+                channel.close()
+            self.poller.close()
+            self.resolver.close()
+
+    def _waiting_count(self):
+        return (sum([len(queue) for queue in self.waiting.values()])
+                + sum([len(deferred) for deferred in self.in_flight.values()]))
+
+    def _busy(self):
+        if self.resolving:
+            return True
+        for channel in self.channels.values():
+            if channel.exchange is not None:
+                return True
+        return False
+
+    def _exchange(self, item):
+        uri, method, body, headers = httplib2._request_tuple(item)
+        headers = self.http._prepare_headers(headers)
+        return _Exchange(uri, uri, method, body, headers, httplib2.DEFAULT_MAX_REDIRECTS)
+
+    # Starting an exchange: the cache side of Http.request
+
+    def _start(self, exchange):
+        try:
+            self._lookup(exchange)
+        except Exception, e:
+            self._fail(exchange, e)
+
+    def _lookup(self, exchange):
+        http = self.http
+        headers = exchange.headers
+        (uri, scheme, authority, request_uri, defrag_uri) = httplib2._request_target(exchange.uri)
+        exchange.absolute_uri = uri
+        exchange.scheme = scheme
+        exchange.authority = authority
+        exchange.request_uri = request_uri
+
+        info = httplib2.email.Message.Message()
+        cached_value = None
+        cachekey = None
+        if http.cache:
+            if defrag_uri in self.in_flight:
+                self.in_flight[defrag_uri].append(exchange)
+                return
+            self.in_flight[defrag_uri] = []
+            exchange.held = defrag_uri
+            # Entries written by other processes are not waited for either
+            (info, cached_value, cachekey) = http._cache_lookup(defrag_uri, wait=False)
+        exchange.info = info
+        exchange.cachekey = cachekey
+
+        cached_value = http._usable_entry(exchange.method, headers, info, cached_value, cachekey)
+        (answer, value) = http._cache_answer(exchange.method, headers, info, cached_value, exchange.redirections)
+        if answer == "REDIRECT":
+            previous = httplib2.Response(info)
+            previous.fromcache = True
+            self._redirect(exchange, value, "GET", None, previous)
+            return
+        if answer == "CACHED":
+            (response, content) = value
+            self._complete(exchange, response, content)
+            return
+        exchange.cached_value = value
+        exchange.key = scheme + ":" + authority
+        self.waiting.setdefault(exchange.key, collections.deque()).append(exchange)
+
+    def _redirect(self, exchange, location, method, body, previous):
+        """Follow a redirect with a new exchange."""
+        following = _Exchange(exchange.original_uri, location, method, body,
+                exchange.headers, exchange.redirections - 1)
+        following.previous = previous
+        self._release(exchange)
+        self._start(following)
+
+    def _release(self, exchange):
+        """Start the exchanges that waited for 'exchange' to be done with its cache key."""
+        if exchange.held is None:
+            return
+        deferred = self.in_flight.pop(exchange.held)
+        exchange.held = None
+        # The first one holds the key in turn, the others wait for it
+        for other in deferred:
+            self._start(other)
+
+    # Finishing an exchange: the response side of Http._request and Http.request
+
+    def _finish(self, exchange, parser):
+        http = self.http
+        response = parser.response()
+        content = StringIO.StringIO("".join(parser.body))
+        if exchange.method != "HEAD" and http.decompress_content:
+            content = httplib2._decompressContent(response, content)
+        (response, content, redirect) = http._response_redirect(exchange.absolute_uri, exchange.method,
+                exchange.body, exchange.headers, exchange.redirections, exchange.cachekey, response, content)
+        if redirect is not None:
+            (location, method, body, previous) = redirect
+            self._redirect(exchange, location, method, body, previous)
+            return
+        if exchange.cached_value is not None:
+            (response, content) = http._revalidated(exchange.info, exchange.cached_value, exchange.cachekey,
+                    exchange.method, response, content)
+        self._complete(exchange, response, content)
+
+    def _complete(self, exchange, response, content):
+        if exchange.previous is not None:
+            response.previous = exchange.previous
+        content = httplib2._response_content(response, content, exchange.method)
+        self.results.append((exchange.original_uri, response, content))
+        self._release(exchange)
+
+    def _fail(self, exchange, e):
+        self._release(exchange)
+        if not self.http.force_exception_to_status_code:
+            raise e
+        (response, content) = self.http._exception_response(e)
+        content = httplib2._response_content(response, content, exchange.method)
+        self.results.append((exchange.original_uri, response, content))
+
+    # Connections
+
+    def _dispatch(self):
+        """Hand waiting exchanges to idle or new connections."""
+        for key in self.waiting.keys():
+            queue = self.waiting[key]
+            while queue:
+                idle = self.idle.get(key)
+                if idle:
+                    channel = idle.pop()
+                elif self.open_count.get(key, 0) < self.max_per_host and self._open_total() < self.max_active:
+                    channel = None
+                elif self._open_total() >= self.max_active and self._close_idle():
+                    continue
+                else:
+                    break
+                exchange = queue.popleft()
+                try:
+                    if channel is None:
+                        channel = self._open(exchange)
+                    self._send(channel, exchange)
+                except Exception, e:
+                    self._fail(exchange, e)
+            if not queue:
+                del self.waiting[key]
+
+    def _open_total(self):
+        return len(self.channels) + len(self.resolving)
+
+    def _close_idle(self):
+        """Close one idle connection to make room for another."""
+        for key, idle in self.idle.items():
+            if idle:
+                self._drop(idle.pop())
+                return True
+        return False
+
+    def _open(self, exchange):
+        """A new channel for 'exchange', connecting once its host is resolved."""
+        conn = self.http._new_connection(httplib2.SCHEME_TO_CONNECTION[exchange.scheme], exchange.authority)
+        channel = _Channel(exchange.key, conn, None)
+        self.open_count[channel.key] = self.open_count.get(channel.key, 0) + 1
+        channel.state = "resolving"
+        self.resolving.add(channel)
+        self.resolver.resolve(channel)
+        return channel
+
+    def _resolved(self):
+        """Connect the channels whose host was resolved."""
+        for (channel, result) in self.resolver.results():
+            if channel not in self.resolving:
+                continue
+            self.resolving.discard(channel)
+            try:
+                if isinstance(result, socket.gaierror):
+                    raise httplib2.ServerNotFoundError("Unable to find the server at %s" % channel.conn.host)
+                if isinstance(result, Exception):
+                    raise result
+                channel.addresses = result
+                self._connect(channel)
+            except Exception, e:
+                self._error(channel, e)
+
+    def _connect(self, channel):
+        """Start connecting to the next address of the channel."""
+        family, socktype, proto, canonname, sockaddr = channel.addresses.pop(0)
+        channel.sock = socket.socket(family, socktype, proto)
+        channel.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel.sock.setblocking(0)
+        err = channel.sock.connect_ex(sockaddr)
+        if err not in (0,) + _WOULD_BLOCK:
+            channel.close()
+            if channel.addresses:
+                return self._connect(channel)
+            raise socket.error(err, os.strerror(err))
+        channel.state = "connecting"
+        self.channels[channel.fileno()] = channel
+        self.poller.register(channel.fileno(), True)
+        self._touch(channel)
+
+    def _send(self, channel, exchange):
+        channel.exchange = exchange
+        channel.parser = _ResponseParser(exchange.method)
+        lines = ["%s %s HTTP/1.1" % (exchange.method, exchange.request_uri),
+                 "Host: %s" % exchange.authority]
+        for key, value in exchange.headers.items():
+            lines.append("%s: %s" % (key, value))
+        body = exchange.body
+        if 'content-length' not in exchange.headers:
+            if body is not None:
+                lines.append("Content-Length: %d" % len(body))
+            elif exchange.method in ["POST", "PUT", "PATCH"]:
+                lines.append("Content-Length: 0")
+        channel.outgoing = "\r\n".join(lines) + "\r\n\r\n" + (body or "")
+        if channel.state == "idle":
+            channel.state = "sending"
+            self.poller.register(channel.fileno(), True)
+        self._touch(channel)
+
+    def _touch(self, channel):
+        if httplib2.has_timeout(self.http.timeout):
+            channel.deadline = time.time() + self.http.timeout
+        else:
+            channel.deadline = None
+
+    def _poll_timeout(self):
+        deadlines = [channel.deadline for channel in self.channels.values()
+                     if channel.deadline is not None and channel.exchange is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _expire(self):
+        now = time.time()
+        for channel in self.channels.values():
+            if channel.exchange is not None and channel.deadline is not None and channel.deadline <= now:
+                self._error(channel, socket.timeout("timed out"))
+
+    def _service(self, channel):
+        try:
+            if channel.state == "connecting":
+                err = channel.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    if not channel.addresses:
+                        raise socket.error(err, os.strerror(err))
+                    # Try the next address
+                    self._unregister(channel)
+                    channel.close()
+                    self._connect(channel)
+                    return
+                if channel.exchange.scheme == "https":
+                    self._start_tls(channel)
+                else:
+                    channel.state = "sending"
+            if channel.state == "handshaking":
+                self._handshake(channel)
+            if channel.state == "sending":
+                self._write(channel)
+            elif channel.state == "receiving":
+                self._read(channel)
+            elif channel.state == "idle":
+                # The server closed the connection, or sent garbage
+                self._drop(channel)
+        except Exception, e:
+            self._error(channel, e)
+
+    def _start_tls(self, channel):
+        conn = channel.conn
+        if ssl is None:
+            raise httplib2.CertificateValidationUnsupported(
+                    "HTTPS needs the ssl module.")
+        channel.sock = httplib2._ssl_wrap_socket(channel.sock, conn.key_file, conn.cert_file,
+                conn.disable_ssl_certificate_validation, conn.ca_certs,
+                do_handshake_on_connect=False)
+        channel.state = "handshaking"
+
+    def _handshake(self, channel):
+        try:
+            channel.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.poller.register(channel.fileno(), False)
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.poller.register(channel.fileno(), True)
+                return
+            if e.args[0] == ssl.SSL_ERROR_SSL:
+                raise httplib2.SSLHandshakeError(e)
+            raise
+        conn = channel.conn
+        if not conn.disable_ssl_certificate_validation:
+            hostname = conn.host.split(':', 0)[0]
+            if not httplib2._check_hostname(conn, channel.sock, hostname):
+                cert = channel.sock.getpeercert()
+                raise httplib2.CertificateHostnameMismatch(
+                    'Server presented certificate that does not match '
+                    'host %s: %s' % (hostname, cert), hostname, cert)
+        channel.state = "sending"
+
+    def _write(self, channel):
+        while channel.outgoing:
+            try:
+                sent = channel.sock.send(channel.outgoing)
+            except socket.error, e:
+                if _would_block(e):
+                    self.poller.register(channel.fileno(), _wants_write(e, True))
+                    return
+                raise
+            channel.outgoing = channel.outgoing[sent:]
+            self._touch(channel)
+        channel.state = "receiving"
+        self.poller.register(channel.fileno(), False)
+
+    def _read(self, channel):
+        parser = channel.parser
+        while not parser.complete:
+            try:
+                data = channel.sock.recv(65536)
+            except socket.error, e:
+                if _would_block(e):
+                    self.poller.register(channel.fileno(), _wants_write(e, False))
+                    return
+                raise
+            self._touch(channel)
+            if not data:
+                parser.feed_eof()
+                break
+            parser.feed(data)
+        exchange = channel.exchange
+        channel.exchange = None
+        channel.parser = None
+        if parser.will_close or parser.buffer:
+            self._drop(channel)
+        else:
+            channel.state = "idle"
+            channel.deadline = None
+            channel.reused = True
+            self.idle.setdefault(channel.key, []).append(channel)
+        try:
+            self._finish(exchange, parser)
+        except Exception, e:
+            self._fail(exchange, e)
+
+    def _error(self, channel, e):
+        """The connection failed while serving an exchange."""
+        exchange = channel.exchange
+        parser = channel.parser
+        self._drop(channel)
+        if exchange is None:
+            return
+        if channel.reused and not exchange.retried and (parser is None or not parser.received) \
+                and not isinstance(e, socket.timeout):
+            # A kept-alive connection the server had closed in the meantime
+            exchange.retried = True
+            self.waiting.setdefault(exchange.key, collections.deque()).appendleft(exchange)
+            return
+        self._fail(exchange, e)
+
+    def _unregister(self, channel):
+        if channel.sock is not None:
+            fd = channel.fileno()
+            self.poller.unregister(fd)
+            self.channels.pop(fd, None)
+
+    def _drop(self, channel):
+        """Close a connection for good."""
+        self.resolving.discard(channel)
+        self._unregister(channel)
+        idle = self.idle.get(channel.key, [])
+        if channel in idle:
+            idle.remove(channel)
+        if channel.counted:
+            channel.counted = False
+            self.open_count[channel.key] -= 1
+        channel.close()
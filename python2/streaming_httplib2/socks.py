@@ -56,6 +56,11 @@ PROXY_TYPE_HTTP_NO_TUNNEL = 4
 _defaultproxy = None
 _orgsocket = socket.socket
 
+def gethostbyname(name):
+    """Resolves names that are not resolved by the proxy.
+    streaming_httplib2 replaces it to use its DNS cache."""
+    return socket.gethostbyname(name)
+
 class ProxyError(Exception): pass
 class GeneralProxyError(ProxyError): pass
 class Socks5AuthError(ProxyError): pass
@@ -256,7 +261,7 @@ class socksocket(socket.socket):
                 req = req + chr(0x03).encode() + chr(len(destaddr)).encode() + destaddr
             else:
                 # Resolve locally
-                ipaddr = socket.inet_aton(socket.gethostbyname(destaddr))
+                ipaddr = socket.inet_aton(gethostbyname(destaddr))
                 req = req + chr(0x01).encode() + ipaddr
         req = req + struct.pack(">H", destport)
         self.sendall(req)
@@ -321,7 +326,7 @@ class socksocket(socket.socket):
                 ipaddr = struct.pack("BBBB", 0x00, 0x00, 0x00, 0x01)
                 rmtrslv = True
             else:
-                ipaddr = socket.inet_aton(socket.gethostbyname(destaddr))
+                ipaddr = socket.inet_aton(gethostbyname(destaddr))
         # Construct the request packet
         req = struct.pack(">BBH", 0x04, 0x01, destport) + ipaddr
         # The username parameter is considered userid for SOCKS4
@@ -361,7 +366,7 @@ class socksocket(socket.socket):
         """
         # If we need to resolve locally, we do this now
         if not self.__proxy[3]:
-            addr = socket.gethostbyname(destaddr)
+            addr = gethostbyname(destaddr)
         else:
             addr = destaddr
         headers =  ["CONNECT ", addr, ":", str(destport), " HTTP/1.1\r\n"]
@@ -0,0 +1,172 @@
+"""
+Removes the cache entries that can only be fetched again.
+
+Once it is stale, an entry with an ETag or a Last-Modified header can be
+revalidated, and served again if it did not change. An entry without
+them is fetched again instead, and only takes room until then. A
+Sweeper walks a cache directory and removes these entries once they
+expired, a batch of files at a time, at a limited rate so that it does
+not compete with the reads of the cache. Entries whose expiry is not
+known are left alone, and so are permanent redirects, which are
+followed from the cache whether they expired or not. A Sweeper can run
+in a background thread, sweeping the cache at intervals:
+
+    sweeper = Sweeper(cache_dir)
+    sweeper.start()
+
+or once from the command line, which keeps the cacheindex of the
+directory up to date if it has one:
+
+    python -m streaming_httplib2.sweeper CACHE_DIRECTORY...
+
+It works on FileCache and DistributedFileCache directories, and leaves
+the entries locked by DistributedFileCache processes alone.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import cacheindex
+
+# How many files are examined at a time.
+DEFAULT_BATCH_SIZE = 100
+
+# How many files are examined per second at most.
+DEFAULT_RATE = 500
+
+# How long to wait, in seconds, between two sweeps in the background.
+DEFAULT_INTERVAL = 3600
+
+
+class Sweeper(object):
+    """Removes the expired entries without validators, other than
+    permanent redirects, of the cache directory 'directory', examining
+    'batch_size' files at a time and at most 'rate' files per second.
+    Removed entries are dropped from 'index', the cacheindex.CacheIndex
+    of the cache if it has one.
+
+    In the background, it sweeps the cache every 'interval' seconds.
+    'removed' and 'examined' count the entries removed and the files
+    examined so far.
+    """
+    def __init__(self, directory, batch_size=DEFAULT_BATCH_SIZE, rate=DEFAULT_RATE,
+                 interval=DEFAULT_INTERVAL, index=None):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.rate = rate
+        self.interval = interval
+        self.index = index
+        self.removed = 0
+        self.examined = 0
+        # Where the current sweep is in the directory tree
+        self.walker = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _files(self):
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    # Not a temporary file or the cacheindex
+                    yield os.path.join(dirpath, filename)
+
+    def sweep_batch(self):
+        """Examine the next batch of files. Returns whether the sweep
+        goes on, False once it went through the whole tree: the next
+        batch starts another."""
+        if self.walker is None:
+            self.walker = self._files()
+        now = time.time()
+        for i in range(self.batch_size):
+            try:
+                path = self.walker.next()
+            except StopIteration:
+                self.walker = None
+                return False
+            self.examined += 1
+            if self._sweep(path, now):
+                self.removed += 1
+        return True
+
+    def sweep(self):
+        """Go through the whole tree, at the rate limit."""
+        while not self.stopping.isSet():
+            start = time.time()
+            more = self.sweep_batch()
+            delay = self.batch_size / float(self.rate) - (time.time() - start)
+            if delay > 0:
+                self.stopping.wait(delay)
+            if not more:
+                return
+
+    def _sweep(self, path, now):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                header = cacheformat.read_header(f)
+            except ValueError:
+                # Being created, or not an entry
+                return False
+            headers = dict([(key.lower(), value) for (key, value) in cacheformat.parse(header.text)])
+            if 'etag' in headers or 'last-modified' in headers or '-x-permanent-redirect-url' in headers:
+                return False
+            expires = header.expires
+            if expires is None:
+                expires = httplib2._entry_expiry(headers)
+            if not expires or expires > now or not cacheformat.remove(path, f):
+                # Not known to be expired, still fresh, or in use
+                return False
+        finally:
+            f.close()
+        if self.index is not None:
+            for entry in self.index.query("WHERE path = ?", (os.path.relpath(path, self.directory),)):
+                self.index.remove(entry['key'])
+        return True
+
+    def start(self):
+        """Sweep in a background thread, until stop is called."""
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.isSet():
+            try:
+                self.sweep()
+            except Exception:
+                httplib2.report_error("Error while sweeping cache %s." % self.directory)
+            self.stopping.wait(self.interval)
+
+
+def main(argv):
+    if not argv:
+        sys.stderr.write("usage: python -m streaming_httplib2.sweeper CACHE_DIRECTORY...\n")
+        return 2
+    for directory in argv:
+        index = None
+        if os.path.exists(os.path.join(directory, cacheindex.INDEX_NAME)):
+            index = cacheindex.CacheIndex(directory)
+        sweeper = Sweeper(directory, index=index)
+        sweeper.sweep()
+        if index is not None:
+            index.close()
+        print "%s: %d of %d entries removed" % (directory, sweeper.removed, sweeper.examined)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,7 @@
 import logging
 import os
 import select
+import socket
 import SimpleHTTPServer
 import SocketServer
 import threading
@@ -19,6 +20,17 @@ class ThisDirHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         logger.info(s, *args)
 
 
+class KeepAliveHandler(ThisDirHandler):
+    """Serves this directory over persistent HTTP/1.1 connections,
+    recording the client address of each request in 'clients'."""
+    protocol_version = 'HTTP/1.1'
+    clients = []
+
+    def parse_request(self):
+        self.clients.append(self.client_address)
+        return ThisDirHandler.parse_request(self)
+
+
 class ShutdownServer(SocketServer.TCPServer):
     """Mixin that allows serve_forever to be shut down.
 
@@ -30,7 +42,7 @@ class ShutdownServer(SocketServer.TCPServer):
     def __init__(self, *args, **kwargs):
         SocketServer.TCPServer.__init__(self, *args, **kwargs)
         self.__is_shut_down = threading.Event()
-        self.__serving = False
+        self.__shutdown_request = False
 
     def serve_forever(self, poll_interval=0.1):
         """Handle one request at a time until shutdown.
@@ -39,13 +51,15 @@ class ShutdownServer(SocketServer.TCPServer):
         self.timeout. If you need to do periodic tasks, do them in
         another thread.
         """
-        self.__serving = True
         self.__is_shut_down.clear()
-        while self.__serving:
-            r, w, e = select.select([self.socket], [], [], poll_interval)
-            if r:
-                self._handle_request_noblock()
-        self.__is_shut_down.set()
+        try:
+            while not self.__shutdown_request:
+                r, w, e = select.select([self.socket], [], [], poll_interval)
+                if r:
+                    self._handle_request_noblock()
+        finally:
+            self.__shutdown_request = False
+            self.__is_shut_down.set()
 
     def shutdown(self):
         """Stops the serve_forever loop.
@@ -53,7 +67,7 @@ class ShutdownServer(SocketServer.TCPServer):
         Blocks until the loop has finished. This must be called while
         serve_forever() is running in another thread, or it will deadlock.
         """
-        self.__serving = False
+        self.__shutdown_request = True
         self.__is_shut_down.wait()
 
     def handle_request(self):
@@ -93,8 +107,12 @@ class ShutdownServer(SocketServer.TCPServer):
                 self.close_request(request)
 
 
-def start_server(handler):
-    httpd = ShutdownServer(("", 0), handler)
+class ThreadingShutdownServer(SocketServer.ThreadingMixIn, ShutdownServer):
+    daemon_threads = True
+
+
+def start_server(handler, server_class=ShutdownServer):
+    httpd = server_class(("", 0), handler)
     threading.Thread(target=httpd.serve_forever).start()
     _, port = httpd.socket.getsockname()
     return httpd, port
@@ -0,0 +1,222 @@
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import dcache
+
+from streaming_httplib2.test import miniserver
+
+
+class CountingFile(StringIO.StringIO):
+    def __init__(self, data):
+        StringIO.StringIO.__init__(self, data)
+        self.reads = 0
+
+    def read(self, n=-1):
+        self.reads += 1
+        return StringIO.StringIO.read(self, n)
+
+
+def version0(header, body):
+    return header + "\r\n\r\n" + body
+
+
+def email_date(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(t))
+
+
+class FormatTest(unittest.TestCase):
+    text = "status: 200\ncontent-length: 5\ncache-control: max-age=60\n"
+
+    def testHeaderInOneRead(self):
+        f = CountingFile(cacheformat.pack(self.text, 5, 1234) + "hello")
+        header = cacheformat.read_header(f)
+        self.assertEqual(2, f.reads)
+        self.assertEqual((1, self.text, 5, 1234), (header.version, header.text, header.body_length, header.expires))
+        self.assertEqual("hello", f.read())
+
+    def testPadded(self):
+        size = len(self.text) + cacheformat.LENGTH_RESERVE
+        short = cacheformat.pack("status: 200\n", 0, 0, size)
+        entry = cacheformat.pack(self.text, 5, 0, size)
+        self.assertEqual(len(short), len(entry))
+        header = cacheformat.read_header(StringIO.StringIO(entry + "hello"))
+        self.assertEqual(cacheformat.parse(self.text), cacheformat.parse(header.text))
+        self.assertRaises(ValueError, cacheformat.pack, self.text, 5, 0, len(self.text) - 1)
+
+    def testVersion0(self):
+        f = StringIO.StringIO(version0(self.text, "hello"))
+        header = cacheformat.read_header(f)
+        self.assertEqual((0, self.text, None), (header.version, header.text, header.body_length))
+        self.assertEqual(len(self.text) + 4, header.size)
+        self.assertEqual("hello", f.read())
+
+    def testTinyVersion0(self):
+        f = StringIO.StringIO(version0("status: 200", "hello"))
+        self.assertEqual("status: 200", cacheformat.read_header(f).text)
+        self.assertEqual("hello", f.read())
+
+    def testUnknownVersion(self):
+        entry = cacheformat.pack(self.text, 5)
+        entry = entry[:4] + chr(cacheformat.VERSION + 1) + entry[5:]
+        self.assertRaises(ValueError, cacheformat.read_header, StringIO.StringIO(entry))
+
+    def testTruncated(self):
+        entry = cacheformat.pack(self.text, 5)
+        self.assertRaises(ValueError, cacheformat.read_header, StringIO.StringIO(entry[:10]))
+        self.assertRaises(ValueError, cacheformat.read_header, StringIO.StringIO(entry[:-1]))
+
+    def testExpiry(self):
+        date = 'Sat, 17 Oct 2026 10:00:00 GMT'
+        response = httplib2.Response({'date': date, 'cache-control': 'max-age=60'})
+        self.assertEqual(1792231260, httplib2._entry_expiry(response))
+        response = httplib2.Response({'date': date, 'expires': 'Sat, 17 Oct 2026 11:00:00 GMT'})
+        self.assertEqual(1792234800, httplib2._entry_expiry(response))
+        self.assertEqual(0, httplib2._entry_expiry(httplib2.Response({'date': date})))
+
+
+class EntryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def entry_path(self):
+        return os.path.join(self.cache_dir, httplib2.safename(httplib2.urlnorm(self.url)[-1]))
+
+    def write_version0(self):
+        text = "status: 200\ncontent-length: %d\ndate: %s\ncache-control: max-age=3600\n" % (
+            len(self.expected), email_date(time.time()))
+        f = open(self.entry_path(), 'wb')
+        f.write(version0(text, self.expected))
+        f.close()
+
+    def only_if_cached(self, client):
+        response, content = client.request(self.url, headers={'cache-control': 'only-if-cached'})
+        self.assertTrue(response.fromcache)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+
+
+class EntryTest(EntryTestCase):
+    def testNewEntries(self):
+        client = httplib2.Http(self.cache_dir)
+        response, content = client.request(self.url)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+        f = open(self.entry_path(), 'rb')
+        header = cacheformat.read_header(f)
+        f.close()
+        self.assertEqual(cacheformat.VERSION, header.version)
+        self.assertEqual(len(self.expected), header.body_length)
+        self.only_if_cached(client)
+
+    def testVersion0Entries(self):
+        self.write_version0()
+        self.only_if_cached(httplib2.Http(self.cache_dir))
+
+    def testConvert(self):
+        self.write_version0()
+        self.assertEqual(1, cacheformat.convert_tree(self.cache_dir))
+        self.assertEqual(0, cacheformat.convert_tree(self.cache_dir))
+        f = open(self.entry_path(), 'rb')
+        header = cacheformat.read_header(f)
+        f.close()
+        self.assertEqual(cacheformat.VERSION, header.version)
+        self.assertTrue(header.expires > time.time() + 3000)
+        self.assertEqual([os.path.basename(self.entry_path())], os.listdir(self.cache_dir))
+        self.only_if_cached(httplib2.Http(self.cache_dir))
+
+    def testIncompleteNotConverted(self):
+        self.write_version0()
+        f = open(self.entry_path(), 'ab')
+        f.write("more")
+        f.close()
+        self.assertEqual(0, cacheformat.convert_tree(self.cache_dir))
+
+    def testLockedNotConverted(self):
+        cache = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True)
+        writer = cache.open('key', version0("status: 200\ncontent-length: 0\n", ""))
+        try:
+            self.assertEqual(0, cacheformat.convert_tree(self.cache_dir))
+        finally:
+            writer.abort()
+
+
+
+class MetadataCacheTest(unittest.TestCase):
+    def testLRU(self):
+        cache = cacheformat.MetadataCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+
+
+class MetadataHitTest(EntryTestCase):
+    def setUp(self):
+        EntryTestCase.setUp(self)
+        self.reads = []
+        self.read_header = cacheformat.read_header
+        cacheformat.read_header = self.counted
+        self.parsed = []
+        self.response_freshness = httplib2._response_freshness
+        httplib2._response_freshness = self.counted_freshness
+        httplib2.CACHE_METADATA.clear()
+
+    def tearDown(self):
+        cacheformat.read_header = self.read_header
+        httplib2._response_freshness = self.response_freshness
+        EntryTestCase.tearDown(self)
+
+    def counted(self, fp):
+        self.reads.append(fp)
+        return self.read_header(fp)
+
+    def counted_freshness(self, response_headers):
+        self.parsed.append(response_headers)
+        return self.response_freshness(response_headers)
+
+    def testHeaderReadOnce(self):
+        self.write_version0()
+        client = httplib2.Http(self.cache_dir)
+        for i in range(3):
+            self.only_if_cached(client)
+        self.assertEqual(1, len(self.reads))
+        # Another version of the entry is read again
+        self.expected += "\n"
+        self.write_version0()
+        self.only_if_cached(client)
+        self.assertEqual(2, len(self.reads))
+
+    def testFreshnessParsedOnce(self):
+        self.write_version0()
+        client = httplib2.Http(self.cache_dir)
+        for i in range(3):
+            response, content = client.request(self.url)
+            self.assertTrue(response.fromcache)
+            self.assertEqual(self.expected, content.read())
+            content.close()
+        self.assertEqual(1, len(self.parsed))
+
+    def testPartialNotKept(self):
+        text = "status: 200\ncontent-length: 100\netag: \"x\"\n"
+        f = open(self.entry_path(), 'wb')
+        f.write(version0(text, "partial"))
+        f.close()
+        client = httplib2.Http(self.cache_dir)
+        for i in range(2):
+            self.assertEqual(None, client._cache_lookup(httplib2.urlnorm(self.url)[-1])[1])
+        self.assertEqual(2, len(self.reads))
@@ -0,0 +1,244 @@
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import cacheindex
+from streaming_httplib2 import dcache
+
+from streaming_httplib2.test import miniserver
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, client):
+        response, content = client.request(self.url)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+        return response
+
+    def check_entry(self, cache, path):
+        entry = cache.index.lookup(self.url)
+        self.assertEqual(path, os.path.join(self.cache_dir, entry['path']))
+        self.assertEqual(os.path.getsize(path), entry['size'])
+        self.assertEqual(int(os.stat(os.path.join(miniserver.HERE, 'miniserver.py')).st_mtime),
+                         httplib2.calendar.timegm(httplib2.email.Utils.parsedate_tz(entry['last_modified'])))
+        return entry
+
+    def testFileCache(self):
+        cache = httplib2.FileCache(self.cache_dir, index=True)
+        client = httplib2.Http(cache)
+        self.fetch(client)
+        self.check_entry(cache, os.path.join(self.cache_dir, httplib2.safename(self.url)))
+        self.fetch(client)
+        self.fetch(client)
+        # Read by the last two requests, which rewrote it after revalidating
+        self.assertEqual({'entries': 1, 'size': cache.index.lookup(self.url)['size'], 'hits': 2},
+                         cache.index.stats())
+        cache.delete(self.url)
+        self.assertEqual(None, cache.index.lookup(self.url))
+        self.assertEqual(0, cache.index.stats()['entries'])
+        self.assertEqual([cacheindex.INDEX_NAME], os.listdir(self.cache_dir))
+
+    def testTee(self):
+        cache = httplib2.FileCache(self.cache_dir, tee=True, index=True)
+        client = httplib2.Http(cache)
+        self.fetch(client)
+        self.check_entry(cache, os.path.join(self.cache_dir, httplib2.safename(self.url)))
+
+    def testSharedIndex(self):
+        cache = httplib2.FileCache(self.cache_dir, index=True)
+        self.fetch(httplib2.Http(cache))
+        cache.index.close()
+        other = cacheindex.CacheIndex(self.cache_dir)
+        self.assertEqual(1, other.stats()['entries'])
+        self.assertEqual(1, len(other.query("WHERE etag IS NULL")))
+
+    def testDistributedFileCache(self):
+        cache = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True, index=True)
+        client = httplib2.Http(cache)
+        self.fetch(client)
+        cache.cleanup()
+        entry = self.check_entry(cache, cache.cache_path(self.url))
+        self.assertEqual(0, entry['hits'])
+        self.fetch(client)
+        cache.cleanup()
+        self.assertEqual(1, cache.index.lookup(self.url)['hits'])
+        cache.delete(self.url)
+        self.assertEqual(None, cache.index.lookup(self.url))
+
+
+class TotalsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.index = cacheindex.CacheIndex(self.cache_dir)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.cache_dir)
+
+    def record(self, key, body):
+        path = os.path.join(self.cache_dir, key)
+        f = open(path, 'wb')
+        f.write(cacheformat.pack("status: 200\n", len(body)) + body)
+        f.close()
+        self.index.record(key, path)
+
+    def check(self):
+        stats = self.index.stats()
+        self.assertEqual({'entries': stats['entries'], 'size': stats['size']}, self.index.totals())
+        return stats
+
+    def testKept(self):
+        self.assertEqual({'entries': 0, 'size': 0}, self.index.totals())
+        self.record('a', 'x' * 10)
+        self.record('b', 'x' * 20)
+        self.index.hit('a')
+        # Rewritten, bigger, keeping its reads
+        self.record('a', 'x' * 100)
+        self.assertEqual(2, self.check()['entries'])
+        self.assertEqual(1, self.index.lookup('a')['hits'])
+        self.index.remove('b')
+        self.assertEqual(1, self.check()['entries'])
+
+    def testCountedOnceOpened(self):
+        for key in 'abc':
+            self.record(key, key)
+        # An index written before the totals were kept
+        db = self.index._db()
+        db.executescript("DROP TRIGGER entries_inserted; DROP TRIGGER entries_deleted; "
+                         "DROP TRIGGER entries_resized; DROP TABLE totals;")
+        self.index.close()
+        self.index = cacheindex.CacheIndex(self.cache_dir)
+        self.assertEqual(3, self.check()['entries'])
+        self.record('d', 'd')
+        self.assertEqual(4, self.check()['entries'])
+
+    def testHeaderGiven(self):
+        path = os.path.join(self.cache_dir, 'a')
+        f = open(path, 'wb')
+        f.write('x' * 10)
+        f.close()
+        # Taken as written, not read back from the file
+        self.index.record('a', path, cacheformat.pack('status: 200\netag: "a"\n', 10, 1234))
+        entry = self.index.lookup('a')
+        self.assertEqual(('"a"', 1234, 10), (entry['etag'], entry['expires'], entry['size']))
+
+    def testFlushedOnReads(self):
+        self.record('a', 'a')
+        for i in range(cacheindex.FLUSH_HITS - 1):
+            self.index.hit('a')
+        self.assertEqual(cacheindex.FLUSH_HITS - 1, self.index.pending['a'][0])
+        self.index.hit('a')
+        self.assertEqual({}, self.index.pending)
+        self.assertEqual(cacheindex.FLUSH_HITS, self.index.lookup('a')['hits'])
+
+
+class PathTest(unittest.TestCase):
+    def testIndexed(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        index = cacheindex.CacheIndex(cache_dir)
+        self.addCleanup(index.close)
+        # How the sweeper finds the entries of the files it removes
+        plan = index._db().execute("EXPLAIN QUERY PLAN SELECT * FROM entries WHERE path = ?", ('a',)).fetchall()
+        self.assertTrue('entries_path' in " ".join([str(row[-1]) for row in plan]))
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def store(self, cache, key, body="body"):
+        header = cacheformat.pack("status: 200\ncontent-length: %d\n" % len(body), len(body))
+        if isinstance(cache, dcache.DistributedFileCache):
+            # Locks the file to write
+            self.assertEqual(None, cache.get(key))
+        cache.set(key, header, StringIO.StringIO(body)).close()
+
+    def read(self, cache, key):
+        f = cache.get(key)
+        self.assertTrue(f is not None)
+        f.close()
+
+    def keys(self, cache):
+        return sorted([entry['key'] for entry in cache.index.query()])
+
+    def testMaxEntries(self):
+        cache = httplib2.FileCache(self.cache_dir, max_entries=3)
+        for key in 'abcde':
+            self.store(cache, key)
+        # Evicted down to two entries on the fourth one
+        self.assertEqual(['c', 'd', 'e'], self.keys(cache))
+        self.assertEqual(sorted([httplib2.safename(key) for key in 'cde'] + [cacheindex.INDEX_NAME]),
+                         sorted(os.listdir(self.cache_dir)))
+
+    def testLRU(self):
+        cache = httplib2.FileCache(self.cache_dir, max_entries=3)
+        for key in 'abc':
+            self.store(cache, key)
+        self.read(cache, 'a')
+        self.store(cache, 'd')
+        self.assertEqual(['a', 'd'], self.keys(cache))
+
+    def testLFU(self):
+        cache = httplib2.FileCache(self.cache_dir, max_entries=3, eviction='lfu')
+        for key in 'abc':
+            self.store(cache, key)
+        for key in 'bcbc':
+            self.read(cache, key)
+        self.read(cache, 'a')
+        self.store(cache, 'd')
+        # The read least often, a, then the least recently used of the others
+        self.assertEqual(['c', 'd'], self.keys(cache))
+
+    def testNoFullScan(self):
+        cache = httplib2.FileCache(self.cache_dir, max_entries=3)
+
+        def stats():
+            self.fail("Went through the index")
+        cache.index.stats = stats
+        for key in 'abcde':
+            self.store(cache, key)
+        self.assertEqual(['c', 'd', 'e'], self.keys(cache))
+
+    def testMaxSize(self):
+        cache = httplib2.FileCache(self.cache_dir, max_size=1000)
+        for key in 'abc':
+            self.store(cache, key, "x" * 250)
+        self.assertEqual(['a', 'b', 'c'], self.keys(cache))
+        self.store(cache, 'd', "x" * 250)
+        self.assertEqual(['c', 'd'], self.keys(cache))
+        self.assertTrue(cache.index.stats()['size'] <= 900)
+
+    def testUnknownPolicy(self):
+        self.assertRaises(ValueError, httplib2.FileCache, self.cache_dir, max_entries=3, eviction='random')
+
+    def testLockedEntriesKept(self):
+        cache = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True, max_entries=3)
+        for key in 'abc':
+            self.store(cache, key)
+        # Being read
+        reading = cache.get('a')
+        self.store(cache, 'd')
+        self.assertEqual(['a', 'd'], self.keys(cache))
+        cacheformat.read_header(reading)
+        self.assertEqual('body', reading.read())
+        reading.close()
+        self.assertTrue(os.path.exists(cache.cache_path('a')))
+        self.assertFalse(os.path.exists(cache.cache_path('b')))
@@ -0,0 +1,141 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import dcache
+
+from streaming_httplib2.test import miniserver
+
+
+class FollowTest(unittest.TestCase):
+    key = 'http://example.org/asset'
+    header = 'status: 200\ncontent-length: 10\n\r\n\r\n'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.writing = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True)
+        self.following = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], follow=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def later(self, function):
+        timer = threading.Timer(0.1, function)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def start(self):
+        self.assertEqual(None, self.writing.get(self.key))
+        writer = self.writing.open(self.key, self.header)
+        writer.write('hello')
+        followed = self.following.get(self.key, timeout=5)
+        self.addCleanup(followed.close)
+        self.assertTrue(isinstance(followed, dcache.FollowedFile))
+        self.assertEqual(self.header + 'hello', followed.read(len(self.header) + 5))
+        return (writer, followed)
+
+    def testComplete(self):
+        (writer, followed) = self.start()
+
+        def finish():
+            writer.write('world')
+            writer.commit()
+        self.later(finish)
+        self.assertEqual('world', followed.read())
+        self.assertFalse(followed.in_progress)
+
+    def testAborted(self):
+        (writer, followed) = self.start()
+        self.later(writer.abort)
+        self.assertRaises(IOError, followed.read)
+
+    def testTimeout(self):
+        (writer, followed) = self.start()
+        followed.timeout = 0.1
+        start = time.time()
+        self.assertRaises(IOError, followed.read, 5)
+        self.assertTrue(time.time() - start < 1)
+        writer.abort()
+
+    def unknown_length(self):
+        text = 'status: 200\n'
+        size = len(text) + cacheformat.LENGTH_RESERVE
+        writer = self.writing.open(self.key, cacheformat.pack(text, 0, 0, size))
+        writer.write('hello')
+        followed = self.following.get(self.key, timeout=5)
+        self.addCleanup(followed.close)
+        cacheformat.read_header(followed)
+        self.assertEqual('hello', followed.read(5))
+        return (writer, followed, lambda length: cacheformat.pack(text + 'content-length: %d\n' % length, length, 0, size))
+
+    def testUnknownLength(self):
+        (writer, followed, header) = self.unknown_length()
+
+        def finish():
+            writer.write('world')
+            writer.rewrite(header(10))
+            writer.commit()
+        self.later(finish)
+        self.assertEqual('world', followed.read())
+
+    def testUnknownLengthWriterDied(self):
+        (writer, followed, header) = self.unknown_length()
+
+        def die():
+            # Unlocked without writing the length over the header
+            fcntl.flock(writer.fd, fcntl.LOCK_UN)
+            os.close(writer.fd)
+        self.later(die)
+        self.assertRaises(IOError, followed.read)
+
+    def testFileno(self):
+        (writer, followed) = self.start()
+        content = httplib2.Content(followed)
+        self.assertEqual(followed.fileno(), content.fileno())
+        self.assertTrue(content.in_progress)
+        writer.abort()
+
+    def testNotFollowing(self):
+        self.following.follow = False
+        self.assertEqual(None, self.writing.get(self.key))
+        writer = self.writing.open(self.key, self.header)
+        writer.write('hello')
+        self.later(lambda: (writer.write('world'), writer.commit()))
+        followed = self.following.get(self.key, timeout=5)
+        self.assertEqual(self.header + 'helloworld', followed.read())
+        followed.close()
+
+
+class FollowedRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def client(self):
+        return httplib2.Http(dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True,
+                                                         tee=True, follow=True))
+
+    def testStreamedToWaiter(self):
+        headers = {'cache-control': 'max-age=3600'}
+        response, downloading = self.client().request(self.url, headers=headers)
+        self.assertFalse(response.fromcache)
+        self.assertEqual(self.expected[:100], downloading.read(100))
+        response, following = self.client().request(self.url, headers=headers)
+        self.assertTrue(response.fromcache)
+        self.assertEqual(self.expected[:100], following.read(100))
+        self.assertEqual(self.expected[100:], downloading.read())
+        downloading.close()
+        self.assertEqual(self.expected[100:], following.read())
+        following.close()
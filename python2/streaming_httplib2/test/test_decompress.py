@@ -0,0 +1,241 @@
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import zlib
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+
+from streaming_httplib2.test import miniserver
+
+
+def gzipped(data):
+    out = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+def raw_deflated(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CountingFile(StringIO.StringIO):
+    """Records the size of each read."""
+    def __init__(self, data):
+        StringIO.StringIO.__init__(self, data)
+        self.reads = []
+
+    def read(self, n=-1):
+        data = StringIO.StringIO.read(self, n)
+        self.reads.append(len(data))
+        return data
+
+
+class DecompressTest(unittest.TestCase):
+    data = "".join(["line %d of the body\n" % i for i in range(20000)])
+
+    def decompress(self, body, encoding):
+        response = httplib2.Response({'content-encoding': encoding,
+                                      'content-length': str(len(body))})
+        content = httplib2._decompressContent(response, CountingFile(body))
+        self.assertFalse('content-length' in response)
+        self.assertEqual(encoding, response['-content-encoding'])
+        return content
+
+    def testGzip(self):
+        content = self.decompress(gzipped(self.data), 'gzip')
+        self.assertEqual(self.data[:10], content.read(10))
+        self.assertEqual(self.data[10:], content.read())
+
+    def testConcatenatedMembers(self):
+        content = self.decompress(gzipped("first\n") + gzipped("second\n"), 'gzip')
+        self.assertEqual("first\nsecond\n", content.read())
+
+    def testZlibDeflate(self):
+        content = self.decompress(zlib.compress(self.data), 'deflate')
+        self.assertEqual(self.data, content.read())
+
+    def testRawDeflate(self):
+        content = self.decompress(raw_deflated(self.data), 'deflate')
+        self.assertEqual(self.data, content.read())
+
+    def testBoundedReads(self):
+        # Highly compressible: a few bytes of input make a lot of output
+        data = "x" * (10 * 1024 * 1024)
+        body = gzipped(data)
+        content = self.decompress(body, 'gzip')
+        self.assertEqual(4096, len(content.read(4096)))
+        self.assertTrue(len(content.buffer) <= 64 * 1024)
+        self.assertEqual(len(data) - 4096, len(content.read()))
+        self.assertTrue(max(content.fp.reads) <= httplib2.DECOMPRESS_CHUNK_SIZE)
+
+    def testFailure(self):
+        self.assertRaises(httplib2.FailedToDecompressContent,
+                          self.decompress, "this is not compressed", 'gzip')
+
+    def testTruncated(self):
+        for body in [gzipped(self.data)[:-4], gzipped(self.data)[:-1000],
+                     zlib.compress(self.data)[:-2], raw_deflated(self.data)[:-100]]:
+            encoding = body.startswith("\037\213") and 'gzip' or 'deflate'
+            content = self.decompress(body, encoding)
+            self.assertRaises(httplib2.FailedToDecompressContent, content.read)
+
+    def testTruncatedMember(self):
+        content = self.decompress(gzipped("first\n") + gzipped("second\n")[:-3], 'gzip')
+        self.assertRaises(httplib2.FailedToDecompressContent, content.read)
+
+    def testStacked(self):
+        # deflate applied first, then gzip
+        content = self.decompress(gzipped(zlib.compress(self.data)), 'deflate, gzip')
+        self.assertEqual(self.data, content.read())
+
+    def testStackedNotRecorded(self):
+        # Once read, no wrapper of the chain keeps the body it was sent
+        data = os.urandom(256 * 1024).encode('hex')
+        content = self.decompress(gzipped(zlib.compress(data)), 'deflate, gzip')
+        chunks = []
+        while True:
+            chunk = content.read(8192)
+            if not chunk:
+                break
+            self.assertEqual(None, content.raw)
+            self.assertEqual(None, content.fp.raw)
+            chunks.append(chunk)
+        self.assertEqual(data, "".join(chunks))
+
+    def testNotDecodable(self):
+        response = httplib2.Response({'content-encoding': 'gzip, x-unknown'})
+        body = StringIO.StringIO("data")
+        self.assertTrue(body is httplib2._decompressContent(response, body))
+        self.assertEqual('gzip, x-unknown', response['content-encoding'])
+
+
+class Reversed(object):
+    """A decoder for a made up coding: the body reversed, in one read."""
+    unconsumed_tail = ""
+    unused_data = ""
+
+    def __init__(self):
+        self.data = ""
+
+    def decompress(self, data, max_length=0):
+        self.data += data
+        return ""
+
+    def flush(self):
+        return self.data[::-1]
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.codings = list(httplib2.CONTENT_CODINGS)
+        self.decoders = dict(httplib2.CONTENT_DECODERS)
+
+    def tearDown(self):
+        httplib2.CONTENT_CODINGS[:] = self.codings
+        httplib2.CONTENT_DECODERS.clear()
+        httplib2.CONTENT_DECODERS.update(self.decoders)
+
+    def testRegister(self):
+        httplib2.register_content_decoder('x-reversed', Reversed)
+        self.assertEqual(', '.join(self.codings + ['x-reversed']), httplib2._accept_encoding())
+        response = httplib2.Response({'content-encoding': 'x-reversed, gzip'})
+        content = httplib2._decompressContent(response, StringIO.StringIO(gzipped("olleh")))
+        self.assertEqual("hello", content.read())
+
+    def testOptionalCodecs(self):
+        self.assertEqual(httplib2.brotli is not None, 'br' in httplib2.CONTENT_DECODERS)
+        self.assertEqual(httplib2.zstandard is not None, 'zstd' in httplib2.CONTENT_DECODERS)
+
+
+class GzipHandler(miniserver.ThisDirHandler):
+    """Serves files gzipped, with chunked transfer encoding, cut short
+    with a 'truncated' query."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = gzipped(open(self.translate_path(self.path)).read())
+        if self.path.endswith('?truncated'):
+            body = body[:-10]
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        for i in range(0, len(body), 1000):
+            chunk = body[i:i + 1000]
+            self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write("0\r\n\r\n")
+
+
+class CachedDecompressTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(GzipHandler)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def testCachedWithLength(self):
+        client = httplib2.Http(self.cache_dir)
+        url = 'http://localhost:%d/miniserver.py' % self.port
+        expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+        response, content = client.request(url)
+        # Written to the cache as it is read, its length known at the end
+        self.assertFalse('content-length' in response)
+        self.assertEqual(expected, content.read())
+        content.close()
+        response, content = client.request(url)
+        self.assertTrue(response.fromcache)
+        self.assertEqual(str(len(expected)), response['content-length'])
+        self.assertEqual(expected, content.read())
+        content.close()
+
+    def testTruncatedNotCached(self):
+        client = httplib2.Http(self.cache_dir)
+        url = 'http://localhost:%d/miniserver.py?truncated' % self.port
+        response, content = client.request(url)
+        try:
+            self.assertRaises(httplib2.FailedToDecompressContent, content.read)
+        finally:
+            content.close()
+        response, content = client.request(url, headers={'cache-control': 'only-if-cached'})
+        self.assertEqual(504, response.status)
+        content.close()
+
+    def testStoredCompressed(self):
+        client = httplib2.Http(httplib2.FileCache(self.cache_dir, store_compressed=True))
+        url = 'http://localhost:%d/miniserver.py' % self.port
+        expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+        response, content = client.request(url)
+        self.assertEqual(expected, content.read())
+        content.close()
+        stored = open(os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0]), 'rb')
+        header = cacheformat.read_header(stored)
+        self.assertTrue('-x-stored-encoding: gzip' in header.text)
+        self.assertEqual(expected, gzip.GzipFile(fileobj=stored).read())
+        stored.close()
+        response, content = client.request(url)
+        self.assertTrue(response.fromcache)
+        self.assertEqual('gzip', response['-content-encoding'])
+        self.assertEqual(expected, content.read())
+
+    def testCompressedStreamHandedOver(self):
+        client = httplib2.Http(httplib2.FileCache(self.cache_dir, store_compressed=True))
+        client.decompress_content = False
+        url = 'http://localhost:%d/miniserver.py' % self.port
+        expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+        for i in range(2):
+            response, content = client.request(url)
+            self.assertEqual(i == 1, response.fromcache)
+            self.assertEqual('gzip', response['content-encoding'])
+            body = content.read()
+            content.close()
+            self.assertEqual(expected, gzip.GzipFile(fileobj=StringIO.StringIO(body)).read())
@@ -0,0 +1,170 @@
+import socket
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import dnscache
+from streaming_httplib2.test import miniserver
+
+
+class FakeResolver(object):
+    def __init__(self):
+        self.calls = []
+        self.error = None
+
+    def __call__(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        self.calls.append(host)
+        if self.error is not None:
+            raise socket.gaierror(self.error, 'failed')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.%d' % len(self.calls), port))]
+
+
+class DNSCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = FakeResolver()
+
+    def testCached(self):
+        cache = dnscache.DNSCache(resolver=self.resolver)
+        first = cache.getaddrinfo('example.org', 80)
+        self.assertEqual(first, cache.getaddrinfo('example.org', 80))
+        self.assertEqual(['example.org'], self.resolver.calls)
+        # Other arguments are other entries
+        cache.getaddrinfo('example.org', 80, socket.AF_INET)
+        self.assertEqual(2, len(self.resolver.calls))
+
+    def testExpires(self):
+        cache = dnscache.DNSCache(ttl=0.05, resolver=self.resolver)
+        cache.getaddrinfo('example.org', 80)
+        time.sleep(0.1)
+        self.assertEqual('127.0.0.2', cache.getaddrinfo('example.org', 80)[0][4][0])
+
+    def testNegative(self):
+        cache = dnscache.DNSCache(resolver=self.resolver)
+        self.resolver.error = socket.EAI_NONAME
+        self.assertRaises(socket.gaierror, cache.getaddrinfo, 'nowhere.example.org', 80)
+        self.assertRaises(socket.gaierror, cache.getaddrinfo, 'nowhere.example.org', 80)
+        self.assertEqual(1, len(self.resolver.calls))
+
+    def testTemporaryFailureNotCached(self):
+        cache = dnscache.DNSCache(resolver=self.resolver)
+        self.resolver.error = socket.EAI_AGAIN
+        self.assertRaises(socket.gaierror, cache.getaddrinfo, 'example.org', 80)
+        self.resolver.error = None
+        cache.getaddrinfo('example.org', 80)
+        self.assertEqual(2, len(self.resolver.calls))
+
+    def testInvalidate(self):
+        cache = dnscache.DNSCache(resolver=self.resolver)
+        cache.getaddrinfo('example.org', 80)
+        cache.invalidate('example.org')
+        cache.getaddrinfo('example.org', 80)
+        self.assertEqual(2, len(self.resolver.calls))
+
+    def testRefresh(self):
+        cache = dnscache.DNSCache(ttl=0.2, refresh=True, resolver=self.resolver)
+        cache.getaddrinfo('example.org', 80)
+        time.sleep(0.17)
+        # Still the entry in cache, while it is resolved again
+        self.assertEqual('127.0.0.1', cache.getaddrinfo('example.org', 80)[0][4][0])
+        time.sleep(0.05)
+        self.assertEqual('127.0.0.2', cache.getaddrinfo('example.org', 80)[0][4][0])
+        self.assertEqual(2, len(self.resolver.calls))
+
+
+class HttpResolutionTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = FakeResolver()
+        self.old_cache = httplib2.DNS_CACHE
+        httplib2.DNS_CACHE = dnscache.DNSCache(resolver=self.resolver)
+
+    def tearDown(self):
+        httplib2.DNS_CACHE = self.old_cache
+
+    def testConnectionsUseCache(self):
+        self.resolver.error = socket.EAI_NONAME
+        client = httplib2.Http()
+        for i in range(2):
+            self.assertRaises(httplib2.ServerNotFoundError,
+                    client.request, 'http://nowhere.example.org/')
+        self.assertEqual(['nowhere.example.org'], self.resolver.calls)
+
+    def testSocksResolution(self):
+        self.assertEqual('127.0.0.1', httplib2.socks.gethostbyname('example.org'))
+        self.assertEqual('127.0.0.1', httplib2.socks.gethostbyname('example.org'))
+        self.assertEqual(1, len(self.resolver.calls))
+
+
+class RacedConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.old_cache = httplib2.DNS_CACHE
+        self.addresses = []
+        httplib2.DNS_CACHE = dnscache.DNSCache(resolver=lambda *args: self.addresses)
+        httplib2._connected_families.clear()
+
+    def tearDown(self):
+        httplib2.DNS_CACHE = self.old_cache
+        httplib2._connected_families.clear()
+        self.httpd.shutdown()
+
+    def address(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))
+
+    def blackhole(self):
+        """A port connections to hang on: its accept queue is full."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        port = listener.getsockname()[1]
+        socks = [listener]
+        for i in range(3):
+            sock = socket.socket()
+            sock.setblocking(0)
+            sock.connect_ex(('127.0.0.1', port))
+            socks.append(sock)
+        for sock in socks:
+            self.addCleanup(sock.close)
+        return port
+
+    def testDeadAddressIsRaced(self):
+        self.addresses = [self.address(self.blackhole()), self.address(self.port)]
+        client = httplib2.Http(timeout=5)
+        start = time.time()
+        response, content = client.request('http://example.org:%d/miniserver.py' % self.port)
+        self.assertEqual(200, response.status)
+        self.assertTrue(time.time() - start < 2)
+
+    def testAllAddressesFail(self):
+        # A port nothing listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.addresses = [self.address(port)]
+        self.assertRaises(socket.error, httplib2._create_connection, 'example.org', port, 5)
+
+    def testFamiliesBounded(self):
+        self.addresses = [self.address(self.port)]
+        old_max = httplib2.MAX_CONNECTED_FAMILIES
+        httplib2.MAX_CONNECTED_FAMILIES = 2
+        try:
+            for host in ['a.example.org', 'b.example.org', 'c.example.org']:
+                httplib2._create_connection(host, self.port, 5).close()
+                self.assertTrue(len(httplib2._connected_families) <= 2)
+            self.assertEqual(socket.AF_INET, httplib2._connected_families['c.example.org'])
+        finally:
+            httplib2.MAX_CONNECTED_FAMILIES = old_max
+
+    def testFamilyRemembered(self):
+        v6 = (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', self.port, 0, 0))
+        self.addresses = [v6, self.address(self.port)]
+        sock = httplib2._create_connection('example.org', self.port, 5)
+        sock.close()
+        self.assertEqual(socket.AF_INET, httplib2._connected_families['example.org'])
+        # Next time, the IPv4 address is tried first
+        self.addresses = [v6, self.address(self.port)]
+        start = time.time()
+        sock = httplib2._create_connection('example.org', self.port, 5)
+        self.assertTrue(time.time() - start < httplib2.CONNECT_ATTEMPT_DELAY)
+        self.assertEqual(socket.AF_INET, sock.family)
+        sock.close()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import dcache
+from streaming_httplib2 import dnscache
+from streaming_httplib2 import multiplex
+
+from streaming_httplib2.test import miniserver
+
+
+class MultiplexFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = None
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+        shutil.rmtree(self.cachedir)
+
+    def serve(self, handler, server_class=miniserver.ShutdownServer):
+        self.httpd, self.port = miniserver.start_server(handler, server_class)
+
+    def url(self, path):
+        return 'http://localhost:%d/%s' % (self.port, path)
+
+    def expected(self, path):
+        return open(os.path.join(miniserver.HERE, path)).read()
+
+    def testFetch(self):
+        self.serve(miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+        del miniserver.KeepAliveHandler.clients[:]
+        names = ['miniserver.py', 'smoke_test.py', 'test_no_socket.py'] * 4
+        fetcher = multiplex.MultiplexFetcher(httplib2.Http(self.cachedir), max_per_host=3)
+        results = list(fetcher.fetch([self.url(name) for name in names]))
+        self.assertEqual(len(names), len(results))
+        for uri, response, content in results:
+            self.assertEqual(200, response.status)
+            self.assertEqual(self.expected(uri.split('/')[-1]), content.read())
+        # Connections were kept alive and reused
+        self.assertTrue(len(set(miniserver.KeepAliveHandler.clients)) <= 3)
+        self.assertEqual(3, len(os.listdir(self.cachedir)))
+
+    def testRedirectAndErrors(self):
+        # SimpleHTTPServer redirects without a body or Content-Length,
+        # which only works when the connection is closed after it.
+        self.serve(miniserver.ThisDirHandler)
+        http = httplib2.Http()
+        http.force_exception_to_status_code = True
+        fetcher = multiplex.MultiplexFetcher(http)
+        results = dict([(uri, (response, content)) for uri, response, content in fetcher.fetch([
+            self.url('brokensocket'),
+            (self.url('missing'), 'HEAD'),
+            'http://localhost:1/'])])
+        response, content = results[self.url('brokensocket')]
+        self.assertEqual(200, response.status)
+        self.assertEqual(301, response.previous.status)
+        self.assertTrue('socket.py' in content.read())
+        self.assertEqual(404, results[self.url('missing')][0].status)
+        self.assertEqual(400, results['http://localhost:1/'][0].status)
+
+    def testSlowResolution(self):
+        self.serve(miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+
+        def resolve(host, port, *args):
+            if host == 'slow.example.org':
+                time.sleep(0.5)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+        old_cache = httplib2.DNS_CACHE
+        httplib2.DNS_CACHE = dnscache.DNSCache(resolver=resolve)
+        try:
+            fetcher = multiplex.MultiplexFetcher(httplib2.Http())
+            slow = 'http://slow.example.org:%d/miniserver.py' % self.port
+            fast = self.url('smoke_test.py')
+            results = []
+            start = time.time()
+            for uri, response, content in fetcher.fetch([slow, fast]):
+                results.append((uri, time.time() - start))
+                self.assertEqual(200, response.status)
+        finally:
+            httplib2.DNS_CACHE = old_cache
+        # The loop went on with the other request in the meantime
+        self.assertEqual([fast, slow], [uri for uri, elapsed in results])
+        self.assertTrue(results[0][1] < 0.4)
+
+    def testErrorsRaise(self):
+        fetcher = multiplex.MultiplexFetcher(httplib2.Http())
+        self.assertRaises(httplib2.socket.error, list, fetcher.fetch(['http://localhost:1/']))
+
+    def testSameEntryWithDistributedCache(self):
+        self.serve(miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+        cache = dcache.DistributedFileCache(self.cachedir, path_schema=[(0, 1)], create=True)
+        fetcher = multiplex.MultiplexFetcher(httplib2.Http(cache))
+        start = time.time()
+        request = (self.url('miniserver.py'), 'GET', None, {'cache-control': 'max-age=3600'})
+        results = list(fetcher.fetch([request] * 3))
+        # The others waited for the first one, not for its lock
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([False, True, True], [response.fromcache for uri, response, content in results])
+        for uri, response, content in results:
+            self.assertEqual(self.expected('miniserver.py'), content.read())
+            content.close()
+
+    def testEntryBeingWrittenIsAMiss(self):
+        self.serve(miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+        # Another process writing the entry
+        writer = dcache.DistributedFileCache(self.cachedir, path_schema=[(0, 1)], create=True)
+        self.assertEqual(None, writer.get(self.url('miniserver.py')))
+        cache = dcache.DistributedFileCache(self.cachedir, path_schema=[(0, 1)])
+        fetcher = multiplex.MultiplexFetcher(httplib2.Http(cache))
+        start = time.time()
+        [(uri, response, content)] = list(fetcher.fetch([self.url('miniserver.py')]))
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(response.fromcache)
+        self.assertEqual(self.expected('miniserver.py'), content.read())
+        # Not cached over the other writer's file
+        self.assertEqual(0, os.path.getsize(writer.cache_path(self.url('miniserver.py'))))
+        writer.cleanup()
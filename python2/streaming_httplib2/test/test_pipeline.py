@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import streaming_httplib2 as httplib2
+
+from streaming_httplib2.test import miniserver
+
+
+class ClosingHandler(miniserver.KeepAliveHandler):
+    """Closes each connection after answering two requests on it."""
+    def handle(self):
+        self.answered = 0
+        miniserver.KeepAliveHandler.handle(self)
+
+    def handle_one_request(self):
+        miniserver.KeepAliveHandler.handle_one_request(self)
+        self.answered += 1
+        if self.answered >= 2:
+            self.close_connection = 1
+
+
+class PipelineTest(unittest.TestCase):
+    srcs = ['miniserver.py', 'test_pool.py', '__init__.py', 'test_pipeline.py']
+
+    def setUp(self):
+        del miniserver.KeepAliveHandler.clients[:]
+        self.client = httplib2.Http()
+        self.servers = []
+
+    def tearDown(self):
+        self.client.connections.clear()
+        for httpd in self.servers:
+            httpd.shutdown()
+
+    def serve(self, handler):
+        httpd, port = miniserver.start_server(handler, miniserver.ThreadingShutdownServer)
+        self.servers.append(httpd)
+        return ['http://localhost:%d/%s' % (port, src) for src in self.srcs]
+
+    def expected(self, uri):
+        return open(os.path.join(miniserver.HERE, uri.rsplit('/', 1)[1])).read()
+
+    def testPipeline(self):
+        urls = self.serve(miniserver.KeepAliveHandler)
+        results = list(self.client.pipeline(urls))
+        self.assertEqual(urls, [uri for uri, response, content in results])
+        # Contents read once all responses are in were buffered
+        for uri, response, content in results:
+            self.assertEqual(200, response.status)
+            self.assertEqual(self.expected(uri), content.read())
+        self.assertEqual(1, len(set(miniserver.KeepAliveHandler.clients)))
+        self.assertEqual(1, len(self.client.connections.values()))
+
+    def testServerClosesConnection(self):
+        urls = self.serve(ClosingHandler) * 2
+        results = []
+        for uri, response, content in self.client.pipeline(urls, depth=3):
+            results.append(uri)
+            self.assertEqual(self.expected(uri), content.read())
+        self.assertEqual(urls, results)
+        self.assertEqual(4, len(set(miniserver.KeepAliveHandler.clients)))
+
+    def testOneRequestPerConnection(self):
+        urls = self.serve(miniserver.ThisDirHandler)
+        results = []
+        for uri, response, content in self.client.pipeline(urls):
+            results.append(uri)
+            self.assertEqual(self.expected(uri), content.read())
+        self.assertEqual(urls, results)
+
+    def testCache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.client = httplib2.Http(cache_dir)
+        urls = self.serve(miniserver.KeepAliveHandler)
+        for uri, response, content in self.client.pipeline(urls):
+            self.assertEqual(200, response.status)
+            self.assertEqual(self.expected(uri), content.read())
+        self.assertEqual(len(urls), len(os.listdir(cache_dir)))
+        # Stale entries are revalidated in the same way
+        for uri, response, content in self.client.pipeline(urls):
+            self.assertEqual(self.expected(uri), content.read())
+        self.assertEqual(len(urls), len(os.listdir(cache_dir)))
+
+    def testOnlyIfCached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.client = httplib2.Http(cache_dir)
+        urls = self.serve(miniserver.KeepAliveHandler)
+        for uri, response, content in self.client.pipeline(urls[:2]):
+            content.read()
+        clients = len(miniserver.KeepAliveHandler.clients)
+        headers = {'cache-control': 'only-if-cached'}
+        results = list(self.client.pipeline([(uri, 'GET', None, headers) for uri in urls[:3]]))
+        self.assertEqual([True, True, False], [response.fromcache for uri, response, content in results])
+        self.assertEqual([200, 200, 504], [response.status for uri, response, content in results])
+        self.assertEqual(self.expected(urls[0]), results[0][2].read())
+        self.assertEqual(clients, len(miniserver.KeepAliveHandler.clients))
+
+    def testErrors(self):
+        self.client.force_exception_to_status_code = True
+        results = list(self.client.pipeline(['http://localhost:1/', 'http://localhost:1/x']))
+        self.assertEqual([400, 400], [response.status for uri, response, content in results])
+        self.client.force_exception_to_status_code = False
+        self.assertRaises(Exception, list, self.client.pipeline(['http://localhost:1/']))
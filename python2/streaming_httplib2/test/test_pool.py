@@ -0,0 +1,277 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+
+from streaming_httplib2.test import miniserver
+
+
+class _Connection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def testReuse(self):
+        pool = httplib2.ConnectionPool(maxsize=2)
+        conn = pool.get("http:example.org", _Connection)
+        pool.put("http:example.org", conn)
+        self.assertTrue(pool.get("http:example.org", _Connection) is conn)
+        self.assertTrue("http:example.org" in pool)
+        self.assertTrue(pool["http:example.org"] is conn)
+        self.assertEqual([conn], pool.values())
+
+    def testFullPoolFails(self):
+        pool = httplib2.ConnectionPool(maxsize=1, block=False)
+        pool.get("http:example.org", _Connection)
+        self.assertRaises(httplib2.PoolFullError,
+                pool.get, "http:example.org", _Connection)
+        # Other hosts have their own limit
+        pool.get("http:example.com", _Connection)
+
+    def testFullPoolTimesOut(self):
+        pool = httplib2.ConnectionPool(maxsize=1, timeout=0.1)
+        pool.get("http:example.org", _Connection)
+        start = time.time()
+        self.assertRaises(httplib2.PoolFullError,
+                pool.get, "http:example.org", _Connection)
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def testFullPoolWaits(self):
+        pool = httplib2.ConnectionPool(maxsize=1)
+        conn = pool.get("http:example.org", _Connection)
+        timer = threading.Timer(0.1, pool.put, ("http:example.org", conn))
+        timer.start()
+        self.assertTrue(pool.get("http:example.org", _Connection) is conn)
+
+    def testDiscard(self):
+        pool = httplib2.ConnectionPool(maxsize=1, block=False)
+        conn = pool.get("http:example.org", _Connection)
+        pool.discard("http:example.org", conn)
+        self.assertTrue(conn.closed)
+        self.assertFalse(pool.get("http:example.org", _Connection) is conn)
+
+
+class _SocketConnection(object):
+    """A connection whose socket is one end of a socket pair."""
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+
+class _Descriptor(object):
+    """A socket that is only a file descriptor."""
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        pass
+
+
+class StaleConnectionTest(unittest.TestCase):
+    def testLiveConnectionKept(self):
+        pool = httplib2.ConnectionPool()
+        conn = pool.get("http:example.org", _SocketConnection)
+        sock = conn.sock
+        pool.put("http:example.org", conn)
+        self.assertTrue(pool.get("http:example.org", _SocketConnection).sock is sock)
+
+    def testClosedByServer(self):
+        pool = httplib2.ConnectionPool()
+        conn = pool.get("http:example.org", _SocketConnection)
+        pool.put("http:example.org", conn)
+        conn.peer.close()
+        self.assertTrue(pool.get("http:example.org", _SocketConnection) is conn)
+        self.assertTrue(conn.sock is None)
+
+    def testHighDescriptor(self):
+        # select can't take descriptors from FD_SETSIZE (1024) on
+        conn = _SocketConnection()
+        try:
+            os.dup2(conn.sock.fileno(), 1500)
+        except OSError:
+            return
+        conn.sock.close()
+        conn.sock = _Descriptor(1500)
+        try:
+            pool = httplib2.ConnectionPool()
+            pool.put("http:example.org", pool.get("http:example.org", lambda: conn))
+            self.assertTrue(pool.get("http:example.org", _SocketConnection) is conn)
+            self.assertTrue(conn.sock is not None)
+        finally:
+            os.close(1500)
+
+    def testIdleTimeout(self):
+        pool = httplib2.ConnectionPool(idle_timeout=0.05)
+        conn = pool.get("http:example.org", _SocketConnection)
+        pool.put("http:example.org", conn)
+        time.sleep(0.1)
+        pool.get("http:example.org", _SocketConnection)
+        self.assertTrue(conn.sock is None)
+
+    def testMaxLifetime(self):
+        pool = httplib2.ConnectionPool(max_lifetime=0.1)
+        conn = pool.get("http:example.org", _SocketConnection)
+        for i in range(3):
+            pool.put("http:example.org", conn)
+            time.sleep(0.04)
+            self.assertTrue(pool.get("http:example.org", _SocketConnection) is conn)
+        self.assertTrue(conn.sock is None)
+
+    def testReaper(self):
+        pool = httplib2.ConnectionPool(idle_timeout=0.05, reap_interval=0.02)
+        conn = pool.get("http:example.org", _SocketConnection)
+        pool.put("http:example.org", conn)
+        time.sleep(0.2)
+        self.assertTrue(conn.sock is None)
+        self.assertEqual([], pool.values())
+
+
+class SharedHttpTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(
+            miniserver.ThisDirHandler)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+
+    def testThreadsShareOneClient(self):
+        client = httplib2.Http()
+        client.connections = httplib2.ConnectionPool(maxsize=2)
+        src = 'miniserver.py'
+        url = 'http://localhost:%d/%s' % (self.port, src)
+        expected = open(os.path.join(miniserver.HERE, src)).read()
+        bodies = []
+
+        def fetch():
+            for i in range(5):
+                response, content = client.request(url)
+                bodies.append(content.read())
+
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([expected] * 20, bodies)
+        self.assertTrue(len(client.connections.values()) <= 2)
+
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(
+            miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+        del miniserver.KeepAliveHandler.clients[:]
+        self.client = httplib2.Http()
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+
+    def tearDown(self):
+        self.client.connections.clear()
+        self.httpd.shutdown()
+
+    def clients(self):
+        return set(miniserver.KeepAliveHandler.clients)
+
+    def testReadBodyReleasesConnection(self):
+        for i in range(3):
+            response, content = self.client.request(self.url)
+            self.assertEqual(self.expected, content.read())
+        self.assertEqual(1, len(self.clients()))
+        self.assertEqual(1, len(self.client.connections.values()))
+
+    def testUnreadBodyHoldsConnection(self):
+        response, first = self.client.request(self.url)
+        response, second = self.client.request(self.url)
+        # The first body was not read, so a second connection was used
+        self.assertEqual(2, len(self.client.connections.values()))
+        self.assertEqual(self.expected, second.read())
+        self.assertEqual(self.expected, first.read())
+        self.assertEqual(2, len(self.clients()))
+
+    def testCloseDrainsSmallBody(self):
+        response, content = self.client.request(self.url)
+        content.read(10)
+        content.close()
+        response, content = self.client.request(self.url)
+        self.assertEqual(self.expected, content.read())
+        self.assertEqual(1, len(self.clients()))
+
+    def testCloseDiscardsLargeBody(self):
+        self.addCleanup(setattr, httplib2, 'MAX_DRAIN_SIZE', httplib2.MAX_DRAIN_SIZE)
+        httplib2.MAX_DRAIN_SIZE = 10
+        response, content = self.client.request(self.url)
+        content.close()
+        self.assertEqual("", content.read())
+        response, content = self.client.request(self.url)
+        self.assertEqual(self.expected, content.read())
+        self.assertEqual(2, len(self.clients()))
+        self.assertEqual(1, len(self.client.connections.values()))
+
+    def testDroppedBodyReleasesConnection(self):
+        self.client.connections = httplib2.ConnectionPool(maxsize=1, block=False)
+        for i in range(3):
+            response, content = self.client.request(self.url)
+            del content
+        self.assertEqual(1, len(self.client.connections.values()))
+
+
+class FetchAllTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(
+            miniserver.KeepAliveHandler, miniserver.ThreadingShutdownServer)
+        self.client = httplib2.Http()
+
+    def tearDown(self):
+        self.client.connections.clear()
+        self.httpd.shutdown()
+
+    def testFetchAll(self):
+        srcs = ['miniserver.py', 'test_pool.py', '__init__.py'] * 4
+        urls = ['http://localhost:%d/%s' % (self.port, src) for src in srcs]
+        fetched = []
+        for uri, response, content in self.client.fetch_all(urls, workers=4, per_host=2):
+            self.assertEqual(200, response.status)
+            src = uri.rsplit('/', 1)[1]
+            self.assertEqual(open(os.path.join(miniserver.HERE, src)).read(), content.read())
+            fetched.append(uri)
+        self.assertEqual(sorted(urls), sorted(fetched))
+        self.assertTrue(len(self.client.connections.values()) <= 2)
+
+    def testConcurrentCacheWrites(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.client = httplib2.Http(cache_dir)
+        url = 'http://localhost:%d/test_pool.py' % self.port
+        expected = open(os.path.join(miniserver.HERE, 'test_pool.py')).read()
+        # Stale entries, written again by each request while others read them
+        for uri, response, content in self.client.fetch_all([url] * 40, workers=8, per_host=8):
+            self.assertEqual(200, response.status)
+            self.assertEqual(expected, content.read())
+            content.close()
+        self.assertEqual([httplib2.safename(url)], os.listdir(cache_dir))
+
+    def testErrorsRaise(self):
+        results = self.client.fetch_all([('http://localhost:1/', 'HEAD')])
+        self.assertRaises(socket.error, list, results)
+
+    def testErrorsToStatusCode(self):
+        self.client.force_exception_to_status_code = True
+        results = list(self.client.fetch_all([('http://localhost:1/', 'HEAD')]))
+        self.assertEqual(1, len(results))
+        self.assertEqual(400, results[0][1].status)
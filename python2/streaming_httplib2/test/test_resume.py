@@ -0,0 +1,189 @@
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import dcache
+
+from streaming_httplib2.test import miniserver
+
+
+def gzipped(data):
+    out = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class RangeHandler(miniserver.KeepAliveHandler):
+    """Serves 'body' with an ETag, answering Range requests whose If-Range
+    matches it. While 'cut' is set, bodies stop after that many bytes.
+    With 'gzip_ranges' set, ranges are sent gzipped whatever was asked."""
+    body = "".join(["line %d of the body\n" % i for i in range(2000)])
+    etag = '"v1"'
+    cut = None
+    gzip_ranges = False
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        start = 0
+        if 'range' in self.headers and self.headers.get('if-range') == self.etag:
+            start = int(self.headers['range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        body = self.body[start:]
+        if start and self.gzip_ranges:
+            body = gzipped(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.cut is not None:
+            self.wfile.write(body[:self.cut])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        RangeHandler.cut = None
+        RangeHandler.etag = '"v1"'
+        RangeHandler.gzip_ranges = False
+        del RangeHandler.requests[:]
+        self.httpd, self.port = miniserver.start_server(RangeHandler, miniserver.ThreadingShutdownServer)
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'http://localhost:%d/big' % self.port
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def cache(self):
+        return httplib2.FileCache(self.cache_dir, tee=True)
+
+    def request(self):
+        client = httplib2.Http(self.cache())
+        response, content = client.request(self.url, headers={'cache-control': 'no-cache'})
+        data = content.read()
+        content.close()
+        return (response, data)
+
+    def interrupted(self):
+        RangeHandler.cut = 1000
+        client = httplib2.Http(self.cache())
+        response, content = client.request(self.url)
+        self.assertRaises(httplib2.httplib.IncompleteRead, content.read)
+        content.close()
+        RangeHandler.cut = None
+
+    def testResumed(self):
+        self.interrupted()
+        response, data = self.request()
+        self.assertEqual(200, response.status)
+        self.assertEqual(RangeHandler.body, data)
+        self.assertEqual('bytes=1000-', RangeHandler.requests[-1]['range'])
+        self.assertEqual('"v1"', RangeHandler.requests[-1]['if-range'])
+        # Now complete
+        client = httplib2.Http(self.cache())
+        response, content = client.request(self.url, headers={'cache-control': 'max-age=3600'})
+        self.assertTrue(response.fromcache)
+        self.assertEqual(RangeHandler.body, content.read())
+        content.close()
+
+    def testChanged(self):
+        self.interrupted()
+        RangeHandler.etag = '"v2"'
+        response, data = self.request()
+        self.assertEqual(200, response.status)
+        self.assertEqual(RangeHandler.body, data)
+        self.assertFalse('range' in RangeHandler.requests[-1] and
+                         RangeHandler.requests[-1].get('if-range') == '"v2"')
+
+    def testEncodedRangeNotAppended(self):
+        self.interrupted()
+        RangeHandler.gzip_ranges = True
+        response, data = self.request()
+        self.assertEqual(RangeHandler.body, data)
+        self.assertEqual('identity', RangeHandler.requests[-2]['accept-encoding'])
+        # Fetched again in full instead, and cached as it is
+        self.assertFalse('range' in RangeHandler.requests[-1])
+        client = httplib2.Http(self.cache())
+        response, content = client.request(self.url, headers={'cache-control': 'max-age=3600'})
+        self.assertTrue(response.fromcache)
+        self.assertEqual(RangeHandler.body, content.read())
+        content.close()
+
+    def testAbortTruncates(self):
+        self.interrupted()
+        cache = self.cache()
+        cached_value = cache.get(self.url)
+        length = os.fstat(cached_value.fileno()).st_size
+        writer = cache.resume(self.url, cached_value, length)
+        writer.write("not the body")
+        writer.abort()
+        self.assertEqual(length, os.fstat(cached_value.fileno()).st_size)
+        cached_value.close()
+        response, data = self.request()
+        self.assertEqual(RangeHandler.body, data)
+        self.assertEqual('bytes=1000-', RangeHandler.requests[-1]['range'])
+
+    def testResumedTwice(self):
+        self.interrupted()
+        RangeHandler.cut = 500
+        client = httplib2.Http(self.cache())
+        response, content = client.request(self.url)
+        self.assertEqual(RangeHandler.body[:1500], content.read(1500))
+        self.assertRaises(httplib2.httplib.IncompleteRead, content.read)
+        content.close()
+        RangeHandler.cut = None
+        response, data = self.request()
+        self.assertEqual(RangeHandler.body, data)
+        self.assertEqual('bytes=1500-', RangeHandler.requests[-1]['range'])
+
+
+class DistributedResumeTest(ResumeTest):
+    def cache(self):
+        return dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True, tee=True)
+
+
+class AppenderTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = httplib2.FileCache(self.cache_dir, tee=True)
+        f = open(os.path.join(self.cache_dir, self.cache.safe('key')), 'wb')
+        f.write("partial")
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get(self):
+        cached_value = self.cache.get('key')
+        self.addCleanup(cached_value.close)
+        return cached_value
+
+    def testOneAppender(self):
+        (first, second) = (self.get(), self.get())
+        writer = self.cache.resume('key', first, 7)
+        if httplib2.cacheformat.fcntl is not None:
+            self.assertEqual(None, self.cache.resume('key', second, 7))
+        writer.write(" and more")
+        writer.commit()
+        # Appended to since it was read
+        self.assertEqual(None, self.cache.resume('key', second, 7))
+        self.assertEqual("partial and more", self.get().read())
+
+    def testReplaced(self):
+        cached_value = self.get()
+        os.remove(os.path.join(self.cache_dir, self.cache.safe('key')))
+        self.assertEqual(None, self.cache.resume('key', cached_value, 7))
+        self.assertEqual([], os.listdir(self.cache_dir))
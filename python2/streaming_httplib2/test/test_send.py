@@ -0,0 +1,208 @@
+import errno
+import io
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import threading
+import unittest
+
+import streaming_httplib2 as httplib2
+
+from streaming_httplib2.test import miniserver
+
+
+class SendToTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = httplib2.Http(self.cache_dir)
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+        self.sendfile_calls = []
+        self.old_sendfile = httplib2._sendfile
+
+        def counted(*args):
+            self.sendfile_calls.append(args)
+            return self.old_sendfile(*args)
+        if self.old_sendfile is not None:
+            httplib2._sendfile = counted
+
+    def tearDown(self):
+        httplib2._sendfile = self.old_sendfile
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def cached(self):
+        response, content = self.client.request(self.url, headers={'cache-control': 'max-age=3600'})
+        content.read()
+        content.close()
+        response, content = self.client.request(self.url, headers={'cache-control': 'only-if-cached'})
+        self.assertTrue(response.fromcache)
+        self.addCleanup(content.close)
+        return content
+
+    def testFile(self):
+        content = self.cached()
+        out = tempfile.TemporaryFile()
+        self.assertEqual(len(self.expected), httplib2.send_to(content, out))
+        out.seek(0)
+        self.assertEqual(self.expected, out.read())
+        self.assertEqual("", content.read())
+        if self.old_sendfile is not None:
+            self.assertTrue(self.sendfile_calls)
+
+    def testSocket(self):
+        content = self.cached()
+        # Partly read already
+        start = content.read(10)
+        (ours, theirs) = socket.socketpair()
+        self.addCleanup(ours.close)
+        received = []
+
+        def receive():
+            while True:
+                data = theirs.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+            theirs.close()
+        thread = threading.Thread(target=receive)
+        thread.start()
+        ours.settimeout(5)
+        self.assertEqual(len(self.expected) - 10, httplib2.send_to(content, ours))
+        ours.shutdown(socket.SHUT_WR)
+        thread.join()
+        self.assertEqual(self.expected, start + "".join(received))
+
+    def testWouldBlockHighDescriptor(self):
+        # Waiting for a descriptor above FD_SETSIZE (1024) to be writable
+        if self.old_sendfile is None:
+            return
+        content = self.cached()
+        (read_fd, write_fd) = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        try:
+            os.dup2(write_fd, 1500)
+        except OSError:
+            return
+        self.addCleanup(os.close, 1500)
+        blocked = []
+
+        def would_block(*args):
+            if not blocked:
+                blocked.append(args)
+                raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+            return self.old_sendfile(*args)
+        httplib2._sendfile = would_block
+        self.assertEqual(len(self.expected), httplib2.send_to(content, 1500))
+        self.assertTrue(blocked)
+        self.assertEqual(self.expected, os.read(read_fd, len(self.expected) + 1))
+
+    def testNotAFile(self):
+        (read_fd, write_fd) = os.pipe()
+        self.assertEqual(5, httplib2.send_to(StringIO.StringIO("hello"), write_fd))
+        os.close(write_fd)
+        self.assertEqual("hello", os.read(read_fd, 10))
+        os.close(read_fd)
+        self.assertEqual([], self.sendfile_calls)
+
+
+class Chunks(object):
+    """Records the size of each read, and whether readinto is used."""
+    def __init__(self, data, readinto):
+        self.fp = StringIO.StringIO(data)
+        self.reads = []
+        if readinto:
+            self.readinto = self._readinto
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.reads.append(('read', len(data)))
+        return data
+
+    def _readinto(self, buf):
+        data = self.fp.read(len(buf))
+        buf[:len(data)] = data
+        self.reads.append(('readinto', len(data)))
+        return len(data)
+
+
+class CopyTest(unittest.TestCase):
+    data = "x" * 2500
+
+    def testReadinto(self):
+        content = Chunks(self.data, True)
+        written = []
+        self.assertEqual(2500, httplib2._copy(content, lambda view: written.append(view.tobytes()), 1000))
+        self.assertEqual(self.data, "".join(written))
+        self.assertEqual([('readinto', 1000), ('readinto', 1000), ('readinto', 500), ('readinto', 0)],
+                         content.reads)
+
+    def testRead(self):
+        content = Chunks(self.data, False)
+        written = []
+        self.assertEqual(2500, httplib2._copy(content, written.append, 1000))
+        self.assertEqual(self.data, "".join(written))
+        self.assertEqual([('read', 1000), ('read', 1000), ('read', 500), ('read', 0)], content.reads)
+
+    def testFileCache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = httplib2.FileCache(cache_dir, chunk_size=1000)
+        content = Chunks(self.data, True)
+        stored = cache.set('key', 'header\r\n\r\n', content)
+        self.assertEqual(self.data, stored.read())
+        stored.close()
+        self.assertEqual(4, len(content.reads))
+
+
+class ContentTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = httplib2.Http(self.cache_dir)
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def request(self, method="GET"):
+        return self.client.request(self.url, method, headers={'cache-control': 'max-age=3600'})
+
+    def testNetwork(self):
+        # Without a cache, the content is read from the connection
+        self.client = httplib2.Http()
+        response, content = self.request()
+        self.assertFalse(response.fromcache)
+        self.assertTrue(isinstance(content, httplib2.Content))
+        self.assertEqual(len(self.expected), content.length)
+        self.assertRaises(io.UnsupportedOperation, content.fileno)
+        buf = bytearray(10)
+        self.assertEqual(10, content.readinto(buf))
+        self.assertEqual(self.expected[:10], str(buf))
+        self.assertEqual(self.expected[10:], "".join(content.iter_chunks(100)))
+        content.close()
+        content.close()
+
+    def testCacheHit(self):
+        response, content = self.request()
+        content.read()
+        content.close()
+        response, content = self.request()
+        self.assertTrue(response.fromcache)
+        with content:
+            self.assertEqual(len(self.expected), content.length)
+            self.assertEqual(len(self.expected), os.fstat(content.fileno()).st_size - content.tell())
+            buf = bytearray(len(self.expected) + 10)
+            self.assertEqual(len(self.expected), content.readinto(memoryview(buf)))
+        self.assertTrue(content.closed)
+
+    def testHead(self):
+        response, content = self.request("HEAD")
+        self.assertEqual(0, content.length)
+        self.assertEqual("", content.read())
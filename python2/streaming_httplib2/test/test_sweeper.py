@@ -0,0 +1,120 @@
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import cacheformat
+from streaming_httplib2 import dcache
+from streaming_httplib2 import sweeper
+
+
+def email_date(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(t))
+
+
+class SweeperTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = httplib2.FileCache(self.cache_dir, index=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def store(self, key, age, **headers):
+        headers['date'] = email_date(time.time() - age)
+        headers.setdefault('cache-control', 'max-age=60')
+        response = httplib2.Response(headers)
+        text = "status: 200\ncontent-length: 4\n" + "".join(["%s: %s\n" % item for item in headers.items()])
+        header = cacheformat.pack(text, 4, httplib2._entry_expiry(response))
+        self.cache.set(key, header, StringIO.StringIO("body")).close()
+
+    def keys(self):
+        return sorted([entry['key'] for entry in self.cache.index.query()])
+
+    def testSweep(self):
+        self.store('expired', 3600)
+        self.store('fresh', 0)
+        self.store('etag', 3600, etag='"x"')
+        self.store('last-modified', 3600, **{'last-modified': email_date(0)})
+        # Expiry not known
+        self.store('no-freshness', 3600, **{'cache-control': 'no-cache'})
+        s = sweeper.Sweeper(self.cache_dir, index=self.cache.index)
+        s.sweep()
+        self.assertEqual((1, 5), (s.removed, s.examined))
+        self.assertEqual(['etag', 'fresh', 'last-modified', 'no-freshness'], self.keys())
+        self.assertEqual(None, self.cache.get('expired'))
+
+    def testPermanentRedirectsKept(self):
+        client = httplib2.Http(self.cache)
+        # How Http caches a 301, followed from the cache from then on
+        response = httplib2.Response({'status': '301', 'date': email_date(time.time() - 3600),
+                                      'location': 'http://example.org/'})
+        response['-x-permanent-redirect-url'] = response['location']
+        content = httplib2._updateCache({}, response, StringIO.StringIO(""), self.cache, 'redirect')
+        content.read()
+        content.close()
+        self.store('expired-redirect', 3600, **{'-x-permanent-redirect-url': 'http://example.org/'})
+        s = sweeper.Sweeper(self.cache_dir, index=self.cache.index)
+        s.sweep()
+        self.assertEqual((0, 2), (s.removed, s.examined))
+        info, cached_value, cachekey = client._cache_lookup('redirect')
+        self.assertEqual('http://example.org/', info['-x-permanent-redirect-url'])
+        cached_value.close()
+
+    def testVersion0(self):
+        path = os.path.join(self.cache_dir, 'entry')
+        f = open(path, 'wb')
+        f.write("status: 200\ncontent-length: 4\ndate: %s\ncache-control: max-age=60\r\n\r\nbody" %
+                email_date(time.time() - 3600))
+        f.close()
+        sweeper.Sweeper(self.cache_dir).sweep()
+        self.assertFalse(os.path.exists(path))
+
+    def testBatches(self):
+        for key in 'abcde':
+            self.store(key, 3600)
+        s = sweeper.Sweeper(self.cache_dir, batch_size=2)
+        self.assertTrue(s.sweep_batch())
+        self.assertEqual(2, s.removed)
+        self.assertTrue(s.sweep_batch())
+        self.assertFalse(s.sweep_batch())
+        self.assertEqual(5, s.removed)
+
+    def testRateLimit(self):
+        for key in 'abcd':
+            self.store(key, 0)
+        s = sweeper.Sweeper(self.cache_dir, batch_size=1, rate=20)
+        start = time.time()
+        s.sweep()
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual((0, 4), (s.removed, s.examined))
+
+    def testBackground(self):
+        self.store('expired', 3600)
+        s = sweeper.Sweeper(self.cache_dir, index=self.cache.index)
+        s.start()
+        try:
+            for i in range(100):
+                if s.removed:
+                    break
+                time.sleep(0.01)
+        finally:
+            s.stop()
+        self.assertEqual([], self.keys())
+
+    def testLockedEntriesKept(self):
+        cache = dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True)
+        self.assertEqual(None, cache.get('key'))
+        cache.set('key', "status: 200\ncontent-length: 4\ndate: %s\ncache-control: max-age=60\r\n\r\n" %
+                  email_date(time.time() - 3600), StringIO.StringIO("body")).close()
+        reading = cache.get('key')
+        try:
+            sweeper.Sweeper(self.cache_dir).sweep()
+            self.assertTrue(os.path.exists(cache.cache_path('key')))
+        finally:
+            reading.close()
+        sweeper.Sweeper(self.cache_dir).sweep()
+        self.assertFalse(os.path.exists(cache.cache_path('key')))
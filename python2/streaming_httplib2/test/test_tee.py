@@ -0,0 +1,116 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+import streaming_httplib2 as httplib2
+from streaming_httplib2 import dcache
+
+from streaming_httplib2.test import miniserver
+
+
+class NoLengthHandler(miniserver.ThisDirHandler):
+    "Sends bodies without a Content-Length, ended by closing the connection"
+    def send_header(self, keyword, value):
+        if keyword.lower() != 'content-length':
+            miniserver.ThisDirHandler.send_header(self, keyword, value)
+
+
+class TeeTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd, self.port = miniserver.start_server(miniserver.ThisDirHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'http://localhost:%d/miniserver.py' % self.port
+        self.expected = open(os.path.join(miniserver.HERE, 'miniserver.py')).read()
+        self.client = httplib2.Http(self.cache())
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def cache(self, tee=True):
+        return httplib2.FileCache(self.cache_dir, tee=tee)
+
+    def files(self):
+        found = []
+        for (path, dirs, files) in os.walk(self.cache_dir):
+            found.extend(files)
+        return found
+
+    def request(self):
+        return self.client.request(self.url, headers={'cache-control': 'max-age=3600'})
+
+    def testWrittenAsRead(self):
+        response, content = self.request()
+        self.assertFalse(response.fromcache)
+        self.assertTrue(isinstance(content.fp, httplib2._TeeContent))
+        self.assertEqual(self.expected[:100], content.read(100))
+        self.assertEqual(self.expected[100:], content.read())
+        content.close()
+        self.assertEqual(1, len(self.files()))
+        response, content = self.request()
+        self.assertTrue(response.fromcache)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+
+    def testAbandoned(self):
+        response, content = self.request()
+        self.assertEqual(self.expected[:100], content.read(100))
+        content.close()
+        self.assertEqual([], self.files())
+        response, content = self.request()
+        self.assertFalse(response.fromcache)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+
+    def testDropped(self):
+        response, content = self.request()
+        self.assertEqual(self.expected[:100], content.read(100))
+        del response, content
+        gc.collect()
+        # No temporary file or lock left behind
+        self.assertEqual([], self.files())
+        response, content = self.request()
+        self.assertFalse(response.fromcache)
+        self.assertEqual(self.expected, content.read())
+        content.close()
+        response, content = self.request()
+        self.assertTrue(response.fromcache)
+        content.close()
+
+    def testPermanentRedirect(self):
+        # Without a Content-Length, to /functional/
+        url = 'http://localhost:%d/functional' % self.port
+        for tee in (True, False):
+            self.client = httplib2.Http(self.cache(tee))
+            for fromcache in (False, True):
+                response, content = self.client.request(url)
+                content.close()
+                self.assertEqual(200, response.status)
+                self.assertEqual((301, fromcache), (response.previous.status, response.previous.fromcache))
+            self.client.cache.delete(url)
+
+    def testUnknownLength(self):
+        httpd, port = miniserver.start_server(NoLengthHandler)
+        self.addCleanup(httpd.shutdown)
+        self.url = 'http://localhost:%d/miniserver.py' % port
+        # Written as they are read, with or without tee
+        for tee in (True, False):
+            self.client = httplib2.Http(self.cache(tee))
+            response, content = self.request()
+            self.assertFalse('content-length' in response)
+            self.assertTrue(isinstance(content.fp, httplib2._TeeContent))
+            self.assertEqual(self.expected, content.read())
+            content.close()
+            response, content = self.request()
+            self.assertTrue(response.fromcache)
+            self.assertEqual(str(len(self.expected)), response['content-length'])
+            self.assertEqual(self.expected, content.read())
+            content.close()
+            self.client.cache.delete(httplib2.urlnorm(self.url)[-1])
+
+
+class DistributedTeeTest(TeeTest):
+    def cache(self, tee=True):
+        return dcache.DistributedFileCache(self.cache_dir, path_schema=[(0, 1)], create=True, tee=tee)
@@ -0,0 +1,42 @@
+import unittest
+
+import streaming_httplib2 as httplib2
+
+
+class FakePeer(object):
+    def getpeercert(self, binary_form=False):
+        if binary_form:
+            return 'certificate'
+        return {'subject': ((('commonName', '*.example.org'),),)}
+
+
+class CachedChecksTest(unittest.TestCase):
+    def setUp(self):
+        httplib2._hostname_checks.clear()
+        self.conn = httplib2.HTTPSConnectionWithTimeout('www.example.org')
+        self.checks = []
+        validate = self.conn._ValidateCertificateHostname
+
+        def counted(cert, hostname):
+            self.checks.append(hostname)
+            return validate(cert, hostname)
+        self.conn._ValidateCertificateHostname = counted
+
+    def tearDown(self):
+        httplib2._hostname_checks.clear()
+
+    def testHostnameChecksRemembered(self):
+        peer = FakePeer()
+        for i in range(2):
+            self.assertTrue(httplib2._check_hostname(self.conn, peer, 'www.example.org'))
+            self.assertFalse(httplib2._check_hostname(self.conn, peer, 'example.com'))
+        self.assertEqual(['www.example.org', 'example.com'], self.checks)
+
+    def testContextsShared(self):
+        if not hasattr(httplib2.ssl, 'SSLContext'):
+            return
+        first = httplib2._ssl_context(None, None, httplib2.ssl.CERT_REQUIRED, httplib2.CA_CERTS)
+        second = httplib2._ssl_context(None, None, httplib2.ssl.CERT_REQUIRED, httplib2.CA_CERTS)
+        self.assertTrue(first is second)
+        other = httplib2._ssl_context(None, None, httplib2.ssl.CERT_NONE, httplib2.CA_CERTS)
+        self.assertFalse(first is other)
@@ -0,0 +1,113 @@
+import base64
+import tempfile
+import unittest
+
+import streaming_httplib2 as httplib2
+
+from streaming_httplib2.test import miniserver
+
+
+class EchoHandler(miniserver.KeepAliveHandler):
+    """Answers PUT requests with the body they sent, and how it was sent.
+    Paths starting with /auth want basic authentication, /redirect is
+    redirected to /."""
+    received = []
+
+    def do_PUT(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    break
+            body = "".join(chunks)
+            framing = 'chunked'
+        else:
+            body = self.rfile.read(int(self.headers['content-length']))
+            framing = 'length'
+        self.received.append(body)
+        if self.path.startswith('/auth') and self.headers.get('authorization') != 'Basic ' + base64.b64encode('joe:secret'):
+            self.answer(401, '', [('WWW-Authenticate', 'Basic realm="test"')])
+        elif self.path.startswith('/redirect'):
+            self.answer(307, '', [('Location', '/')])
+        else:
+            self.answer(200, '%s %s' % (framing, body))
+
+    def answer(self, status, body, headers=[]):
+        self.send_response(status)
+        for (key, value) in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RecordingConnection(object):
+    def __init__(self):
+        self.sent = []
+
+    def putrequest(self, method, url, **skips):
+        pass
+
+    def putheader(self, key, value):
+        pass
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+class ChunkedTest(unittest.TestCase):
+    def testOneSendPerChunk(self):
+        conn = RecordingConnection()
+        body = httplib2._StreamingBody(['hello', ' world'], None)
+        httplib2._send_streaming(conn, 'PUT', '/', body, {})
+        self.assertEqual(['5\r\nhello\r\n', '6\r\n world\r\n', '0\r\n\r\n'], conn.sent)
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        del EchoHandler.received[:]
+        self.httpd, self.port = miniserver.start_server(EchoHandler)
+        self.client = httplib2.Http()
+        self.client.add_credentials('joe', 'secret')
+
+    def tearDown(self):
+        self.client.connections.clear()
+        self.httpd.shutdown()
+
+    def put(self, path, body, headers=None):
+        response, content = self.client.request('http://localhost:%d%s' % (self.port, path), 'PUT',
+                                                body, headers)
+        self.assertEqual(200, response.status)
+        return content.read()
+
+    def testFile(self):
+        body = tempfile.TemporaryFile()
+        body.write('skipped, then sent')
+        body.seek(9)
+        self.assertEqual('length then sent', self.put('/', body))
+
+    def testIterator(self):
+        self.assertEqual('chunked hello world', self.put('/', iter(['hello', ' ', 'world'])))
+
+    def testIteratorWithLength(self):
+        self.assertEqual('length hello', self.put('/', iter(['hel', 'lo']), {'content-length': '5'}))
+
+    def testRewoundForAuthentication(self):
+        body = tempfile.TemporaryFile()
+        body.write('data')
+        body.seek(0)
+        self.assertEqual('length data', self.put('/auth', body))
+        self.assertEqual(['data', 'data'], EchoHandler.received)
+
+    def testRewoundForRedirect(self):
+        self.client.follow_all_redirects = True
+        self.assertEqual('chunked data', self.put('/redirect', ['da', 'ta']))
+
+    def testNotRewindable(self):
+        self.assertRaises(httplib2.NonRewindableBodyError, self.put, '/auth', iter(['data']))